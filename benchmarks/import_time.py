@@ -0,0 +1,99 @@
+# %%
+"""
+Start-up time of light `bioio` commands, which must not import tensorflow (or other heavy dependencies).
+
+Every command is run in a fresh interpreter (i.e. the time includes python start-up and all imports). Exits with
+status 1 if a command exceeds the time budget or imports a heavy module.
+
+Usage:
+    python benchmarks/import_time.py --budget 1.0
+
+The same check runs as part of the tests (tests/test_import_time.py).
+"""
+
+# %%
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+import click
+
+from bioio.tf.writer import TFRecordAppendWriter
+
+# %%
+HEAVY_MODULES = ('tensorflow', 'tensorflow_datasets', 'pandas', 'torch', 'pysam', 'pyBigWig')
+
+# runs the CLI like `bioio ...` and prints the heavy modules it imported
+RUNNER = """
+import sys, json, runpy
+sys.argv = ['bioio'] + json.loads(sys.argv[1])
+try:
+    runpy.run_module('bioio', run_name='__main__')
+except SystemExit as e:
+    if e.code not in (None, 0):
+        raise
+print(json.dumps([m for m in {heavy} if m in sys.modules]), file=sys.stderr)
+"""
+
+# %%
+def light_commands(tfrecord, directory):
+    return {
+        'version': ['--version'],
+        'tf-utils count': ['tf-utils', 'count', tfrecord],
+        'tf-utils verify': ['tf-utils', 'verify', tfrecord],
+        'tfrecord2idx': ['tfrecord2idx', tfrecord, '-i', os.path.join(directory, 'test.idx')],
+        'cache ls': ['cache', 'ls', '-d', os.path.join(directory, 'cache')],
+    }
+
+# %%
+def write_test_tfrecord(filepath, num_records=1000):
+    with TFRecordAppendWriter(filepath) as writer:
+        for i in range(num_records):
+            writer.write(os.urandom(100 + i % 100))
+
+# %%
+def run_command(args):
+    """Runs a command in a fresh interpreter, returns its wall time and the heavy modules it imported."""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', RUNNER.format(heavy=HEAVY_MODULES), json.dumps(args)], capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'Command {args} failed:\n{result.stderr}')
+    return seconds, json.loads(result.stderr.strip().splitlines()[-1])
+
+# %%
+def measure_command(args, repeat=3):
+    """Returns the minimum wall time of a command over repeated runs and the heavy modules imported by any run."""
+    runs = [run_command(args) for _ in range(repeat)]
+    return min(seconds for seconds, _ in runs), sorted(set(m for _, modules in runs for m in modules))
+
+# %%
+@click.command()
+@click.option('--budget', type=float, default=1.0, help='Maximum start-up time (in seconds) of each light command.')
+@click.option('-r', '--repeat', type=int, default=3, help='Number of repetitions (minimum is reported).')
+def main(budget, repeat):
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        tfrecord = os.path.join(directory, 'test.tfrecord')
+        write_test_tfrecord(tfrecord)
+
+        for name, args in light_commands(tfrecord, directory).items():
+            seconds, heavy = measure_command(args, repeat)
+            status = 'OK'
+            if heavy:
+                status = f"imports {', '.join(heavy)}"
+            elif seconds > budget:
+                status = f'exceeds budget of {budget:.2f}s'
+            if status != 'OK':
+                failures.append(name)
+            print(f'{name:<20} {seconds:8.3f}s  {status}')
+
+    if failures:
+        sys.exit(1)
+
+# %%
+if __name__ == '__main__':
+    main()
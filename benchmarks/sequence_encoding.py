@@ -0,0 +1,69 @@
+# %%
+"""
+Benchmark of the per-base sequence encoding functions in bioio.utils against the 
+vectorized (lookup-table) batch encoder. 
+
+Usage: 
+    python benchmarks/sequence_encoding.py --length 1000 --n 2000
+"""
+
+# %%
+import time
+
+import click
+import numpy as np
+import tensorflow as tf
+
+from bioio.utils import sequence2onehot, reverse_complement, mask_noncanonical_bases, encode_sequence, encode_sequences
+
+# %%
+def random_sequences(n, length, seed=0):
+    rng = np.random.default_rng(seed)
+    alphabet = np.frombuffer(b'ACGTacgtN', dtype=np.uint8)
+    bases = alphabet[rng.choice(len(alphabet), size=(n, length), p=[0.2]*4 + [0.04]*4 + [0.04])]
+    strands = rng.choice(['+', '-'], size=n)
+    return [row.tobytes().decode('ascii') for row in bases], list(strands)
+
+# %%
+def legacy_encode(sequence, strand):
+    # per-base path of Fasta.fetch before vectorization
+    sequence = mask_noncanonical_bases(sequence.upper())
+    if strand == '-':
+        sequence = ''.join(reverse_complement(sequence))
+    return tf.cast(sequence2onehot(sequence), tf.int8).numpy()
+
+# %%
+def timeit(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+# %%
+@click.command()
+@click.option('-n', '--n', type=int, default=1000, help='Number of sequences.')
+@click.option('-l', '--length', type=int, default=1000, help='Length of each sequence.')
+@click.option('-r', '--repeat', type=int, default=3, help='Number of repetitions (minimum is reported).')
+def main(n, length, repeat):
+    sequences, strands = random_sequences(n, length)
+
+    # sanity check, all encoders must agree
+    for sequence, strand in zip(sequences[:100], strands[:100]):
+        assert np.array_equal(legacy_encode(sequence, strand), encode_sequence(sequence, strand))
+
+    results = {
+        'per-base (legacy)': timeit(lambda: [legacy_encode(s, strand) for s, strand in zip(sequences, strands)], repeat),
+        'vectorized (per sequence)': timeit(lambda: [encode_sequence(s, strand) for s, strand in zip(sequences, strands)], repeat),
+        'vectorized (batch)': timeit(lambda: encode_sequences(sequences, strands), repeat),
+    }
+
+    baseline = results['per-base (legacy)']
+    print(f'{n} sequences x {length} bp')
+    for name, seconds in results.items():
+        print(f'{name:<28} {seconds*1000:10.1f} ms {n/seconds:12.0f} seq/s {baseline/seconds:8.1f}x')
+
+# %%
+if __name__ == '__main__':
+    main()
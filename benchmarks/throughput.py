@@ -0,0 +1,265 @@
+# %%
+"""
+Read and write throughput benchmarks, on synthetic data and the bundled examples (i.e. offline).
+
+Measures `serialize` examples/s (examples/basset and examples/eCLIP biospecs), `load_tfrecord` read throughput
+at different shuffle buffer sizes, `GFileTFRecord` random-access latency (p50/p99), and `index_tfrecord` and
+`count_records` MB/s. Results are written as JSON and can be compared against a saved baseline.
+
+Usage:
+    python benchmarks/throughput.py run -o results.json
+    python benchmarks/throughput.py compare baseline.json results.json --threshold 0.1
+"""
+
+# %%
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+
+import click
+import numpy as np
+import tensorflow as tf
+
+import bioio
+from bioio import load_biospec
+from bioio.tf.crc import CRC32C_BACKEND
+from bioio.tf.utils import load_tfrecord, dataset_to_tfrecord, dataset_to_tensor_features
+from bioio.tf.index import index_tfrecord, load_index
+from bioio.tf.gfile import GFileTFRecord
+from bioio.bin.serialize import write_tfrecord
+from bioio.bin.tfutils.count import count_records
+
+# %%
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples')
+
+ECLIP_BIOSPEC = """
+source:
+  !PyIterable &bed
+    object: bioio.dataspec.sources.Bed
+    args:
+      filepath: {eclip}/peaks/peaks.crosslink.slop-200b.bed
+data:
+  inputs:
+    sequence:
+      !Transform
+        object: bioio.dataspec.transforms.Fasta
+        input: *bed
+        batch_size: 64
+        args:
+          filepath: {meta}/chr19.fa
+  outputs:
+    total:
+      !Transform
+        object: bioio.dataspec.transforms.StrandedBigWig
+        input: *bed
+        batch_size: 64
+        args:
+          bigwig_plus: {eclip}/bigWig/total/counts.pos.bw
+          bigwig_minus: {eclip}/bigWig/total/counts.neg.bw
+    control:
+      !Transform
+        object: bioio.dataspec.transforms.StrandedBigWig
+        input: *bed
+        batch_size: 64
+        args:
+          bigwig_plus: {eclip}/bigWig/control/counts.pos.bw
+          bigwig_minus: {eclip}/bigWig/control/counts.neg.bw
+"""
+
+# %%
+def best_of(func, repeat):
+    """Returns the minimum wall time of repeat calls of func (and the result of the last call)."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+# %%
+def metric(value, unit, higher_is_better=True):
+    return {'value': float(value), 'unit': unit, 'higher_is_better': higher_is_better}
+
+# %%
+def consume(dataset):
+    return int(dataset.reduce(np.int64(0), lambda n, _: n + 1))
+
+# %%
+def synthetic_tfrecord(filepath, num_records, length=1000, seed=0):
+    """Writes a TFRecord file (with features and index) of one-hot sequences, coverage tracks and names."""
+    rng = np.random.default_rng(seed)
+    def examples():
+        for i in range(num_records):
+            yield {
+                'name': f'example_{i}',
+                'sequence': np.eye(4, dtype=np.int8)[rng.integers(0, 4, length)],
+                'coverage': rng.poisson(1.0, length).astype(np.float32),
+            }
+    signature = {
+        'name': tf.TensorSpec((), tf.string),
+        'sequence': tf.TensorSpec((None, 4), tf.int8),
+        'coverage': tf.TensorSpec((None, ), tf.float32),
+    }
+    dataset_to_tfrecord(tf.data.Dataset.from_generator(examples, output_signature=signature), filepath, encoding='bytes')
+    index_tfrecord(filepath, filepath + '.idx')
+
+# %%
+def bench_serialize(name, biospec, directory, tmpdir, repeat):
+    cwd = os.getcwd()
+    try:
+        # relative paths of a biospec are relative to its directory
+        os.chdir(directory)
+        dataset = load_biospec(biospec)
+        features = dataset_to_tensor_features(dataset, encoding='bytes')
+    finally:
+        os.chdir(cwd)
+
+    out = os.path.join(tmpdir, f'{name}.tfrecord')
+    seconds, num_records = best_of(lambda: write_tfrecord(dataset, features, out, None, out_index=out + '.idx'), repeat)
+    return {f'serialize.{name}.examples_per_s': metric(num_records / seconds, 'examples/s')}
+
+# %%
+def bench_load_tfrecord(tfrecord, shuffle_sizes, repeat):
+    size_mb = os.path.getsize(tfrecord) / 2**20
+    results = {}
+    for shuffle in shuffle_sizes:
+        name = f'load_tfrecord.shuffle_{shuffle or 0}'
+        seconds, n = best_of(lambda: consume(load_tfrecord(tfrecord, shuffle=shuffle)), repeat)
+        results[f'{name}.examples_per_s'] = metric(n / seconds, 'examples/s')
+        results[f'{name}.mb_per_s'] = metric(size_mb / seconds, 'MB/s')
+
+    seconds, n = best_of(lambda: consume(load_tfrecord(tfrecord, deserialize=False)), repeat)
+    results['load_tfrecord.raw.mb_per_s'] = metric(size_mb / seconds, 'MB/s')
+    return results
+
+# %%
+def latencies(func, offsets):
+    timings = np.zeros(len(offsets))
+    for i, offset in enumerate(offsets):
+        start = time.perf_counter()
+        func(offset)
+        timings[i] = time.perf_counter() - start
+    return timings * 1e6
+
+# %%
+def bench_random_access(tfrecord, num_reads, seed=0):
+    offsets = np.asarray(load_index(tfrecord + '.idx'))
+    offsets = offsets[np.random.default_rng(seed).integers(0, len(offsets), num_reads)]
+
+    results = {}
+    readers = {
+        'mmap': GFileTFRecord(tfrecord, features=tfrecord + '.features.json', use_mmap=True),
+        'gfile': GFileTFRecord(tfrecord, features=tfrecord + '.features.json', use_mmap=False),
+    }
+    calls = {
+        'raw': lambda reader: (lambda offset: reader(offset, deserialize=False)),
+        'numpy': lambda reader: (lambda offset: reader(offset, to_numpy=True)),
+    }
+    for reader_name, reader in readers.items():
+        for call_name, call in calls.items():
+            timings = latencies(call(reader), offsets)
+            name = f'gfile_tfrecord.{reader_name}.{call_name}'
+            results[f'{name}.p50_us'] = metric(np.percentile(timings, 50), 'us', higher_is_better=False)
+            results[f'{name}.p99_us'] = metric(np.percentile(timings, 99), 'us', higher_is_better=False)
+    return results
+
+# %%
+def bench_scan(tfrecord, tmpdir, repeat):
+    size_mb = os.path.getsize(tfrecord) / 2**20
+    seconds_index, _ = best_of(lambda: index_tfrecord(tfrecord, os.path.join(tmpdir, 'bench.idx')), repeat)
+    seconds_count, _ = best_of(lambda: count_records(tfrecord), repeat)
+    seconds_validate, _ = best_of(lambda: count_records(tfrecord, validate=True), repeat)
+    return {
+        'index_tfrecord.mb_per_s': metric(size_mb / seconds_index, 'MB/s'),
+        'count_records.mb_per_s': metric(size_mb / seconds_count, 'MB/s'),
+        'count_records.validate.mb_per_s': metric(size_mb / seconds_validate, 'MB/s'),
+    }
+
+# %%
+def environment():
+    return {
+        'bioio': bioio.__version__,
+        'python': platform.python_version(),
+        'tensorflow': tf.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'crc32c_backend': CRC32C_BACKEND,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+# %%
+@click.group()
+def main():
+    pass
+
+# %%
+@main.command()
+@click.option('-o', '--out', type=str, default=None, help='Write results as JSON to this file.')
+@click.option('--records', type=int, default=20000, help='Number of records of the synthetic TFRecord file.')
+@click.option('--reads', type=int, default=2000, help='Number of random reads for the latency benchmark.')
+@click.option('-r', '--repeat', type=int, default=3, help='Number of repetitions (minimum is reported).')
+def run(out, records, reads, repeat):
+    """Runs all benchmarks."""
+    tmpdir = tempfile.mkdtemp(prefix='bioio-benchmarks-')
+    try:
+        with open(os.path.join(tmpdir, 'eclip.yml'), 'w') as f:
+            f.write(ECLIP_BIOSPEC.format(eclip=os.path.join(EXAMPLES, 'eCLIP', 'ENCODE_TIA1-HepG2'), meta=os.path.join(EXAMPLES, 'meta.data')))
+        tfrecord = os.path.join(tmpdir, 'synthetic.tfrecord')
+        synthetic_tfrecord(tfrecord, records)
+
+        results = {}
+        results.update(bench_serialize('basset', 'samples.biospec.yml', os.path.join(EXAMPLES, 'basset'), tmpdir, repeat))
+        results.update(bench_serialize('eclip', os.path.join(tmpdir, 'eclip.yml'), tmpdir, tmpdir, repeat))
+        results.update(bench_load_tfrecord(tfrecord, [None, 1000, 10000], repeat))
+        results.update(bench_random_access(tfrecord, reads))
+        results.update(bench_scan(tfrecord, tmpdir, repeat))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    for name, m in results.items():
+        print(f"{name:<48} {m['value']:14.1f} {m['unit']}")
+
+    if out is not None:
+        with open(out, 'w') as f:
+            print(json.dumps({'environment': environment(), 'config': {'records': records, 'reads': reads, 'repeat': repeat}, 'results': results}, indent=2), file=f)
+
+# %%
+@main.command()
+@click.argument('baseline')
+@click.argument('results')
+@click.option('--threshold', type=float, default=0.1, help='Relative change (in the worse direction) that is flagged as regression.')
+def compare(baseline, results, threshold):
+    """Compares results against a baseline and exits with status 1 on regressions."""
+    with open(baseline) as f:
+        baseline = json.load(f)['results']
+    with open(results) as f:
+        results = json.load(f)['results']
+
+    regressions = []
+    print(f"{'benchmark':<48} {'baseline':>12} {'result':>12} {'change':>8}")
+    for name in sorted(set(baseline) & set(results)):
+        before, after = baseline[name]['value'], results[name]['value']
+        change = (after - before) / before if before != 0 else 0.0
+        # positive changes are improvements
+        improvement = change if results[name]['higher_is_better'] else -change
+        flag = ''
+        if improvement < -threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print(f'{name:<48} {before:12.1f} {after:12.1f} {change:+8.1%} {flag}')
+
+    for name in sorted(set(baseline) ^ set(results)):
+        print(f"{name:<48} only in {'baseline' if name in baseline else 'results'}")
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) (threshold {threshold:.0%})')
+        sys.exit(1)
+
+# %%
+if __name__ == '__main__':
+    main()
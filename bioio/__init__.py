@@ -7,10 +7,12 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 # %%
-# Disable absl INFO and WARNING log messages
-from absl import logging as absl_logging
-absl_logging.set_verbosity(absl_logging.ERROR)
+from ._lazy import lazy_getattr
 
 # %%
-from . import tf#, torch
-from bioio.dataspec import load_biospec
\ No newline at end of file
+# submodules (and their attributes) are imported on first access, such that e.g. `bioio tf-utils count` does 
+# not load tensorflow
+_SUBMODULES = ('tf', 'torch', 'dataspec', 'utils')
+_ATTRIBUTES = {'load_biospec': 'dataspec'}
+
+__getattr__ = lazy_getattr(__name__, _SUBMODULES, _ATTRIBUTES)
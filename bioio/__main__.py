@@ -3,21 +3,25 @@ import click
 
 # %%
 from . import __version__
-from .bin import serialize, biospec2dot, tfrecord2idx, merge_tfrecords, tfutils
+from .bin import LazyGroup
 
 # %%
-@click.group()
+# subcommands are imported when invoked, i.e. light commands (e.g. tf-utils count, tfrecord2idx) start without tensorflow
+@click.group(cls=LazyGroup, lazy_commands={
+    'serialize': 'bioio.bin.serialize:main',
+    'biospec2dot': 'bioio.bin.biospec2dot:main',
+    'tfrecord2idx': 'bioio.bin.tfrecord2idx:main',
+    'merge-tfrecords': 'bioio.bin.merge_tfrecords:main',
+    'pack-fasta': 'bioio.bin.pack_fasta:main',
+    'cache-bigwig': 'bioio.bin.cache_bigwig:main',
+    'cache': 'bioio.bin.cache:main',
+    'profile': 'bioio.bin.profile:main',
+    'tf-utils': 'bioio.bin.tfutils:main',
+})
 @click.version_option(__version__)
 def main():
     pass
 
-# %%
-main.add_command(serialize.main, name='serialize')
-main.add_command(biospec2dot.main, name='biospec2dot')
-main.add_command(tfrecord2idx.main, name='tfrecord2idx')
-main.add_command(merge_tfrecords.main, name='merge-tfrecords')
-main.add_command(tfutils.main, name='tf-utils')
-
 # %%
 if __name__ == '__main__':
     main()
@@ -0,0 +1,24 @@
+# %%
+import sys
+import importlib
+
+# %%
+def lazy_getattr(module_name, submodules, attributes):
+    """
+    Returns a module-level __getattr__ that imports submodules (and attributes of submodules) on first access.
+
+    Args:
+        module_name (str): Name of the package, i.e. its __name__
+        submodules (tuple): Names of the submodules
+        attributes (dict): Attribute name to the name of the submodule that defines it
+    """
+
+    def __getattr__(name):
+        if name in submodules:
+            return importlib.import_module(f'{module_name}.{name}')
+        if name in attributes:
+            value = getattr(importlib.import_module(f'{module_name}.{attributes[name]}'), name)
+            setattr(sys.modules[module_name], name, value)
+            return value
+        raise AttributeError(f'module {module_name!r} has no attribute {name!r}')
+    return __getattr__
@@ -0,0 +1,27 @@
+# %%
+import importlib
+
+import click
+
+# %%
+class LazyGroup(click.Group):
+    """
+    click.Group whose subcommands are imported when they are invoked, such that heavy dependencies (e.g. tensorflow)
+    are only loaded by the commands that use them.
+
+    Args:
+        lazy_commands (dict): Command name to 'module:attribute' of the command
+    """
+
+    def __init__(self, *args, lazy_commands=None, **kwargs) -> None:
+        super(LazyGroup, self).__init__(*args, **kwargs)
+        self.lazy_commands = dict(lazy_commands or {})
+
+    def list_commands(self, ctx):
+        return sorted(set(super(LazyGroup, self).list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name in self.lazy_commands:
+            module, attribute = self.lazy_commands[name].split(':')
+            return getattr(importlib.import_module(module), attribute)
+        return super(LazyGroup, self).get_command(ctx, name)
@@ -1,43 +1,62 @@
 # %%
+import json
+
 import click
+import tensorflow as tf
 
-from bioio.dataspec.loader import load_biospec
+from bioio.dataspec.loader import load_biospec_graph
 from bioio.utils import flatten_dict
 
 # %%
-def unique_edges(dataset):
-    visited = set()
+def unique_edges(graph):
     edges = []
-    def dfs(dataset):
-        nonlocal edges
-        nonlocal visited
-
-        visited.add(id(dataset))
-        
-        for parent in dataset._inputs():
-            edges.append([f'{parent._name}', f'{dataset._name}'])
-            if id(parent) not in visited:
-                dfs(parent)
-    dfs(dataset)
+    for node in graph.nodes:
+        for parent in node.parents:
+            edges.append([parent.key, node.key])
     return edges
 
 # %%
-def dataset_to_dot(data):
+def node_attributes(node, label, profile=None):
+    # with a profile, nodes are annotated with their cost and filled by their share of the total time (the slowest node is outlined)
+    measurement = profile.get(node.key) if profile is not None else None
+    if measurement is None:
+        return f'label="{label}"'
+    label += f"\\n{measurement['wall_s']:.3f}s ({measurement['share']:.0%}), {measurement['examples_per_s']:.0f} ex/s"
+    label += f"\\npy {measurement['py_function_s']:.3f}s, graph {measurement['graph_s']:.3f}s, {measurement['peak_rss_mb']:.0f} MB"
+    attributes = f'label="{label}", style=filled, fillcolor="0.000 {measurement["share"]:.3f} 1.000"'
+    if measurement['share'] == max(m['share'] for m in profile.values()):
+        attributes += ', color=red, penwidth=3'
+    return attributes
+
+# %%
+def graph_to_dot(graph, profile=None):
     print('digraph test {')
-    dot_edges = list()
-    flattened_data_dict = flatten_dict(data)
-    for key, dataset in flattened_data_dict.items():
-        edges = unique_edges(dataset)
-        edges.append([edges[0][1], key])
-        for edge in edges:
-            edge = list(map(lambda x: f'"{x}"', edge))
-            dot_edges.append(('\t' + ' -> '.join(edge) + ';'))
-    
-    for dot_edge in set(dot_edges):
-        print(dot_edge)
 
+    # sources and fused map stages, each stage is drawn as a cluster
+    print('\tsubgraph cluster_source {')
+    print('\t\tlabel="source (zip)";')
+    for node in graph.sources:
+        print(f'\t\t"{node.key}" [{node_attributes(node, node.name + (" (cached)" if node.cache else ""), profile)}];')
+    print('\t}')
+
+    for i, stage in enumerate(graph.stages, start=1):
+        print(f'\tsubgraph cluster_stage_{i} {{')
+        print(f'\t\tlabel="map stage {i}' + (' (fused)' if len(stage) > 1 else '') + '";')
+        for node in stage:
+            label = node.name + (f' (batch_size={node.batch_size})' if node.batch_size else '') + (' (cached)' if node.cache else '')
+            print(f'\t\t"{node.key}" [{node_attributes(node, label, profile)}];')
+        print('\t}')
+
+    print()
+    for edge in unique_edges(graph):
+        edge = list(map(lambda x: f'"{x}"', edge))
+        print('\t' + ' -> '.join(edge) + ';')
+
+    # outputs (flattened keys of the biospec data)
     print()
-    for key in flattened_data_dict.keys():
+    flattened_data_dict = flatten_dict(tf.nest.map_structure(lambda node: node.key, graph.data))
+    for key, node_key in flattened_data_dict.items():
+        print(f'\t"{node_key}" -> "{key}";')
         print(f'\t"{key}" [color="red"]')
 
     print('}')
@@ -45,11 +64,17 @@ def dataset_to_dot(data):
 # %%
 @click.command()
 @click.argument('biospec')
-def main(biospec, ):
-    data = load_biospec(biospec, to_dataset=False)
-    dataset_to_dot(data)
+@click.option('--profile', 'profile_json', type=str, default=None, help='Annotate nodes with their measured cost (JSON written by bioio profile -o).')
+def main(biospec, profile_json):
+    graph = load_biospec_graph(biospec)
+
+    profile = None
+    if profile_json is not None:
+        with open(profile_json) as f:
+            profile = {node['key']: node for node in json.load(f)['nodes']}
+    graph_to_dot(graph, profile)
 
 
 # %%
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
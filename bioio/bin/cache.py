@@ -0,0 +1,39 @@
+# %%
+import time
+
+import click
+
+from bioio.dataspec.cache import NodeCache, DEFAULT_CACHE_DIR, format_size
+
+# %%
+@click.group()
+def main():
+    pass
+
+# %%
+@main.command(name='ls')
+@click.option('-d', '--directory', type=str, default=DEFAULT_CACHE_DIR, show_default=True, help='Cache directory.')
+def ls(directory):
+    """Lists cached node outputs, most recently used first."""
+    entries = NodeCache(directory).entries()
+    print('key\tname\tobject\tsize\tlast_used')
+    for entry in entries:
+        last_used = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used']))
+        print(f"{entry['key'][:12]}\t{entry.get('name')}\t{entry.get('object')}\t{format_size(entry['size'])}\t{last_used}")
+    print(f"{len(entries)} entries, {format_size(sum(entry['size'] for entry in entries))} total")
+
+# %%
+@main.command(name='prune')
+@click.option('-d', '--directory', type=str, default=DEFAULT_CACHE_DIR, show_default=True, help='Cache directory.')
+@click.option('--max-size', type=str, default=None, help='Evict least recently used entries until the cache is not larger than this (e.g. 10G). Defaults to $BIOIO_CACHE_MAX_SIZE or 50G.')
+@click.option('--all', 'remove_all', is_flag=True, default=False, help='Remove all entries.')
+def prune(directory, max_size, remove_all):
+    """Evicts least recently used cached node outputs."""
+    removed = NodeCache(directory, max_size=max_size).prune(max_size=(0 if remove_all else None))
+    for entry in removed:
+        print(f"Removed {entry['key'][:12]}\t{entry.get('name')}\t{format_size(entry['size'])}")
+    print(f"Removed {len(removed)} entries, {format_size(sum(entry['size'] for entry in removed))} total")
+
+# %%
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+# %%
+import click
+import tqdm
+
+from bioio.dataspec.transforms.bigwig_cache import cache_bigwig, estimate_track_size, open_bigwig, TrackCache
+
+# %%
+@click.command()
+@click.argument('bigwig')
+@click.option('-o', '--out', type=str, default=None, help='Output file, defaults to <bigwig>.track')
+@click.option('--dtype', type=click.Choice(['float16', 'float32']), default='float16')
+@click.option('--layout', type=click.Choice(['auto', 'dense', 'sparse']), default='auto', help='Dense (one value per base) or sparse (non-zero intervals). Auto picks the smaller one.')
+@click.option('--estimate', is_flag=True, default=False, help='Just print the estimated size of each layout and exit.')
+def main(bigwig, out, dtype, layout, estimate):
+    if estimate:
+        for name, size in estimate_track_size(bigwig, dtype).items():
+            print(f'{name}\t{size / 2**20:.1f} MB' + ('\t(upper bound)' if name == 'sparse' else ''))
+        return
+
+    if out is None:
+        out = bigwig + '.track'
+
+    bw = open_bigwig(bigwig)
+    total = sum(bw.chroms().values())
+    bw.close()
+    with tqdm.tqdm(total=total, unit='bp', unit_scale=True) as pbar:
+        layout = cache_bigwig(bigwig, out, dtype=dtype, layout=layout, pbar=pbar)
+    # CachedBigWig(in_memory=True) copies the (loaded chromosomes of the) track into the memory of every process
+    nbytes = TrackCache(out).nbytes
+    print(f'Wrote {layout} track cache to {out}, CachedBigWig(in_memory=True) holds {nbytes / 2**20:.1f} MB in memory per process (less with chroms=[...]).')
+
+# %%
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
 # %%
+import os
+import json
+import contextlib
+import multiprocessing
+
 import click
 import tqdm
 import tensorflow as tf
 
 from bioio.tf import load_tfrecord
-from bioio.tf.utils import dataset_to_tensor_features, features_to_json_file, serialize_dataset
+from bioio.tf.utils import dataset_to_tensor_features, features_to_json_file, serialize_dataset, compression_type
+from bioio.tf.index import IndexWriter, read_index_header
+from bioio.tf.writer import iter_records
+from bioio.tf.example import ExampleDecoder, feature_entries, parse_feature_entry, serialize_feature_entries
+from bioio.tf.blocks import BLOCK_INDEX_COLUMNS, DEFAULT_BLOCK_SIZE, BlockCompression, BlockTFRecordWriter
+from bioio.bin.serialize import shard_filepath, write_shard_manifest, get_tfrecord_options
+from bioio.bin.tfutils.count import count_records
 
 # %%
 def merge_dicts(dicts):
@@ -14,31 +25,194 @@ def merge_dicts(dicts):
     return xm
 
 # %%
-@click.command()
-@click.argument('tfrecords', nargs=-1)
-@click.option('--gzip', is_flag=True, default=False)
-@click.option('--compression-level', type=int, default=None)
-@click.option('-t', '--out-tfrecord', required=True, type=str)
-@click.option('-f', '--out-features', type=str, default=None)
-def main(tfrecords, gzip, compression_level, out_tfrecord, out_features):
+def input_shards(tfrecord):
+    """
+    Returns the shards of an input, i.e. the shards of its manifest (see `bioio serialize --num-shards`) or the
+    file itself, as a list of (path, number of records or None), and its features file.
+    """
+
+    manifest_filepath = tfrecord + '.manifest.json'
+    if os.path.exists(manifest_filepath) and not os.path.exists(tfrecord):
+        with open(manifest_filepath) as f:
+            manifest = json.load(f)
+        directory = os.path.dirname(tfrecord)
+        shards = [(os.path.join(directory, shard['path']), shard['num_records']) for shard in manifest['shards']]
+        return shards, os.path.join(directory, manifest['features'])
+    return [(tfrecord, None)], tfrecord + '.features.json'
+
+# %%
+def input_num_records(tfrecord, num_records=None):
+    """Number of records of a TFRecord file, from its manifest entry or closed index if possible, else by scanning the file."""
+    if num_records is not None:
+        return num_records
+    try:
+        return read_index_header(tfrecord + '.idx')['num_records']
+    except (OSError, ValueError):
+        # no index, a legacy TSV index or an unclosed index
+        return count_records(tfrecord)
+
+# %%
+def merge_features(features_jsons):
+    """
+    Merges the top-level features of FeaturesDict specifications, later inputs replace features of the same name
+    (like `merge_dicts`).
+
+    Returns:
+        tuple: Merged features specification and the names of the top-level features taken from each input
+    """
+
+    merged, owners = {}, {}
+    for i, features_json in enumerate(features_jsons):
+        for name, feature in ExampleDecoder._features_dict_content(features_json).items():
+            merged[name] = feature
+            owners[name] = i
+    features_json = {**features_jsons[0], 'content': {**features_jsons[0]['content'], 'features': merged}}
+    return features_json, [set(name for name, owner in owners.items() if owner == i) for i in range(len(features_jsons))]
+
+# %%
+def key_decoder(features_json, key):
+    decoder = ExampleDecoder(features_json).decoders.get(tuple(key.split('/')), None)
+    if decoder is None:
+        raise click.UsageError(f"Unknown key '{key}', expected one of {['/'.join(path) for path in ExampleDecoder(features_json).decoders]}.")
+    if decoder.shape != ():
+        raise click.UsageError(f"Key '{key}' is not a scalar.")
+    return decoder
+
+# %%
+def merge_records(records, owners, key_decoders=None):
+    """
+    Merges the feature maps of serialized tf.train.Example protos (one per input), without decoding any tensor.
+
+    Args:
+        records (list): Serialized examples, one per input
+        owners (list): Names of the top-level features taken from each input (see `merge_features`)
+        key_decoders (list): Optional decoder of a scalar key feature of each input, whose values must be equal
+
+    Returns:
+        bytes: Serialized example
+    """
+
+    entries, keys = {}, []
+    for record, names in zip(records, owners):
+        record_entries = feature_entries(record)
+        if key_decoders is not None:
+            decoder = key_decoders[len(keys)]
+            keys.append(decoder({decoder.name: parse_feature_entry(record_entries[decoder.name])}) if decoder.name in record_entries else None)
+        entries.update((name, entry) for name, entry in record_entries.items() if name.split('/')[0] in names)
+    if key_decoders is not None and any(key != keys[0] for key in keys[1:]):
+        raise ValueError(f'Inputs are not aligned, keys differ: {keys}')
+    return serialize_feature_entries(entries)
+
+# %%
+def merge_group(tfrecords, out_tfrecord, owners, key_decoders=None, gzip=False, compression_level=None, write_index=True, pbar=None, 
+                block_compression=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Merges aligned (uncompressed or block-compressed) TFRecord files record by record and streams the result (and its index) to out_tfrecord."""
+    tfrecord_options = get_tfrecord_options(gzip, compression_level, block_compression, block_size, compression_level)
+    if isinstance(tfrecord_options, BlockCompression):
+        tf_writer = BlockTFRecordWriter(out_tfrecord, tfrecord_options)
+        index_writer = IndexWriter(out_tfrecord + '.idx', columns=BLOCK_INDEX_COLUMNS) if write_index else contextlib.nullcontext()
+    else:
+        tf_writer = tf.io.TFRecordWriter(out_tfrecord, tfrecord_options)
+        index_writer = IndexWriter(out_tfrecord + '.idx') if write_index else contextlib.nullcontext()
+
+    n = 0
+    with tf_writer, index_writer:
+        for records in zip(*[iter_records(tfrecord) for tfrecord in tfrecords]):
+            try:
+                record = merge_records(records, owners, key_decoders)
+            except ValueError as e:
+                raise ValueError(f'Record {n} of {list(tfrecords)}: {e}')
+            position = tf_writer.position if block_compression is not None else {}
+            tf_writer.write(record)
+            if write_index:
+                index_writer.add_proto(record, **position)
+            n += 1
+            if pbar is not None:
+                pbar.update(1)
+    return n
+
+# %%
+def _merge_group_star(args):
+    out_tfrecord = args[1]
+    return {'path': os.path.basename(out_tfrecord), 'num_records': merge_group(*args)}
+
+# %%
+def merge_protos(tfrecords, out_tfrecord, out_features, key, gzip, compression_level, write_index, workers, block_compression=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Merges the feature maps of aligned inputs (files or sharded datasets with a manifest) at the proto level."""
+    inputs = [input_shards(tfrecord) for tfrecord in tfrecords]
+    num_shards = len(inputs[0][0])
+    if any(len(shards) != num_shards for shards, _ in inputs):
+        raise click.UsageError(f'Inputs have different numbers of shards: {[len(shards) for shards, _ in inputs]}')
+    for shards, _ in inputs:
+        for path, _ in shards:
+            # detected by magic bytes, gzip-compressed files are not necessarily named *.gz (e.g. `bioio serialize --gzip`)
+            if compression_type(path) == 'GZIP':
+                raise click.UsageError(f'{path} is gzip-compressed, use --decode to merge gzip-compressed TFRecord files.')
+
+    features_jsons = []
+    for _, features_file in inputs:
+        with open(features_file) as f:
+            features_jsons.append(json.load(f))
+    features_json, owners = merge_features(features_jsons)
+    key_decoders = [key_decoder(spec, key) for spec in features_jsons] if key is not None else None
+
+    # aligned by count, checked before anything is written
+    groups = [[shards[i] for shards, _ in inputs] for i in range(num_shards)]
+    for i, group in enumerate(groups):
+        counts = [input_num_records(*shard) for shard in group]
+        if any(count != counts[0] for count in counts[1:]):
+            raise click.UsageError(f'Inputs are not aligned, numbers of records differ: {dict(zip([path for path, _ in group], counts))}')
+
+    if out_features is None:
+        out_features = out_tfrecord.removesuffix('.gz') + '.features.json'
+    with open(out_features, 'w') as f:
+        print(json.dumps(features_json, indent=2), file=f)
+
+    if num_shards == 1:
+        with tqdm.tqdm(total=input_num_records(*groups[0][0])) as pbar:
+            merge_group([path for path, _ in groups[0]], out_tfrecord, owners, key_decoders, gzip, compression_level, write_index, pbar, block_compression, block_size)
+        return
+
+    # shard groups are merged in parallel (tensorflow is not fork-safe, hence 'spawn')
+    tasks = [([path for path, _ in group], shard_filepath(out_tfrecord, i, num_shards), owners, key_decoders, gzip, compression_level, write_index, None, 
+        block_compression, block_size) for i, group in enumerate(groups)]
+    with tqdm.tqdm(total=num_shards, unit='shard') as pbar:
+        if workers > 1:
+            with multiprocessing.get_context('spawn').Pool(min(workers, num_shards)) as pool:
+                shards = []
+                for shard in pool.imap(_merge_group_star, tasks):
+                    shards.append(shard)
+                    pbar.update(1)
+        else:
+            shards = []
+            for task in tasks:
+                shards.append(_merge_group_star(task))
+                pbar.update(1)
+    write_shard_manifest(shards, out_features, out_tfrecord + '.manifest.json')
+
+# %%
+def merge_decoded(tfrecords, out_tfrecord, out_features, gzip, compression_level, write_index):
+    """Merges inputs by decoding and re-serializing every example (with zlib encoding)."""
     # load datasets
     datasets = tuple([load_tfrecord(tfrecord) for tfrecord in tfrecords])
 
     dataset = tf.data.Dataset.zip(datasets)
     dataset = dataset.map(lambda *dicts: merge_dicts(dicts))
     print(dataset.element_spec)
-    
+
     # compress tfrecords to gzip, if flag '--gzip' is set
     tfrecord_options = tf.io.TFRecordOptions(
         compression_type = 'GZIP' if gzip else None,
         compression_level = compression_level if gzip else None,
     )
-    
-    # determine dataset cardinality 
+
+    # determine dataset cardinality
     cardinality = dataset.cardinality()
     cardinality = int(cardinality) if cardinality > 0 else None
 
-    with tf.io.TFRecordWriter(out_tfrecord, tfrecord_options) as tf_writer, tqdm.tqdm(total=cardinality) as pbar:
+    index_writer = IndexWriter(out_tfrecord + '.idx') if write_index else contextlib.nullcontext()
+
+    with tf.io.TFRecordWriter(out_tfrecord, tfrecord_options) as tf_writer, index_writer, tqdm.tqdm(total=cardinality) as pbar:
         features = dataset_to_tensor_features(dataset, encoding='zlib')
 
         # write features spec to json file
@@ -52,8 +226,50 @@ def main(tfrecords, gzip, compression_level, out_tfrecord, out_features):
         # write serialized examples to tfrecord
         for serialized_example in serialized_dataset:
             tf_writer.write(serialized_example)
+            if write_index:
+                index_writer.add_proto(serialized_example)
             pbar.update(1)
 
+# %%
+@click.command()
+@click.argument('tfrecords', nargs=-1)
+@click.option('--gzip', is_flag=True, default=False)
+@click.option('--compression-level', type=int, default=None, help='Compression level of --gzip or --block-compression.')
+@click.option('--block-compression', type=click.Choice(['zlib', 'zstd']), default=None, help='Compress blocks of records independently (random access via the index), instead of --gzip.')
+@click.option('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Uncompressed size (in bytes) of the blocks of --block-compression.')
+@click.option('-t', '--out-tfrecord', required=True, type=str)
+@click.option('-f', '--out-features', type=str, default=None)
+@click.option('--index/--no-index', 'write_index', default=True, help='Write the record index (<tfrecord>.idx) while merging. Ignored with --gzip.')
+@click.option('--key', type=str, default=None, help='Scalar feature (flattened name, e.g. inputs/name) whose values must be equal in all inputs, checked for every record.')
+@click.option('--workers', type=int, default=1, help='Number of worker processes for sharded inputs, each merging one group of shards at a time.')
+@click.option('--decode', is_flag=True, default=False, help='Decode and re-serialize every example with zlib encoding, as merge did before proto-level merging became the default (which keeps the encoding of every feature, i.e. writes different bytes). Required for gzip-compressed inputs.')
+def main(tfrecords, gzip, compression_level, block_compression, block_size, out_tfrecord, out_features, write_index, key, workers, decode):
+    """
+    Merges the features of aligned TFRecord files (i.e. with the same rows in the same order), features of later
+    inputs replace top-level features of the same name.
+
+    By default, the feature maps of the serialized examples are merged without decoding any tensor, i.e. every
+    feature keeps its encoding. Inputs may be sharded (i.e. the output of `bioio serialize --num-shards`, given by
+    the path of its manifest without '.manifest.json'), the output is then sharded the same way.
+    """
+
+    if len(tfrecords) == 0:
+        raise click.UsageError('Expected at least one TFRecord file.')
+    if decode and key is not None:
+        raise click.UsageError('--key is not supported with --decode.')
+    if gzip and block_compression is not None:
+        raise click.UsageError('--gzip and --block-compression are mutually exclusive.')
+    if decode and block_compression is not None:
+        raise click.UsageError('--block-compression is not supported with --decode.')
+
+    # record offsets are only meaningful for uncompressed tfrecords
+    write_index = write_index and not gzip
+
+    if decode:
+        merge_decoded(tfrecords, out_tfrecord, out_features, gzip, compression_level, write_index)
+    else:
+        merge_protos(tfrecords, out_tfrecord, out_features, key, gzip, compression_level, write_index, workers, block_compression, block_size)
+
 # %%
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
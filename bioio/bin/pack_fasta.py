@@ -0,0 +1,28 @@
+# %%
+import click
+import tqdm
+import pysam
+
+from bioio.dataspec.transforms.packed_fasta import pack_fasta, PackedGenome
+
+# %%
+@click.command()
+@click.argument('fasta')
+@click.option('-o', '--out', type=str, default=None, help='Output file, defaults to <fasta>.packed')
+@click.option('--bits', type=click.Choice(['2', '8']), default='2', help='Bits per base, 2 (plus a 1-bit N-mask) or 8.')
+def main(fasta, out, bits):
+    if out is None:
+        out = fasta + '.packed'
+
+    with pysam.FastaFile(fasta) as f:
+        total = sum(f.lengths)
+    with tqdm.tqdm(total=total, unit='bp', unit_scale=True) as pbar:
+        pack_fasta(fasta, out, bits=int(bits), pbar=pbar)
+
+    # PackedFasta(in_memory=True) copies the (loaded chromosomes of the) genome into the memory of every process
+    nbytes = PackedGenome(out).nbytes
+    print(f'Wrote {out}, PackedFasta(in_memory=True) holds {nbytes / 2**20:.1f} MB in memory per process (less with chroms=[...]).')
+
+# %%
+if __name__ == '__main__':
+    main()
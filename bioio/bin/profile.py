@@ -0,0 +1,46 @@
+# %%
+import os
+import json
+
+import click
+
+from bioio.dataspec.loader import load_biospec_graph
+from bioio.dataspec.profile import profile_graph
+
+# %%
+def print_profile(profile):
+    print(f"{'node':<32}{'stage':>6}{'ex/s':>12}{'wall (s)':>10}{'share':>8}{'py (s)':>10}{'graph (s)':>11}{'peak (MB)':>11}")
+    rows = [(f"{node['key']}", node['stage'], node) for node in profile['nodes']]
+    rows += [(name, '', profile[name]) for name in ('pipeline', 'serialize') if name in profile]
+    for name, stage, m in rows:
+        share = f"{m['share']:.0%}" if m.get('share') is not None else ''
+        examples_per_s = f"{m['examples_per_s']:.0f}" if m['examples_per_s'] is not None else ''
+        print(f"{name:<32}{stage:>6}{examples_per_s:>12}{m['wall_s']:>10.3f}{share:>8}{m['py_function_s']:>10.3f}{m['graph_s']:>11.3f}{m['peak_rss_mb']:>11.0f}")
+
+# %%
+@click.command()
+@click.argument('biospec')
+@click.option('-n', '--num-examples', type=int, default=1000, help='Number of source rows to profile.')
+@click.option('-o', '--out', type=str, default=None, help='Write the profile as JSON to this file (e.g. for biospec2dot --profile).')
+@click.option('-d', '--directory', type=str, default=None)
+@click.option('--encoding', type=str, default='bytes')
+@click.option('--serialize/--no-serialize', default=True, help='Also profile the serialization of the outputs.')
+def main(biospec, num_examples, out, directory, encoding, serialize):
+    if directory is not None:
+        # change working directory (all relative paths in biospec.yml will be relative to this directory)
+        if not os.path.isdir(directory):
+            raise ValueError(f"'{directory}' is not a directory.")
+        os.chdir(directory)
+
+    graph = load_biospec_graph(biospec)
+    profile = profile_graph(graph, num_examples=num_examples, serialize=serialize, encoding=encoding)
+    profile['biospec'] = biospec
+
+    print_profile(profile)
+    if out is not None:
+        with open(out, 'w') as f:
+            print(json.dumps(profile, indent=2), file=f)
+
+# %%
+if __name__ == '__main__':
+    main()
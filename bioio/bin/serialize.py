@@ -1,31 +1,251 @@
 
 # %%
 import os
+import json
+import contextlib
+import multiprocessing
 
 import click
 import tqdm
+import numpy as np
 import tensorflow as tf
 
 from bioio import load_biospec
-from bioio.tf.utils import dataset_to_tensor_features, features_to_json_file, serialize_dataset
+from bioio.dataspec.loader import load_biospec_graph
+from bioio.tf.utils import dataset_to_tensor_features, features_to_json, features_to_json_file, features_from_json_file, serialize_dataset
+from bioio.tf.index import IndexWriter, index_tfrecord, record_length_fn, length_columns, length_values
+from bioio.tf.writer import TFRecordAppendWriter, iter_records
+from bioio.tf.blocks import BLOCK_INDEX_COLUMNS, DEFAULT_BLOCK_SIZE, BlockCompression, BlockTFRecordWriter
+from bioio.tf.example import ExampleDecoder, parse_example
+from bioio.bin.tfutils.verify import verify_tfrecord
+
+# %%
+def shard_filepath(out_tfrecord, index, num_shards):
+    return f'{out_tfrecord}-{index:05d}-of-{num_shards:05d}'
+
+# %%
+def checkpoint_filepath(out_tfrecord):
+    return out_tfrecord + '.checkpoint.json'
+
+# %%
+def write_checkpoint(out_tfrecord, num_records, shard=None, complete=False):
+    """Writes the checkpoint of a (partially) written TFRecord file, i.e. the number of records and bytes written so far."""
+    checkpoint = {
+        'path': os.path.basename(out_tfrecord),
+        'shard': shard,
+        'num_records': num_records,
+        'num_bytes': os.path.getsize(out_tfrecord),
+        'complete': complete,
+    }
+    tmp = checkpoint_filepath(out_tfrecord) + '.tmp'
+    with open(tmp, 'w') as f:
+        print(json.dumps(checkpoint, indent=2), file=f)
+    os.replace(tmp, checkpoint_filepath(out_tfrecord))
+
+# %%
+def read_checkpoint(out_tfrecord):
+    if not os.path.exists(checkpoint_filepath(out_tfrecord)):
+        return None
+    with open(checkpoint_filepath(out_tfrecord)) as f:
+        return json.load(f)
+
+# %%
+def recover_tfrecord(out_tfrecord):
+    """
+    Truncates a (partially written) TFRecord file after its last valid record and returns its number of records. 
+    Records before the checkpoint (if any) are not checked again.
+    """
+
+    checkpoint = read_checkpoint(out_tfrecord)
+    num_records, offset = (checkpoint['num_records'], checkpoint['num_bytes']) if checkpoint is not None else (0, 0)
+    if offset > os.path.getsize(out_tfrecord):
+        raise ValueError(f'{out_tfrecord} is shorter than its checkpoint, i.e. it was modified after the checkpoint was written.')
+
+    result = verify_tfrecord(out_tfrecord, offset=offset)
+    if result['error'] is not None:
+        print(f"Truncating {out_tfrecord} at offset {result['error']['offset']} ({result['error']['reason']}).")
+        with open(out_tfrecord, 'r+b') as f:
+            f.truncate(result['error']['offset'])
+    return num_records + result['num_records']
+
+# %%
+def open_index_for_append(out_index, out_tfrecord, num_records, length_fn=None):
+    """Opens the index of the first num_records records of a TFRecord file for appending, rebuilds it if it is missing or does not match."""
+    columns = length_columns(length_fn)
+    if os.path.exists(out_index):
+        try:
+            return IndexWriter(out_index, columns=columns, append=True, num_records=num_records)
+        except ValueError:
+            pass
+    index_tfrecord(out_tfrecord, out_index, length_fn=length_fn)
+    return IndexWriter(out_index, columns=columns, append=True, num_records=num_records)
+
+# %%
+def read_keys(tfrecord, features_file, key):
+    """Returns the values of a scalar feature (flattened name, e.g. 'inputs/name') of all records of a TFRecord file."""
+    decoders = ExampleDecoder.from_json_file(features_file).decoders
+    decoder = decoders.get(tuple(key.split('/')), None)
+    if decoder is None:
+        raise click.UsageError(f"Unknown key '{key}', expected one of {['/'.join(path) for path in decoders]}.")
+    if decoder.shape != ():
+        raise click.UsageError(f"Key '{key}' is not a scalar.")
+    return [decoder(parse_example(proto, keys=set(decoder.keys))) for proto in iter_records(tfrecord)]
+
+# %%
+def not_in(values):
+    """Row filter predicate (see BiospecGraph.to_dataset), keeps rows whose (scalar string or integer) value is not in values."""
+    values = np.asarray(values)
+    if values.dtype.kind not in 'SOiu':
+        raise click.UsageError(f'Key must be a string or an integer, but got {values.dtype}.')
+    dtype = tf.string if values.dtype.kind in 'SO' else tf.int64
+    table = tf.lookup.StaticHashTable(tf.lookup.KeyValueTensorInitializer(tf.constant(values, dtype=dtype), tf.ones(len(values), dtype=tf.int64)), default_value=0)
+    return lambda value: table.lookup(value if dtype == tf.string else tf.cast(value, dtype)) == 0
+
+# %%
+def write_tfrecord(dataset, features, out_tfrecord, tfrecord_options, out_index=None, pbar=None, checkpoint_every=None, shard=None, num_existing=0, length_fn=None):
+    """
+    Serializes a dataset to a TFRecord file (and optionally its index) and returns the number of records in the file.
+
+    Args:
+        tfrecord_options (tf.io.TFRecordOptions or BlockCompression): Compression of the file, see `get_tfrecord_options`
+        checkpoint_every (int): Write a checkpoint (see `write_checkpoint`) every that many records, requires an uncompressed file
+        shard (list): Optional [index, num_shards] of the file, stored in checkpoints
+        num_existing (int): Append to the first num_existing records of an existing (uncompressed) file and its index
+        length_fn (callable): Optional function of a serialized record that returns its length, stored in the index (see `record_length_fn`)
+    """
+
+    n = num_existing
+    block_compression = isinstance(tfrecord_options, BlockCompression)
+    if block_compression:
+        # the index stores the block of each record, for random access
+        tf_writer = BlockTFRecordWriter(out_tfrecord, tfrecord_options)
+        index_writer = IndexWriter(out_index, columns=BLOCK_INDEX_COLUMNS + length_columns(length_fn)) if out_index is not None else contextlib.nullcontext()
+    elif num_existing > 0:
+        tf_writer = TFRecordAppendWriter(out_tfrecord)
+        index_writer = open_index_for_append(out_index, out_tfrecord, num_existing, length_fn) if out_index is not None else contextlib.nullcontext()
+    else:
+        tf_writer = tf.io.TFRecordWriter(out_tfrecord, tfrecord_options)
+        index_writer = IndexWriter(out_index, columns=length_columns(length_fn)) if out_index is not None else contextlib.nullcontext()
+        # a checkpoint of a previous run does not refer to this file anymore
+        if os.path.exists(checkpoint_filepath(out_tfrecord)):
+            os.remove(checkpoint_filepath(out_tfrecord))
+
+    with tf_writer, index_writer:
+        # use features to serialize examples to binary string
+        serialized_dataset = serialize_dataset(dataset, features)
+
+        # write serialized examples to tfrecord
+        for serialized_example in serialized_dataset:
+            position = tf_writer.position if block_compression else {}
+            tf_writer.write(serialized_example)
+            if out_index is not None:
+                index_writer.add_proto(serialized_example, **position, **length_values(serialized_example, length_fn))
+            n += 1
+            if pbar is not None:
+                pbar.update(1)
+
+            if checkpoint_every and (n - num_existing) % checkpoint_every == 0:
+                tf_writer.flush()
+                if out_index is not None:
+                    index_writer.flush()
+                write_checkpoint(out_tfrecord, n, shard=shard)
+
+    if checkpoint_every:
+        write_checkpoint(out_tfrecord, n, shard=shard, complete=True)
+    return n
+
+# %%
+def get_tfrecord_options(gzip=False, gzip_compression_level=None, block_compression=None, block_size=DEFAULT_BLOCK_SIZE, block_compression_level=None):
+    """Options of the TFRecord writer, i.e. tf.io.TFRecordOptions, or BlockCompression for block-compressed files (see `bioio.tf.blocks`)."""
+    if block_compression is not None:
+        return BlockCompression(block_compression, block_size=block_size, level=block_compression_level)
+    return tf.io.TFRecordOptions(
+        compression_type = 'GZIP' if gzip else None,
+        compression_level = gzip_compression_level if gzip else None,
+    )
+
+# %%
+def write_shard(biospec, features_file, out_tfrecord, index, num_shards, gzip, gzip_compression_level, write_index, checkpoint_every=None, resume=False, 
+                block_compression=None, block_size=DEFAULT_BLOCK_SIZE, block_compression_level=None, length_key=None):
+    """Builds the biospec graph for a single shard of the source rows and writes it to its own TFRecord file."""
+    shard_tfrecord = shard_filepath(out_tfrecord, index, num_shards)
+
+    num_existing = 0
+    if resume and os.path.exists(shard_tfrecord):
+        checkpoint = read_checkpoint(shard_tfrecord)
+        if checkpoint is not None and checkpoint['complete']:
+            return {'path': os.path.basename(shard_tfrecord), 'num_records': checkpoint['num_records']}
+        num_existing = recover_tfrecord(shard_tfrecord)
+
+    # rows of the shard that are already written are skipped before any transform is applied
+    dataset = load_biospec(biospec, shard=(num_shards, index), skip=num_existing)
+    features = features_from_json_file(features_file)
+    length_fn = record_length_fn(features_to_json(features), length_key) if length_key is not None else None
+
+    tfrecord_options = get_tfrecord_options(gzip, gzip_compression_level, block_compression, block_size, block_compression_level)
+
+    n = write_tfrecord(dataset, features, shard_tfrecord, tfrecord_options, out_index=(shard_tfrecord + '.idx' if write_index else None), 
+        checkpoint_every=checkpoint_every, shard=[index, num_shards], num_existing=num_existing, length_fn=length_fn)
+    return {'path': os.path.basename(shard_tfrecord), 'num_records': n}
+
+# %%
+def _write_shard_star(args):
+    return write_shard(*args)
+
+# %%
+def write_shard_manifest(shards, out_features, filepath):
+    manifest = {
+        'num_shards': len(shards),
+        'num_records': sum(shard['num_records'] for shard in shards),
+        'features': os.path.basename(out_features),
+        'shards': shards,
+    }
+    with open(filepath, 'w') as f:
+        print(json.dumps(manifest, indent=2), file=f)
 
 # %%
 @click.command()
 @click.argument('biospec')
 @click.option('--gzip', is_flag=True, default=False)
 @click.option('--gzip-compression-level', type=int, default=None)
+@click.option('--block-compression', type=click.Choice(['zlib', 'zstd']), default=None, help='Compress blocks of records independently (random access via the index), instead of --gzip.')
+@click.option('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Uncompressed size (in bytes) of the blocks of --block-compression.')
+@click.option('--block-compression-level', type=int, default=None, help='Compression level of --block-compression, defaults to the codec default.')
 @click.option('--encoding', type=str, default='bytes')
 @click.option('-d', '--directory', type=str, default=None)
 @click.option('-t', '--out-tfrecord', required=True, type=str)
 @click.option('-f', '--out-features', type=str, default=None)
 @click.option('--just-write-features', is_flag=True, default=False, help='Just write features and exit.')
-def main(biospec, gzip, gzip_compression_level, encoding, out_tfrecord, out_features, directory, just_write_features):
+@click.option('--num-shards', type=int, default=1, help='Split the source rows into this many output shards.')
+@click.option('--workers', type=int, default=1, help='Number of worker processes, each writing one shard at a time.')
+@click.option('--index/--no-index', 'write_index', default=True, help='Write the record index (<tfrecord>.idx) while serializing. Ignored with --gzip.')
+@click.option('--checkpoint-every', type=int, default=10000, help='Write a checkpoint (<tfrecord>.checkpoint.json) every this many records, 0 disables checkpoints. Removed once a single file is complete. Ignored with --gzip and --block-compression.')
+@click.option('--resume', is_flag=True, default=False, help='Continue an interrupted run from its checkpoint(s), partially written records are truncated.')
+@click.option('--append', is_flag=True, default=False, help='Only serialize source rows whose --key is not in the TFRecord file yet and append them to the file and its index.')
+@click.option('--key', type=str, default=None, help='Output that identifies source rows for --append (flattened name, e.g. inputs/name), e.g. of a BedFormatName transform.')
+@click.option('--length-key', type=str, default=None, help='Variable-length output (flattened name, e.g. inputs/sequence) whose length is stored in the index, e.g. for length-bucketed batching. Ignored with --gzip.')
+def main(biospec, gzip, gzip_compression_level, block_compression, block_size, block_compression_level, encoding, out_tfrecord, out_features, directory, just_write_features, num_shards, workers, write_index, checkpoint_every, resume, append, key, length_key):
+    if resume and append:
+        raise click.UsageError('--resume and --append are mutually exclusive.')
+    if gzip and block_compression is not None:
+        raise click.UsageError('--gzip and --block-compression are mutually exclusive.')
+    if (gzip or block_compression is not None) and (resume or append):
+        raise click.UsageError('--resume and --append require uncompressed TFRecords (i.e. no --gzip or --block-compression).')
+    if append and (key is None or num_shards > 1):
+        raise click.UsageError('--append requires --key and a single output file (--num-shards 1).')
+    if key is not None and not append:
+        raise click.UsageError('--key is only used with --append.')
+
     if directory is not None:
         # change working directory (all relative paths in biospec.yml will be relative to this directory)
         if not os.path.isdir(directory):
             raise ValueError(f"'{directory}' is not a directory.")
         os.chdir(directory)
 
+    # records written before are identified by their position, i.e. rows must be written in the order of the source rows
+    if (resume or append) and not load_biospec_graph(biospec).deterministic:
+        raise click.UsageError('--resume and --append require the rows in source order, i.e. no node of the biospec may be mapped with deterministic: false.')
+
     dataset = load_biospec(biospec)
     print(dataset.element_spec)
 
@@ -34,31 +254,89 @@ def main(biospec, gzip, gzip_compression_level, encoding, out_tfrecord, out_feat
     # write features spec to json file
     if out_features is None:
         out_features = out_tfrecord + '.features.json'
+    if (resume or append) and os.path.exists(out_features):
+        # records written before must have the same features
+        with open(out_features) as f:
+            if json.load(f) != json.loads(json.dumps(features_to_json(features))):
+                raise click.UsageError(f'Features of the biospec do not match {out_features}.')
     features_to_json_file(features, out_features)
 
     if just_write_features:
         # just write features and exit
         return
-    
-    # compress tfrecords to gzip, if flag '--gzip' is set
-    tfrecord_options = tf.io.TFRecordOptions(
-        compression_type = 'GZIP' if gzip else None,
-        compression_level = gzip_compression_level if gzip else None,
-    )
-    
-    # determine dataset cardinality 
+
+    length_fn = None
+    if length_key is not None:
+        try:
+            length_fn = record_length_fn(features_to_json(features), length_key)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+    # record offsets are only meaningful for uncompressed and block-compressed tfrecords, checkpoints only for uncompressed tfrecords
+    write_index = write_index and not gzip
+    checkpoint_every = None if (gzip or block_compression is not None) else checkpoint_every
+
+    if num_shards > 1:
+        # shard i holds source rows i, i + num_shards, ..., such that the output is deterministic for a given number of shards
+        tasks = [(biospec, out_features, out_tfrecord, i, num_shards, gzip, gzip_compression_level, write_index, checkpoint_every, resume, 
+            block_compression, block_size, block_compression_level, length_key) for i in range(num_shards)]
+        with tqdm.tqdm(total=num_shards, unit='shard') as pbar:
+            if workers > 1:
+                # each worker process builds its own biospec graph (tensorflow is not fork-safe, hence 'spawn')
+                with multiprocessing.get_context('spawn').Pool(min(workers, num_shards)) as pool:
+                    shards = []
+                    for shard in pool.imap(_write_shard_star, tasks):
+                        shards.append(shard)
+                        pbar.update(1)
+            else:
+                shards = []
+                for task in tasks:
+                    shards.append(write_shard(*task))
+                    pbar.update(1)
+
+        write_shard_manifest(shards, out_features, out_tfrecord + '.manifest.json')
+
+        # all shards are complete, i.e. their checkpoints are not needed anymore
+        for i in range(num_shards):
+            if os.path.exists(checkpoint_filepath(shard_filepath(out_tfrecord, i, num_shards))):
+                os.remove(checkpoint_filepath(shard_filepath(out_tfrecord, i, num_shards)))
+        return
+
+    # compress tfrecords to gzip, if flag '--gzip' is set, or block-wise, if '--block-compression' is set
+    tfrecord_options = get_tfrecord_options(gzip, gzip_compression_level, block_compression, block_size, block_compression_level)
+
+    # determine dataset cardinality
     cardinality = dataset.cardinality()
     cardinality = int(cardinality) if cardinality > 0 else None
 
-    with tf.io.TFRecordWriter(out_tfrecord, tfrecord_options) as tf_writer, tqdm.tqdm(total=cardinality) as pbar:
-        # use features to serialize examples to binary string
-        serialized_dataset = serialize_dataset(dataset, features)
+    num_existing = 0
+    if (resume or append) and os.path.exists(out_tfrecord):
+        checkpoint = read_checkpoint(out_tfrecord)
+        if resume and checkpoint is not None and checkpoint['complete']:
+            print(f'{out_tfrecord} is already complete.')
+            return
+        num_existing = recover_tfrecord(out_tfrecord)
 
-        # write serialized examples to tfrecord
-        for serialized_example in serialized_dataset:
-            tf_writer.write(serialized_example)
-            pbar.update(1)
+    if append and num_existing > 0:
+        # rows are identified by the key output, which is computed first (i.e. other outputs only for new rows)
+        existing_keys = read_keys(out_tfrecord, out_features, key)
+        dataset = load_biospec(biospec, row_filter=(key, not_in(existing_keys)))
+        cardinality = None
+    elif resume and num_existing > 0:
+        dataset = load_biospec(biospec, skip=num_existing)
+        cardinality = (cardinality - num_existing) if cardinality is not None else None
+    if num_existing > 0:
+        print(f'Continuing after {num_existing} records of {out_tfrecord}.')
+
+    with tqdm.tqdm(total=cardinality) as pbar:
+        write_tfrecord(dataset, features, out_tfrecord, tfrecord_options, out_index=(out_tfrecord + '.idx' if write_index else None), pbar=pbar, 
+            checkpoint_every=checkpoint_every, num_existing=num_existing, length_fn=length_fn)
+
+    # the file is complete, i.e. its checkpoint is not needed anymore (unlike the checkpoints of shards, which mark 
+    # complete shards for --resume)
+    if os.path.exists(checkpoint_filepath(out_tfrecord)):
+        os.remove(checkpoint_filepath(out_tfrecord))
 
 # %%
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,9 @@
 # %%
+import json
+
 import click
 
-from bioio.tf.index import index_tfrecord
-from bioio.tf.utils import features_from_json_file
+from bioio.tf.index import index_tfrecord, record_length_fn
 
 def deserialize_and_get_nested_values(proto, keys, features):
     x = features.deserialize_example(proto)
@@ -15,16 +16,30 @@ def deserialize_and_get_nested_values(proto, keys, features):
 @click.argument('tfrecord')
 @click.option('-i', '--index', default=None)
 @click.option('-k', '--key', default=None)
-def main(tfrecord, index, key):
+@click.option('--tsv', is_flag=True, default=False, help='Write the legacy (tab-separated) index format.')
+@click.option('--validate', is_flag=True, default=False, help='Check the CRCs of every record.')
+@click.option('--length-key', type=str, default=None, help='Variable-length feature (flattened name, e.g. inputs/sequence) whose length is stored in the index, e.g. for length-bucketed batching.')
+def main(tfrecord, index, key, tsv, validate, length_key):
     if index is None:
         index = tfrecord + '.idx'
     
     proto_fn = None
     if key is not None:
+        # deserializing keys requires tensorflow, i.e. it is only imported with --key
+        from bioio.tf.utils import features_from_json_file
         features = features_from_json_file(tfrecord + '.features.json')
         proto_fn = lambda proto: deserialize_and_get_nested_values(proto, key, features)
     
-    index_tfrecord(tfrecord, index, pbar=True, proto_fn=proto_fn)
+    length_fn = None
+    if length_key is not None:
+        # lengths are read without tensorflow (see `record_length_fn`)
+        with open(tfrecord + '.features.json') as f:
+            length_fn = record_length_fn(json.load(f), length_key)
+
+    try:
+        index_tfrecord(tfrecord, index, pbar=True, proto_fn=proto_fn, binary=(not tsv), validate=validate, length_fn=length_fn)
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 # %%
 if __name__ == '__main__':
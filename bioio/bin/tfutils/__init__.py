@@ -1,16 +1,16 @@
 # %%
 import click
 
-from . import count
+from bioio.bin import LazyGroup
 
 # %%
-@click.group()
+@click.group(cls=LazyGroup, lazy_commands={
+    'count': 'bioio.bin.tfutils.count:main',
+    'verify': 'bioio.bin.tfutils.verify:main',
+})
 def main():
     pass
 
-# %%
-main.add_command(count.main, name='count')
-
 # %%
 if __name__ == '__main__':
     main()
@@ -1,28 +1,50 @@
 # %%
+import sys
 import struct
 
 import click
 
+from bioio.tf.crc import check_record
+
 # %%
-def count_records(tfrecord):
+def count_records(tfrecord, validate=False):
+    from bioio.tf.blocks import is_block_tfrecord, open_block_tfrecord
+    if is_block_tfrecord(tfrecord):
+        reader = open_block_tfrecord(tfrecord, cache_size=0)
+        if reader.num_records is not None and not validate:
+            return reader.num_records
+        return sum(1 for _ in reader.iter_records(validate))
+
     count = 0
     with open(tfrecord, 'rb') as tfr:
         while True:
+            offset = tfr.tell()
             try:
                 # byte length
                 byte_len = tfr.read(8)
                 if len(byte_len) == 0:
                     break
+                if validate and len(byte_len) < 8:
+                    raise ValueError(f'Truncated record at offset {offset}.')
 
                 # crc length
                 proto_len = struct.unpack('q', byte_len)[0]
 
-                # crc length + proto + crc
-                _ = tfr.read(4 + proto_len + 4)
+                if validate:
+                    byte_len_crc = tfr.read(4)
+                    proto = tfr.read(proto_len)
+                    proto_crc = tfr.read(4)
+                    check_record(byte_len + byte_len_crc, proto, proto_crc, offset)
+                else:
+                    # crc length + proto + crc
+                    _ = tfr.read(4 + proto_len + 4)
 
                 count +=1
+            except ValueError:
+                # corrupted record
+                raise
             except Exception:
-                print('Not a valid TFRecord file.')
+                print('Not a valid TFRecord file.', file=sys.stderr)
                 break
         
     return count
@@ -30,9 +52,13 @@ def count_records(tfrecord):
 # %%
 @click.command()
 @click.argument('tfrecord')
-def main(tfrecord):
-    print(count_records(tfrecord))
+@click.option('--validate', is_flag=True, default=False, help='Check the CRCs of every record.')
+def main(tfrecord, validate):
+    try:
+        print(count_records(tfrecord, validate=validate))
+    except ValueError as e:
+        raise click.ClickException(str(e))
 
 # %%
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,127 @@
+# %%
+import os
+import sys
+import mmap
+import struct
+import multiprocessing
+
+import click
+import numpy as np
+
+from bioio.tf.crc import masked_crc32c, masked_crc32c_batch
+
+# %%
+def _verify_buffer(buffer, result, batch_size=1024, offset=0, base_offset=0):
+    # checks the records of a buffer in batches, reported offsets are relative to base_offset
+    size = len(buffer)
+    while offset < size and result['error'] is None:
+        # walk the framing of the next batch of records
+        offsets, lengths, error = [], [], None
+        while offset < size and len(offsets) < batch_size:
+            if offset + 8 + 4 > size:
+                error = {'offset': base_offset + offset, 'reason': 'truncated record'}
+                break
+            proto_len = struct.unpack_from('<Q', buffer, offset)[0]
+            if offset + 8 + 4 + proto_len + 4 > size:
+                # the length itself may be corrupted
+                length_crc = struct.unpack_from('<I', buffer, offset + 8)[0]
+                reason = 'length CRC mismatch' if masked_crc32c(buffer[offset:offset + 8]) != length_crc else 'truncated record'
+                error = {'offset': base_offset + offset, 'reason': reason}
+                break
+            offsets.append(offset)
+            lengths.append(proto_len)
+            offset += 8 + 4 + proto_len + 4
+
+        # check the CRCs of the batch
+        offsets, lengths = np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64)
+        length_crcs = np.array([struct.unpack_from('<I', buffer, o + 8)[0] for o in offsets], dtype=np.uint32)
+        proto_crcs = np.array([struct.unpack_from('<I', buffer, o + 8 + 4 + n)[0] for o, n in zip(offsets, lengths)], dtype=np.uint32)
+        length_ok = masked_crc32c_batch([buffer[o:o + 8] for o in offsets]) == length_crcs
+        proto_ok = masked_crc32c_batch([buffer[o + 8 + 4:o + 8 + 4 + n] for o, n in zip(offsets, lengths)]) == proto_crcs
+
+        invalid = np.nonzero(~(length_ok & proto_ok))[0]
+        if len(invalid) > 0:
+            i = invalid[0]
+            result['num_records'] += int(i)
+            result['error'] = {'offset': base_offset + int(offsets[i]), 'reason': 'length CRC mismatch' if not length_ok[i] else 'data CRC mismatch'}
+        else:
+            result['num_records'] += len(offsets)
+            result['error'] = error
+    return result
+
+# %%
+def verify_tfrecord(tfrecord, batch_size=1024, offset=0):
+    """
+    Checks the framing and CRCs of all records of an (uncompressed or block-compressed) TFRecord file. 
+
+    The file is memory-mapped and the CRCs of each batch of records are computed at once. 
+
+    Args:
+        tfrecord (str): Path to a TFRecord file
+        batch_size (int): Number of records whose CRCs are computed at once
+        offset (int): Offset of the first record to check (e.g. of a checkpoint), for uncompressed files
+
+    Returns:
+        dict: 'path', 'num_records' (number of valid records before the first error) and 'error' (None, or a dict with 'offset' and 'reason' of the first invalid record)
+    """
+
+    result = {'path': tfrecord, 'num_records': 0, 'error': None}
+    with open(tfrecord, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return result
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        from bioio.tf.blocks import BLOCK_MAGIC
+        if buffer[:len(BLOCK_MAGIC)] == BLOCK_MAGIC:
+            return _verify_blocks(buffer, result, batch_size)
+        return _verify_buffer(buffer, result, batch_size, offset)
+    finally:
+        buffer.close()
+
+# %%
+def _verify_blocks(buffer, result, batch_size):
+    # records of every block are checked after decompression, offsets are offsets in the uncompressed records
+    from bioio.tf.blocks import BlockTFRecordReader
+
+    reader = BlockTFRecordReader(lambda offset, size: buffer[offset:offset + size], len(buffer), cache_size=0)
+    for i, start in enumerate(reader.block_starts):
+        try:
+            block = reader.decompress_block(i)
+        except Exception:
+            result['error'] = {'offset': int(start), 'reason': 'corrupted block'}
+            break
+        _verify_buffer(block, result, batch_size, base_offset=int(start))
+        if result['error'] is not None:
+            break
+    return result
+
+# %%
+def _verify_tfrecord_star(args):
+    return verify_tfrecord(*args)
+
+# %%
+@click.command()
+@click.argument('tfrecords', nargs=-1, required=True)
+@click.option('--workers', type=int, default=1, help='Number of worker processes, each verifying one file at a time.')
+@click.option('--batch-size', type=int, default=1024, help='Number of records whose CRCs are computed at once.')
+def main(tfrecords, workers, batch_size):
+    tasks = [(tfrecord, batch_size) for tfrecord in tfrecords]
+    if workers > 1 and len(tasks) > 1:
+        with multiprocessing.get_context('spawn').Pool(min(workers, len(tasks))) as pool:
+            results = list(pool.imap(_verify_tfrecord_star, tasks))
+    else:
+        results = list(map(_verify_tfrecord_star, tasks))
+
+    for result in results:
+        if result['error'] is None:
+            print(f"{result['path']}\tOK\t{result['num_records']} records")
+        else:
+            print(f"{result['path']}\tFAILED\t{result['error']['reason']} at offset {result['error']['offset']} (after {result['num_records']} valid records)")
+
+    if any(result['error'] is not None for result in results):
+        sys.exit(1)
+
+# %%
+if __name__ == '__main__':
+    main()
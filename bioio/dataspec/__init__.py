@@ -1,2 +1,14 @@
-from . import sources, transforms
-from .loader import load_biospec
\ No newline at end of file
+# %%
+from bioio._lazy import lazy_getattr
+
+# %%
+# Disable absl INFO and WARNING log messages (like bioio.tf, since dataspec imports tensorflow without bioio.tf)
+from absl import logging as absl_logging
+absl_logging.set_verbosity(absl_logging.ERROR)
+
+# %%
+# submodules are imported on first access, e.g. `bioio cache ls` only needs bioio.dataspec.cache (without tensorflow)
+_SUBMODULES = ('sources', 'transforms', 'loader', 'graph', 'cache', 'profile')
+_ATTRIBUTES = {'load_biospec': 'loader'}
+
+__getattr__ = lazy_getattr(__name__, _SUBMODULES, _ATTRIBUTES)
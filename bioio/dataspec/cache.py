@@ -0,0 +1,186 @@
+# %%
+"""
+Content-addressed cache of biospec node outputs.
+
+A node with a `cache` key is materialised once (with tf.data.Dataset.save) under a key that hashes the node's
+object path and args, the size and mtime of the files referenced by its args and the keys of its upstream nodes.
+Unchanged subgraphs are then read back (with tf.data.Dataset.load) instead of being recomputed. Entries are
+evicted least recently used first, once the cache directory exceeds its maximum size.
+"""
+
+# %%
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from bioio import __version__
+
+# %%
+DEFAULT_CACHE_DIR = os.environ.get('BIOIO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'bioio'))
+DEFAULT_MAX_SIZE = os.environ.get('BIOIO_CACHE_MAX_SIZE', '50G')
+
+_SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+# %%
+def parse_size(size):
+    """Parses a size in bytes, e.g. 1024, '500M' or '10G'."""
+    if size is None or isinstance(size, int):
+        return size
+    value = str(size).strip().upper()
+    value = value[:-1] if value.endswith('B') else value
+    unit = value[-1] if value and value[-1] in _SIZE_UNITS else ''
+    try:
+        return int(float(value[:len(value) - len(unit)]) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f'Invalid size: {size}')
+
+# %%
+def format_size(size):
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            return f'{size:.1f}{unit}' if unit else f'{size}B'
+        size /= 1024
+    return f'{size:.1f}T'
+
+# %%
+def file_stats(args):
+    """Returns [path, size, mtime] of every existing file referenced in (nested) args."""
+    stats = []
+    def visit(value):
+        if isinstance(value, dict):
+            for v in value.values():
+                visit(v)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                visit(v)
+        elif isinstance(value, str) and os.path.isfile(value):
+            stat = os.stat(value)
+            stats.append([os.path.abspath(value), stat.st_size, stat.st_mtime_ns])
+    visit(args)
+    return stats
+
+# %%
+def node_fingerprint(object_path, args, **options):
+    """JSON-serializable description of a biospec node (without its inputs)."""
+    return {'object': object_path, 'args': args, 'files': file_stats(args), **options}
+
+# %%
+def hash_fingerprint(fingerprint, parents=None):
+    """Cache key of a node, given its fingerprint and the (nested structure of) cache keys of its inputs."""
+    # transforms nested in args are described by their own fingerprint
+    default = lambda value: getattr(value, 'biospec_fingerprint', str(value))
+    content = json.dumps({'version': __version__, 'fingerprint': fingerprint, 'parents': parents}, sort_keys=True, default=default)
+    return hashlib.sha256(content.encode('UTF-8')).hexdigest()
+
+# %%
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+# %%
+class NodeCache():
+    """
+    Cache directory of materialised node outputs, with one sub-directory (data and meta.json) per key.
+
+    Args:
+        directory (str): Cache directory, defaults to $BIOIO_CACHE_DIR or ~/.cache/bioio
+        max_size (int or str): Maximum size of the cache (e.g. '10G'), defaults to $BIOIO_CACHE_MAX_SIZE or 50G
+    """
+
+    def __init__(self, directory=None, max_size=None) -> None:
+        self.directory = directory if directory is not None else DEFAULT_CACHE_DIR
+        self.max_size = parse_size(max_size if max_size is not None else DEFAULT_MAX_SIZE)
+
+    @classmethod
+    def from_biospec(cls, value):
+        """Cache of a biospec 'cache' value, i.e. true (default directory), a directory or a mapping of arguments."""
+        if value is None or value is False:
+            return None
+        if value is True:
+            return cls()
+        if isinstance(value, str):
+            return cls(directory=value)
+        if isinstance(value, dict):
+            return cls(**value)
+        raise ValueError(f"Invalid value for 'cache': {value}")
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key):
+        return os.path.isfile(os.path.join(self.path(key), 'meta.json'))
+
+    def _write_meta(self, path, meta):
+        tmp = os.path.join(path, f'meta.json.tmp-{os.getpid()}')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(path, 'meta.json'))
+
+    def meta(self, key):
+        with open(os.path.join(self.path(key), 'meta.json')) as f:
+            return json.load(f)
+
+    def load(self, key):
+        """Loads the dataset of a key and marks it as recently used."""
+        meta = self.meta(key)
+        meta['last_used'] = time.time()
+        self._write_meta(self.path(key), meta)
+        # tensorflow is only imported to load and save entries, e.g. not by `bioio cache ls`
+        import tensorflow as tf
+        return tf.data.Dataset.load(os.path.join(self.path(key), 'data'))
+
+    def save(self, key, dataset, **meta):
+        """Materialises a dataset under a key and evicts least recently used entries if the cache is too large."""
+        import tensorflow as tf
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.path(key) + f'.tmp-{os.getpid()}'
+        # a single shard, such that elements are read back in the same order (i.e. aligned with the source rows)
+        dataset.save(os.path.join(tmp, 'data'), shard_func=lambda *_: tf.constant(0, dtype=tf.int64))
+        now = time.time()
+        self._write_meta(tmp, {'key': key, **meta, 'size': directory_size(tmp), 'created': now, 'last_used': now})
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:
+            # written concurrently by another process
+            shutil.rmtree(tmp)
+        self.prune(keep=[key])
+
+    def entries(self):
+        """Returns the meta data of all entries, most recently used first."""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = [self.meta(key) for key in os.listdir(self.directory) if key in self]
+        return sorted(entries, key=lambda entry: entry['last_used'], reverse=True)
+
+    def remove(self, key):
+        shutil.rmtree(self.path(key))
+
+    def prune(self, max_size=None, keep=()):
+        """
+        Evicts least recently used entries until the cache is not larger than max_size.
+
+        Args:
+            max_size (int or str): Defaults to the maximum size of the cache, 0 removes all entries
+            keep (list): Keys that are never evicted
+
+        Returns:
+            list: Meta data of the removed entries
+        """
+
+        max_size = self.max_size if max_size is None else parse_size(max_size)
+        entries = self.entries()
+        total, removed = sum(entry['size'] for entry in entries), []
+        for entry in reversed(entries):
+            if total <= max_size:
+                break
+            if entry['key'] in keep:
+                continue
+            self.remove(entry['key'])
+            total -= entry['size']
+            removed.append(entry)
+        return removed
@@ -0,0 +1,291 @@
+# %%
+import itertools
+
+import tensorflow as tf
+
+from bioio.tf.utils import dataset_from_iterable
+from bioio.utils import flatten_dict
+from bioio.dataspec.cache import hash_fingerprint
+
+# %%
+class Node():
+    """
+    A node of a biospec graph, i.e. a '!PyIterable' or '!Transform' with an input.
+
+    Args:
+        name (str): Name of the node
+        fingerprint (dict): Description of the node (see `bioio.dataspec.cache.node_fingerprint`), required for caching
+        cache (NodeCache): Optional cache the output of the node is materialised to
+    """
+    _ids = itertools.count()
+
+    def __init__(self, name, fingerprint=None, cache=None) -> None:
+        self.name = name
+        self.key = f'{name}_{next(Node._ids)}'
+        self.fingerprint = fingerprint
+        self.cache = cache
+
+    @property
+    def parents(self):
+        return []
+
+    def _parent_cache_keys(self):
+        return None
+
+    @property
+    def cache_key(self):
+        """Hash of the fingerprints of the node and all its upstream nodes, None if any of them has no fingerprint."""
+        parent_keys = self._parent_cache_keys()
+        if self.fingerprint is None or (parent_keys is not None and None in tf.nest.flatten(parent_keys)):
+            return None
+        return hash_fingerprint(self.fingerprint, parent_keys)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.key})'
+
+# %%
+class SourceNode(Node):
+    def __init__(self, iterable, name, **kwargs) -> None:
+        super(SourceNode, self).__init__(name, **kwargs)
+        self.iterable = iterable
+
+    def to_dataset(self):
+        return dataset_from_iterable(self.iterable)
+
+# %%
+class TransformNode(Node):
+    def __init__(self, input, transform, name, batch_transform=None, batch_size=None, maps=(), num_parallel_calls=None, deterministic=None, prefetch=None, **kwargs) -> None:
+        super(TransformNode, self).__init__(name, **kwargs)
+        self.input = input
+        self.transform = transform
+        self.batch_transform = batch_transform
+        self.batch_size = batch_size
+        self.maps = list(maps)
+        self.num_parallel_calls = num_parallel_calls
+        self.deterministic = deterministic
+        self.prefetch = prefetch
+
+    @property
+    def parents(self):
+        return tf.nest.flatten(self.input)
+
+    def _parent_cache_keys(self):
+        return tf.nest.map_structure(lambda parent: parent.cache_key, self.input)
+
+    @property
+    def thread_safe(self):
+        # the transform and all its maps are safe to be called in parallel
+        return all(getattr(transform, 'thread_safe', False) for transform in [self.transform] + self.maps)
+
+    @property
+    def parallel_calls(self):
+        # thread-safe transforms (e.g. implemented with tensorflow ops only, or with one file handle per thread) are mapped in parallel by default
+        if self.num_parallel_calls is not None:
+            return None if self.num_parallel_calls == 1 else self.num_parallel_calls
+        return tf.data.AUTOTUNE if self.thread_safe else None
+
+    def apply_maps(self, x):
+        for transform in self.maps:
+            x = transform(x)
+        return x
+
+    def __call__(self, x):
+        return self.apply_maps(self.transform(x))
+
+# %%
+class BiospecGraph():
+    """
+    Graph of biospec nodes, compiled to a single tf.data pipeline.
+
+    Instead of mapping every transform over its own copy of the input dataset (which re-iterates the
+    source once per output), all sources are zipped and iterated once. Transforms are grouped into
+    stages by their depth in the graph, and all transforms of a stage (e.g. all transforms of the same
+    source) are fused into a single map over a dict of intermediate results.
+
+    Nodes with a cache are materialised first (unless their cache key is found) and are then read back
+    as additional sources, i.e. their upstream nodes are not computed again.
+    """
+
+    def __init__(self, data) -> None:
+        self.data = data
+        self.outputs = tf.nest.flatten(data)
+        for node in self.outputs:
+            if not isinstance(node, Node):
+                raise TypeError(f'Expected a biospec node (!PyIterable or !Transform with input), but got {type(node)}.')
+
+        self.nodes = self._topological_sort(self.outputs)
+        self.sources = [node for node in self.nodes if isinstance(node, SourceNode)]
+        self.stages = self._stages(self.nodes)
+
+    @staticmethod
+    def _topological_sort(outputs, leaves=()):
+        # leaves (keys of e.g. cached nodes) are treated as sources, i.e. their parents are not visited
+        nodes, visited = [], set()
+        def dfs(node):
+            if node.key in visited:
+                return
+            visited.add(node.key)
+            if node.key not in leaves:
+                for parent in node.parents:
+                    dfs(parent)
+            nodes.append(node)
+        for node in outputs:
+            dfs(node)
+        return nodes
+
+    @staticmethod
+    def _stages(nodes, leaves=()):
+        # depth of a node is the length of the longest path from a source
+        depth = {}
+        for node in nodes:
+            depth[node.key] = 0 if (isinstance(node, SourceNode) or node.key in leaves) else 1 + max(depth[parent.key] for parent in node.parents)
+
+        stages = [[] for _ in range(max(depth.values()))]
+        for node in nodes:
+            if depth[node.key] > 0:
+                stages[depth[node.key] - 1].append(node)
+        return stages
+
+    @staticmethod
+    def _required_keys(outputs, stages):
+        # keys of intermediate results that must be kept after each stage
+        required, keys = [], set(node.key for node in outputs)
+        for stage in reversed(stages):
+            required.append(set(keys))
+            for node in stage:
+                keys.update(parent.key for parent in node.parents)
+        return list(reversed(required))
+
+    def _apply_stage(self, dataset, stage, required_keys):
+        # nodes with the same batch size and map options are fused into a single map
+        groups = {}
+        for node in sorted(stage, key=lambda node: node.batch_size or 0):
+            groups.setdefault((node.batch_size, node.parallel_calls, node.deterministic), []).append(node)
+
+        for (batch_size, num_parallel_calls, deterministic), nodes in groups.items():
+            name = nodes[0].name if len(nodes) == 1 else 'fused'
+            map_options = {'num_parallel_calls': num_parallel_calls, 'deterministic': deterministic}
+
+            if batch_size is None:
+                dataset = dataset.map(lambda state, nodes=nodes: {**state, **{node.key: node(resolve_input(node, state)) for node in nodes}}, name=name, **map_options)
+            else:
+                # ragged_batch, since intermediate results may have a variable shape
+                dataset = dataset.ragged_batch(batch_size)
+                dataset = dataset.map(lambda state, nodes=nodes: {**state, **{node.key: node.batch_transform(resolve_input(node, state)) for node in nodes}}, name=name, **map_options)
+                dataset = dataset.unbatch()
+                # note that this map also restores a TensorSpec for unbatched rows of tf.RaggedTensor
+                dataset = dataset.map(lambda state, nodes=nodes: {**state, **{node.key: node.apply_maps(state[node.key]) for node in nodes}}, **map_options)
+
+            # prefetch depth defaults to AUTOTUNE, 0 disables prefetching
+            buffer_sizes = [tf.data.AUTOTUNE if node.prefetch is None else node.prefetch for node in nodes]
+            buffer_size = tf.data.AUTOTUNE if tf.data.AUTOTUNE in buffer_sizes else max(buffer_sizes)
+            if buffer_size != 0:
+                dataset = dataset.prefetch(buffer_size)
+
+        # drop intermediate results that are not needed anymore
+        dataset = dataset.map(lambda state: {key: value for key, value in state.items() if key in required_keys})
+        return dataset
+
+    def _compile(self, outputs, datasets, shard=None, skip=None, row_filter=None):
+        # dataset of dicts of intermediate results, nodes in datasets (i.e. cached nodes) are read instead of computed
+        filter_nodes = [row_filter[0]] if row_filter is not None else []
+        nodes = self._topological_sort(outputs + filter_nodes, leaves=datasets)
+        stages = self._stages(nodes, leaves=datasets)
+
+        # iterate all sources once
+        sources = {node.key: datasets[node.key] if node.key in datasets else node.to_dataset() for node in nodes if node.key in datasets or isinstance(node, SourceNode)}
+        dataset = tf.data.Dataset.zip(sources, name='zip')
+
+        if shard is not None:
+            # shard the source rows, i.e. before any transform is applied
+            num_shards, index = shard
+            dataset = dataset.shard(num_shards, index)
+
+        if skip:
+            # skip source rows, i.e. without computing any transform for them
+            dataset = dataset.skip(skip)
+
+        if row_filter is not None:
+            # the filter node and its upstream nodes are computed first, such that all other nodes are only computed for the remaining rows
+            filter_node, predicate = row_filter
+            upstream = set(node.key for node in self._topological_sort(filter_nodes, leaves=datasets))
+            for stage in stages:
+                stage = [node for node in stage if node.key in upstream]
+                if stage:
+                    dataset = self._apply_stage(dataset, stage, set(node.key for node in nodes))
+            dataset = dataset.filter(lambda state: predicate(state[filter_node.key]))
+            stages = [[node for node in stage if node.key not in upstream] for stage in stages]
+            stages = [stage for stage in stages if stage]
+
+        for stage, required_keys in zip(stages, self._required_keys(outputs, stages)):
+            dataset = self._apply_stage(dataset, stage, required_keys)
+        return dataset
+
+    def _is_deterministic(self, nodes, leaves=()):
+        # rows are in the order of the source rows, unless a node (or an upstream node) is mapped with deterministic=false
+        return not any(getattr(upstream, 'deterministic', None) is False for upstream in self._topological_sort(nodes, leaves=leaves))
+
+    @property
+    def deterministic(self):
+        """Whether the rows of the dataset are in the order of the source rows, i.e. no node is mapped with deterministic=false."""
+        return self._is_deterministic(self.outputs)
+
+    def _materialize(self):
+        # datasets of cached nodes, materialised in topological order if their cache key is not found
+        hits = set(node.key for node in self.nodes if node.cache is not None and node.cache_key is not None and node.cache_key in node.cache)
+
+        datasets = {}
+        for node in self._topological_sort(self.outputs, leaves=hits):
+            if node.cache is None:
+                continue
+            key = node.cache_key
+            if key is None:
+                raise ValueError(f'Node {node.key} cannot be cached, since it (or an upstream node) has no fingerprint.')
+
+            if node.key not in hits:
+                # cached outputs are zipped with the source rows, i.e. they must be in the same order
+                if not self._is_deterministic([node], leaves=datasets):
+                    raise ValueError(f'Node {node.key} cannot be cached, since it (or an upstream node) is mapped with deterministic=false.')
+                dataset = self._compile([node], datasets).map(lambda state, node=node: state[node.key])
+                node.cache.save(key, dataset, name=node.name, object=node.fingerprint['object'])
+            datasets[node.key] = node.cache.load(key)
+        return datasets
+
+    def output(self, name):
+        """Returns the output node of a flattened key of the biospec data, e.g. 'inputs/name'."""
+        nodes = {node.key: node for node in self.outputs}
+        names = flatten_dict(tf.nest.map_structure(lambda node: node.key, self.data))
+        if name not in names:
+            raise KeyError(f"Unknown output '{name}', expected one of {list(names)}.")
+        return nodes[names[name]]
+
+    def to_dataset(self, shard=None, skip=None, row_filter=None):
+        """
+        Compiles the graph to a tf.data.Dataset. Nodes with a cache are materialised first, if needed.
+
+        Args:
+            shard (tuple): Optional (num_shards, index), only rows index, index + num_shards, ... of the sources are processed
+            skip (int): Optional number of (sharded) source rows to skip
+            row_filter (tuple): Optional (name, predicate), only rows for which predicate returns True for the output 
+                name (see `output`) are kept. The output is computed first, i.e. other outputs only for the kept rows
+        """
+
+        if row_filter is not None:
+            name, predicate = row_filter
+            row_filter = (self.output(name), predicate)
+        dataset = self._compile(self.outputs, self._materialize(), shard=shard, skip=skip, row_filter=row_filter)
+        return self._pack_outputs(dataset)
+
+    def _pack_outputs(self, dataset):
+        # restore the nested structure of the biospec data
+        return dataset.map(lambda state: tf.nest.pack_sequence_as(self.data, [state[node.key] for node in self.outputs]))
+
+    def to_datasets(self, **kwargs):
+        """Returns the nested structure of the biospec data with one dataset per output."""
+        dataset = self.to_dataset(**kwargs)
+        datasets = [dataset.map(lambda x, i=i: tf.nest.flatten(x)[i], name=node.name) for i, node in enumerate(self.outputs)]
+        return tf.nest.pack_sequence_as(self.data, datasets)
+
+# %%
+def resolve_input(node, state):
+    return tf.nest.map_structure(lambda parent: state[parent.key], node.input)
@@ -8,7 +8,8 @@ import yaml
 import tensorflow as tf
 
 # %%
-from bioio.tf.utils import dataset_from_iterable
+from bioio.dataspec.graph import Node, SourceNode, TransformNode, BiospecGraph
+from bioio.dataspec.cache import NodeCache, node_fingerprint
 
 # %%
 # To import modules from the current directory
@@ -22,6 +23,17 @@ def import_object_from_string(import_string):
     module = importlib.import_module(module_name, object_name)
     return module.__getattribute__(object_name)
 
+# %%
+def parse_autotune(value, key, minimum=0):
+    """Parses a non-negative integer or 'auto' (i.e. tf.data.AUTOTUNE) biospec value."""
+    if value is None:
+        return None
+    if isinstance(value, str) and value.lower() in ('auto', 'autotune'):
+        return tf.data.AUTOTUNE
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise ValueError(f"Invalid value for '{key}': {value} (expected an integer >= {minimum} or 'auto')")
+    return value
+
 # %%
 class BiospecLoader(yaml.SafeLoader):
     def __init__(self, *args, **kwargs):
@@ -50,7 +62,8 @@ class BiospecLoader(yaml.SafeLoader):
 
         iterable = import_object_from_string(fields['object'])(**fields['args'])
 
-        return dataset_from_iterable(iterable)
+        fingerprint = node_fingerprint(fields['object'], fields['args'])
+        return SourceNode(iterable, name=type(iterable).__name__, fingerprint=fingerprint, cache=NodeCache.from_biospec(fields.get('cache', None)))
 
     def constructor_transform(self, loader, node):
         fields = fields = loader.construct_mapping(node, deep=True)
@@ -77,6 +90,25 @@ class BiospecLoader(yaml.SafeLoader):
             # assert that the transform is callable (it could be an abritrary object)
             assert callable(transform), f'Transform {fields["object"]} is not callable'
 
+        # transforms that are implemented with tensorflow ops only can declare to be thread-safe, i.e. to be mapped in parallel
+        thread_safe = getattr(transform_object if isinstance(transform_object, types.FunctionType) else transform, 'thread_safe', False)
+
+        # optionally, configure the parallelism of the map and the prefetch depth after it
+        num_parallel_calls = parse_autotune(fields.get('num_parallel_calls', None), 'num_parallel_calls', minimum=1)
+        if num_parallel_calls is not None and num_parallel_calls != 1 and not thread_safe:
+            raise ValueError(f"Transform {fields['object']} is not thread-safe (see 'thread_safe'), i.e. it cannot be mapped with num_parallel_calls={fields['num_parallel_calls']}")
+        prefetch = parse_autotune(fields.get('prefetch', None), 'prefetch')
+        deterministic = fields.get('deterministic', None)
+        if deterministic is not None and not isinstance(deterministic, bool):
+            raise ValueError(f"Invalid value for 'deterministic': {deterministic} (expected true or false)")
+
+        # optionally, apply the transform to batches of examples (amortizes the per-call py_function overhead)
+        batch_size = fields.get('batch_size', None)
+        if batch_size is not None:
+            if not hasattr(transform, 'call_batch'):
+                raise TypeError(f'Transform {fields["object"]} does not support batching (no \'call_batch\' method)')
+            batch_transform = transform.call_batch
+
         # # optionally, cast the output of the transform to a specific tensorflow dtype
         if 'dtype' in fields:
             try:
@@ -88,38 +120,57 @@ class BiospecLoader(yaml.SafeLoader):
             transform = lambda x: tf.cast(transform_(x), dtype)
             transform.__name__ = transform_.__name__
 
-        if 'input' not in fields:
-            # if input is not specified, we assume the transform is called within another 
-            # transform and return the transform itself
-            return transform
+            if batch_size is not None:
+                batch_transform_ = batch_transform
+                batch_transform = lambda x: tf.cast(batch_transform_(x), dtype)
 
-        # if input is not a tf.data.Dataset, we assume it's a nested structure of 
-        # tf.data.Dataset and zip them together to create a zipped tf.data.Dataset
-        if not isinstance(fields['input'], tf.data.Dataset):
-            fields['input'] = tf.data.Dataset.zip(fields['input'], name='zip')
+        transform.thread_safe = thread_safe
 
-        # map the transform over the input dataset
-        dataset = fields['input'].map(transform, name=transform.__name__)
+        # optionally, apply an additional stack of zero or more transforms to the output
+        maps = fields.get('map', [])
+        for map_transform in maps:
+            if isinstance(map_transform, Node):
+                raise TypeError('Expected a transform, but got a biospec node. Did specify \'input\' in a nested context?')
 
-        # optionally, apply an additional stack of zero or more transforms to the dataset
-        if 'map' in fields:
-            for transform in fields['map']:
-                if isinstance(transform, tf.data.Dataset):
-                    raise TypeError('Expected a transform, but got a tf.data.Dataset. Did specify \'input\' in a nested context?')
-                dataset = dataset.map(transform, name=transform.__name__)
+        # describes the transform for cache keys (batch_size and map options do not change the output)
+        transform.biospec_fingerprint = node_fingerprint(fields['object'], fields['args'], dtype=fields.get('dtype', None), 
+            map=[getattr(map_transform, 'biospec_fingerprint', None) for map_transform in maps])
 
-        # TODO: Replace with 
-        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+        if 'input' not in fields:
+            # if input is not specified, we assume the transform is called within another 
+            # transform and return the transform itself
+            if 'cache' in fields:
+                raise ValueError(f"Transform {fields['object']} has no input, i.e. it cannot be cached.")
+            return transform
 
-        return dataset
+        # the input is a node or a nested structure of nodes, the graph is compiled to a tf.data pipeline in load_biospec
+        return TransformNode(
+            fields['input'], 
+            transform, 
+            name=transform.__name__, 
+            batch_transform=(batch_transform if batch_size is not None else None), 
+            batch_size=batch_size, 
+            maps=maps,
+            num_parallel_calls=num_parallel_calls,
+            deterministic=deterministic,
+            prefetch=prefetch,
+            fingerprint=transform.biospec_fingerprint,
+            cache=NodeCache.from_biospec(fields.get('cache', None)))
 
 
 # %%
-def load_biospec(biospec_yaml, to_dataset=True):
+def load_biospec_graph(biospec_yaml):
     with open(biospec_yaml, 'r') as f:
         data = yaml.load(f, BiospecLoader)['data']
+    return BiospecGraph(data)
+
+# %%
+def load_biospec(biospec_yaml, to_dataset=True, **kwargs):
+    """Loads a biospec as a tf.data.Dataset. Keyword arguments (shard, skip, row_filter) are passed to `BiospecGraph.to_dataset`."""
+    graph = load_biospec_graph(biospec_yaml)
     
     if to_dataset:
-        data = tf.data.Dataset.zip(data)
-
-    return data
\ No newline at end of file
+        return graph.to_dataset(**kwargs)
+    else:
+        # nested structure of datasets, one per output
+        return graph.to_datasets(**kwargs)
@@ -0,0 +1,137 @@
+# %%
+"""
+Per-node profiling of biospec graphs.
+
+Every node is timed in isolation, i.e. the outputs of its inputs are computed (and profiled) first and held in
+memory, such that the time of a node does not include the time of its upstream nodes.
+"""
+
+# %%
+import os
+import sys
+import time
+import resource
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from bioio.dataspec.graph import SourceNode
+from bioio.tf.utils import PyFunctionTimer, dataset_to_tensor_features, example_serializer
+
+# %%
+def rss():
+    """Resident set size of the process in bytes (the peak resident set size, if /proc is not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+# %%
+class PeakMemory():
+    """Samples the resident set size in a background thread, while used as context manager."""
+
+    def __init__(self, interval=0.01) -> None:
+        self.interval = interval
+        self.start = self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def __enter__(self):
+        self.start = self.peak = rss()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss())
+
+# %%
+def consume(dataset):
+    """Iterates a dataset in graph mode (i.e. without per-element python overhead) and returns its number of elements."""
+    return int(dataset.reduce(np.int64(0), lambda n, _: n + 1))
+
+# %%
+def measure(func):
+    """Calls func (which returns a number of examples) and measures its wall time, time in python code and peak memory."""
+    with PyFunctionTimer() as timer, PeakMemory() as memory:
+        start = time.perf_counter()
+        num_examples = func()
+        wall = time.perf_counter() - start
+
+    return {
+        'num_examples': num_examples,
+        'wall_s': wall,
+        'examples_per_s': (num_examples / wall) if wall > 0 else None,
+        'py_function_s': timer.seconds,
+        'graph_s': max(wall - timer.seconds, 0.0),
+        'peak_rss_mb': memory.peak / 2**20,
+        'rss_delta_mb': (memory.peak - memory.start) / 2**20,
+    }
+
+# %%
+def profile_graph(graph, num_examples=1000, serialize=True, encoding='bytes'):
+    """
+    Profiles the nodes of a biospec graph on its first num_examples source rows.
+
+    Args:
+        graph (BiospecGraph): Biospec graph (see `load_biospec_graph`)
+        num_examples (int): Number of source rows
+        serialize (bool): Also profile the serialization of the outputs with tfds features (as done by `bioio serialize`)
+        encoding (str): Encoding of tensor features for serialization
+
+    Returns:
+        dict: 'nodes' (list of measurements of every node, see `measure`), 'pipeline' (the compiled pipeline, end-to-end) and 'serialize'
+    """
+
+    stages = {node.key: i for i, stage in enumerate(graph.stages, start=1) for node in stage}
+
+    outputs, nodes = {}, []
+    for node in graph.nodes:
+        if isinstance(node, SourceNode):
+            dataset = node.to_dataset().take(num_examples)
+        else:
+            # only the node itself is computed, its inputs are read from memory
+            inputs = {parent.key: outputs[parent.key] for parent in node.parents}
+            dataset = graph._compile([node], inputs).map(lambda state, node=node: state[node.key])
+        # the first iteration (i.e. the measurement) fills the cache
+        dataset = dataset.cache()
+        outputs[node.key] = dataset
+
+        nodes.append({
+            'key': node.key,
+            'name': node.name,
+            'type': 'PyIterable' if isinstance(node, SourceNode) else 'Transform',
+            'object': node.fingerprint['object'] if node.fingerprint is not None else None,
+            'stage': stages.get(node.key, 0),
+            'batch_size': getattr(node, 'batch_size', None),
+            'thread_safe': getattr(node, 'thread_safe', None),
+            **measure(lambda: consume(dataset)),
+        })
+
+    total = sum(node['wall_s'] for node in nodes)
+    for node in nodes:
+        node['share'] = (node['wall_s'] / total) if total > 0 else None
+
+    profile = {'num_examples': num_examples, 'nodes': nodes}
+    profile['pipeline'] = measure(lambda: consume(graph._compile(graph.outputs, {}).take(num_examples)))
+
+    if serialize:
+        dataset = graph._pack_outputs(graph._compile(graph.outputs, outputs))
+        features = dataset_to_tensor_features(dataset, encoding=encoding)
+        serialize = example_serializer(features)
+        def serialize_all():
+            n = 0
+            for example in dataset:
+                serialize(tf.nest.map_structure(lambda e: e.numpy(), example))
+                n += 1
+            return n
+        profile['serialize'] = measure(serialize_all)
+    return profile
@@ -1,16 +1,124 @@
 # %%
+import gzip
+
 import pandas as pd
+import tensorflow as tf
+
+# %%
+BED_COLUMNS = ['chrom', 'start', 'end', 'name', 'score', 'strand']
+
+# explicit column dtypes, such that e.g. a column of comma-separated labels is always parsed as a string
+# (and not as int64 if the file happens to contain only a single label per row). The score dtype is inferred, see `score_dtype`
+BED_DTYPES = {'chrom': 'string', 'start': 'int64', 'end': 'int64', 'name': 'string', 'strand': 'string'}
+SCORE_INFERENCE_ROWS = 10000
+
+# %%
+def is_gzipped(filepath):
+    # gzip and bgzip files both start with the gzip magic bytes
+    with open(filepath, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+# %%
+def bed_columns(filepath):
+    """Returns the column names of a (optionally gzipped) BED file, based on its first line."""
+    open_fn = gzip.open if is_gzipped(filepath) else open
+    with open_fn(filepath, 'rt') as f:
+        for line in f:
+            if not line.startswith('#'):
+                n = len(line.rstrip('\n').split('\t'))
+                return BED_COLUMNS[:n] + [str(i) for i in range(len(BED_COLUMNS), n)]
+    raise ValueError(f'Empty BED file: {filepath}')
+
+# %%
+def score_dtype(filepath, nrows=SCORE_INFERENCE_ROWS):
+    """
+    Returns 'int64' if the scores of the first nrows rows (all rows if None) are integers (as before typed columns), 
+    else 'float32' ('.' is parsed as NaN).
+    """
+    chunks = pd.read_csv(filepath, sep='\t', header=None, usecols=[4], comment='#', nrows=nrows, dtype=object, keep_default_na=False, 
+        compression=('gzip' if is_gzipped(filepath) else None), chunksize=2**20)
+    return 'int64' if all(chunk[4].str.fullmatch(r'[+-]?\d+').all() for chunk in chunks) else 'float32'
 
 # %%
 class Bed():
-    def __init__(self, filepath) -> None:
-        
-        self.bed_df = pd.read_csv(filepath, sep='\t', header=None)
-        self.bed_df.columns = ['chrom', 'start', 'end', 'name', 'score', 'strand'] + [str(i) for i in range(6, len(self.bed_df.columns))]
-        
+    """BED file source.
+
+    Columns are named 'chrom', 'start', 'end', 'name', 'score', 'strand' followed by '6', '7', ... for
+    any additional columns. Additional columns are parsed as strings, unless specified otherwise in `dtypes`. Integer
+    scores are parsed as int64 and other scores as float32 (with '.' as NaN), inferred from the first rows (or all
+    rows, when streaming in chunks).
+
+    Args:
+        filepath  (str): Path to a BED file (plain, gzip or bgzip)
+        dtypes    (dict): Column dtypes ('string', 'int64', 'float32', ...), overrides the defaults
+        chunksize (int): If given, stream the file in chunks of this many rows instead of loading it into memory
+    """
+
+    def __init__(self, filepath, dtypes=None, chunksize=None) -> None:
+        self.filepath = filepath
+        self.chunksize = chunksize
+        self.columns = bed_columns(filepath)
+        dtypes = dtypes if dtypes is not None else {}
+        self.dtypes = {column: BED_DTYPES.get(column, 'string') for column in self.columns}
+        infer_score = 'score' in self.columns and 'score' not in dtypes
+        if infer_score:
+            # chunks are typed before they are read, i.e. a later non-integer score could not be parsed anymore
+            self.dtypes['score'] = score_dtype(filepath, nrows=(SCORE_INFERENCE_ROWS if chunksize is None else None))
+        self.dtypes.update(dtypes)
+
+        if chunksize is None:
+            try:
+                self.bed_df = self._read_csv()
+            except ValueError:
+                if not (infer_score and self.dtypes['score'] == 'int64'):
+                    raise
+                # a score after the first rows is not an integer (e.g. '.' or a float)
+                self.dtypes['score'] = 'float32'
+                self.bed_df = self._read_csv()
+
+    def _read_csv(self, **kwargs):
+        return pd.read_csv(
+            self.filepath,
+            sep='\t',
+            header=None,
+            names=self.columns,
+            comment='#',
+            compression=('gzip' if is_gzipped(self.filepath) else None),
+            dtype={column: (object if dtype == 'string' else dtype) for column, dtype in self.dtypes.items()},
+            keep_default_na=False, # keep empty strings, i.e. don't parse them as NaN
+            na_values={'score': ['.']},
+            **kwargs)
+
+    def _chunks(self):
+        if self.chunksize is None:
+            yield self.bed_df
+        else:
+            yield from self._read_csv(chunksize=self.chunksize)
+
+    def _chunk_to_columns(self, chunk):
+        return {column: chunk[column].to_numpy(dtype=(object if dtype == 'string' else dtype)) for column, dtype in self.dtypes.items()}
+
     def __len__(self):
-        return len(self.bed_df)
+        if self.chunksize is None:
+            return len(self.bed_df)
+        else:
+            return sum(len(chunk) for chunk in self._chunks())
 
     def __iter__(self):
-        for i in range(0, len(self.bed_df)):
-            yield self.bed_df.loc[i].to_dict()
\ No newline at end of file
+        for chunk in self._chunks():
+            yield from chunk.to_dict(orient='records')
+
+    @property
+    def element_spec(self):
+        return {column: tf.TensorSpec(shape=(), dtype=tf.dtypes.as_dtype(dtype)) for column, dtype in self.dtypes.items()}
+
+    def to_dataset(self):
+        """Returns a tf.data.Dataset of BED rows, built from column arrays rather than a per-row python generator."""
+        if self.chunksize is None:
+            # in-memory, with known cardinality
+            return tf.data.Dataset.from_tensor_slices(self._chunk_to_columns(self.bed_df))
+        else:
+            # streaming, one generator call per chunk of rows
+            signature = {column: tf.TensorSpec(shape=(None, ), dtype=spec.dtype) for column, spec in self.element_spec.items()}
+            chunks = lambda: map(self._chunk_to_columns, self._chunks())
+            return tf.data.Dataset.from_generator(chunks, output_signature=signature).unbatch()
@@ -1,6 +1,8 @@
 # %%
-from . import fasta, bigwig, bed
+from . import fasta, packed_fasta, bigwig, bigwig_cache, bed
 
 # %%
 from .fasta import Fasta
-from .bigwig import BigWig, StrandedBigWig
\ No newline at end of file
+from .packed_fasta import PackedFasta
+from .bigwig import BigWig, StrandedBigWig
+from .bigwig_cache import CachedBigWig, CachedStrandedBigWig
\ No newline at end of file
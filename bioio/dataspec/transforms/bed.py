@@ -6,6 +6,7 @@ from bioio.tf.utils import multi_hot, better_py_function_kwargs
 # %%
 class BedFormatName:
     tensor_spec = tf.TensorSpec(shape=(), dtype=tf.string)
+    thread_safe = True
 
     def __init__(self, format_string='{chrom}:{start}-{end}:{strand}') -> None:
         self.format_string = format_string
@@ -21,6 +22,8 @@ class BedFormatName:
 
 # %%
 class BedColumnSparseLabels:
+    thread_safe = True
+
     def __init__(self, column, sep=','):
         self._column = column
         self._sep = sep
@@ -33,6 +36,7 @@ class BedColumnSparseLabels:
 # %%
 class BedColumnMultihotLabels:
     tensor_spec = tf.TensorSpec(shape=(None, ), dtype=tf.int64)
+    thread_safe = True
 
     def __init__(self, column, depth, sep=','):
         self._column = column
@@ -1,11 +1,12 @@
 # %%
-import sys, math
+import os, sys, math
 
 import tensorflow as tf
 import numpy as np
 # import pyBigWig
 
-from bioio.tf.utils import better_py_function_kwargs
+from bioio.tf.utils import better_py_function_kwargs, better_py_function_batch
+from bioio.utils import HandlePool
 
 # %%
 def nan_to_zero(x):
@@ -16,29 +17,55 @@ def nan_to_zero(x):
 class BigWig():
     tensor_spec = tf.TensorSpec(shape=(None, ), dtype=tf.float32)
 
+    # one pyBigWig handle per thread, i.e. safe to be mapped with parallel calls
+    thread_safe = True
+
     def __init__(self, bigwig_filepath) -> None:
         try:
             import pyBigWig
         except ModuleNotFoundError:
             raise ModuleNotFoundError('Please install pyBigWig. See https://github.com/deeptools/pyBigWig')
 
-        self._bigWig = pyBigWig.open(bigwig_filepath)
-    
+        # absolute path of local files (pyBigWig also opens URLs), since handles of other threads are opened lazily
+        self._bigWig_pool = HandlePool(pyBigWig.open, os.path.abspath(bigwig_filepath) if os.path.exists(bigwig_filepath) else bigwig_filepath)
+        # open a handle right away, such that a missing file fails early
+        self._bigWig_pool.get()
+        # pyBigWig may be compiled without numpy support
+        self._numpy = bool(pyBigWig.numpy)
+
+    @property
+    def _bigWig(self):
+        return self._bigWig_pool.get()
+
     def values(self, chrom, start, end, **kwargs):
         chrom, start, end = str(chrom), int(start), int(end) # not sure why this is needed, it worked locally with numpy.int32
-        values = self._bigWig.values(chrom, start, end)
-        values = [nan_to_zero(v) for v in values]        
-        return tf.cast(values, self.tensor_spec.dtype)
+        bigWig = self._bigWig
+        if self._numpy:
+            values = bigWig.values(chrom, start, end, numpy=True)
+            return np.nan_to_num(values, nan=0.0, copy=False).astype(self.tensor_spec.dtype.as_numpy_dtype, copy=False)
+        else:
+            return np.array([nan_to_zero(v) for v in bigWig.values(chrom, start, end)], dtype=self.tensor_spec.dtype.as_numpy_dtype)
+
+    def values_batch(self, chrom, start, end, **kwargs):
+        """Returns values for a batch of ranges, concatenated, and the length of each range."""
+        values = [self.values(c, s, e) for c, s, e in zip(chrom, start, end)]
+        return concatenate_values(values, self.tensor_spec.dtype.as_numpy_dtype)
 
     def __call__(self, kwargs):
         tensor = better_py_function_kwargs(Tout=self.tensor_spec)(self.values)(kwargs)
         tensor.set_shape(self.tensor_spec.shape)
         return tensor
 
+    def call_batch(self, examples):
+        return better_py_function_batch(Tout=self.tensor_spec, ragged=True)(self.values_batch)(examples)
+
 # %%
 class StrandedBigWig():
     tensor_spec = tf.TensorSpec(shape=(None, ), dtype=tf.float32)
 
+    # see BigWig
+    thread_safe = True
+
     def __init__(self, bigwig_plus, bigwig_minus, reverse_minus=True) -> None:
         self._bigWig_plus = BigWig(bigwig_plus)
         self._bigWig_minus = BigWig(bigwig_minus)
@@ -67,9 +94,14 @@ class StrandedBigWig():
         values = bigWig.values(chrom, start, end)
 
         if strand == '-' and self.reverse_minus:
-            values = list(reversed(values))
+            values = values[::-1]
+
+        return values
 
-        return tf.cast(values, dtype=self.tensor_spec.dtype)
+    def values_batch(self, chrom, start, end, strand, **kwargs):
+        """Returns values for a batch of ranges and strands, concatenated, and the length of each range."""
+        values = [self.values(c, s, e, strand=st) for c, s, e, st in zip(chrom, start, end, strand)]
+        return concatenate_values(values, self.tensor_spec.dtype.as_numpy_dtype)
 
     # def __call__(self, *args, **kwargs):
     #     return self.values(*args, **kwargs)
@@ -78,4 +110,12 @@ class StrandedBigWig():
         tensor = better_py_function_kwargs(Tout=self.tensor_spec)(self.values)(kwargs)
         tensor.set_shape(self.tensor_spec.shape)
         return tensor
-        
\ No newline at end of file
+
+    def call_batch(self, examples):
+        return better_py_function_batch(Tout=self.tensor_spec, ragged=True)(self.values_batch)(examples)
+
+# %%
+def concatenate_values(values, dtype):
+    lengths = np.array([len(v) for v in values], dtype=np.int64)
+    values = np.concatenate(values).astype(dtype, copy=False) if len(values) > 0 else np.zeros((0, ), dtype=dtype)
+    return values, lengths
@@ -0,0 +1,372 @@
+# %%
+import json
+import warnings
+
+import numpy as np
+import tensorflow as tf
+
+# %%
+# Track cache format:
+#   - 8 bytes magic (TRACK_MAGIC)
+#   - JSON header (version, layout, dtype, chromosomes with their offset and length, offsets of the arrays), padded to TRACK_HEADER_SIZE
+#   - layout 'dense': values of all chromosomes, concatenated (i.e. one value per base, NaN filled to zero)
+#   - layout 'sparse': non-zero intervals as int64 starts, int64 ends and values (positions are global, i.e. chromosome offset + position)
+TRACK_MAGIC = b'BIOIOTRK'
+TRACK_HEADER_SIZE = 4096
+TRACK_LAYOUTS = ('dense', 'sparse')
+
+# in-memory tracks larger than this (in bytes) are copied into every process with a warning
+IN_MEMORY_WARNING_BYTES = 2**30
+
+# %%
+def open_bigwig(bigwig_filepath):
+    try:
+        import pyBigWig
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('Please install pyBigWig. See https://github.com/deeptools/pyBigWig')
+    return pyBigWig.open(bigwig_filepath)
+
+# %%
+def estimate_track_size(bigwig_filepath, dtype='float16'):
+    """
+    Estimates the size (in bytes) of a track cache in the dense and sparse layout.
+
+    The sparse size is an upper bound, based on the number of bases covered by the bigWig (i.e. assuming one interval per base).
+
+    Returns:
+        dict: 'dense' and 'sparse' size in bytes
+    """
+
+    bw = open_bigwig(bigwig_filepath)
+    itemsize = np.dtype(dtype).itemsize
+    num_bases = sum(bw.chroms().values())
+    num_covered = bw.header()['nBasesCovered']
+    bw.close()
+    return {'dense': num_bases * itemsize, 'sparse': num_covered * (8 + 8 + itemsize)}
+
+# %%
+def fill_intervals(intervals, start, end, dtype):
+    """Dense values of bases [start, end) from (non-overlapping) intervals of shape (n, 3), i.e. start, end and value (NaN filled to zero)."""
+    starts = np.clip(intervals[:, 0].astype(np.int64), start, end) - start
+    lengths = np.clip(intervals[:, 1].astype(np.int64), start, end) - start - starts
+    values = np.zeros(end - start, dtype=dtype)
+    # positions of all covered bases, i.e. the concatenated ranges [start, start + length) of the intervals
+    positions = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+    values[positions] = np.repeat(np.nan_to_num(intervals[:, 2], nan=0), lengths)
+    return values
+
+# %%
+def cache_bigwig(bigwig_filepath, out_filepath, dtype='float16', layout='auto', chunk_size=2**24, pbar=None):
+    """
+    Converts a bigWig file to a memory-mappable track cache.
+
+    Args:
+        bigwig_filepath (str): Path to a bigWig file
+        out_filepath (str): Path of the track cache
+        dtype (str): Dtype of the values ('float16' or 'float32')
+        layout (str): 'dense' (one value per base), 'sparse' (non-zero intervals) or 'auto' (the smaller one, see `estimate_track_size`)
+        chunk_size (int): Number of bases read at once (dense layout)
+
+    Returns:
+        str: The layout of the track cache
+    """
+
+    if layout == 'auto':
+        size = estimate_track_size(bigwig_filepath, dtype)
+        layout = 'sparse' if size['sparse'] < size['dense'] else 'dense'
+    if layout not in TRACK_LAYOUTS:
+        raise ValueError(f'Unknown layout: {layout}')
+
+    bw = open_bigwig(bigwig_filepath)
+    chroms, offset = [], 0
+    for name, length in bw.chroms().items():
+        chroms.append({'name': name, 'offset': offset, 'length': length})
+        offset += length
+
+    with open(out_filepath, 'wb') as f:
+        f.write(b' '*TRACK_HEADER_SIZE)
+        header = {'version': 1, 'layout': layout, 'dtype': dtype, 'num_bases': offset, 'chroms': chroms}
+
+        if layout == 'dense':
+            header['values_offset'] = TRACK_HEADER_SIZE
+            for chrom in chroms:
+                for start in range(0, chrom['length'], chunk_size):
+                    end = min(start + chunk_size, chrom['length'])
+                    intervals = np.array(bw.intervals(chrom['name'], start, end) or np.zeros((0, 3)), dtype=np.float64).reshape(-1, 3)
+                    f.write(fill_intervals(intervals, start, end, dtype).tobytes())
+                    if pbar is not None:
+                        pbar.update(end - start)
+        else:
+            starts, ends, values = [], [], []
+            for chrom in chroms:
+                intervals = np.array(bw.intervals(chrom['name']) or np.zeros((0, 3)), dtype=np.float64).reshape(-1, 3)
+                intervals = intervals[~np.isnan(intervals[:, 2]) & (intervals[:, 2] != 0)]
+                starts.append(intervals[:, 0].astype(np.int64) + chrom['offset'])
+                ends.append(intervals[:, 1].astype(np.int64) + chrom['offset'])
+                values.append(intervals[:, 2].astype(dtype))
+                if pbar is not None:
+                    pbar.update(chrom['length'])
+            starts, ends, values = np.concatenate(starts), np.concatenate(ends), np.concatenate(values)
+
+            header['num_intervals'] = len(starts)
+            header['starts_offset'] = TRACK_HEADER_SIZE
+            header['ends_offset'] = header['starts_offset'] + starts.nbytes
+            header['values_offset'] = header['ends_offset'] + ends.nbytes
+            f.write(starts.astype('<i8').tobytes())
+            f.write(ends.astype('<i8').tobytes())
+            f.write(values.tobytes())
+
+        header = json.dumps(header).encode('UTF-8')
+        if len(TRACK_MAGIC) + len(header) > TRACK_HEADER_SIZE:
+            raise ValueError('Track cache header too large.')
+        f.seek(0)
+        f.write(TRACK_MAGIC + header)
+
+    bw.close()
+    return layout
+
+# %%
+class TrackCache():
+    """
+    Memory-mapped track cache (see `cache_bigwig`).
+
+    Args:
+        filepath (str): Path to a track cache
+    """
+
+    def __init__(self, filepath) -> None:
+        self.filepath = filepath
+        with open(filepath, 'rb') as f:
+            if f.read(len(TRACK_MAGIC)) != TRACK_MAGIC:
+                raise ValueError(f'Not a track cache: {filepath}')
+            self.header = json.loads(f.read(TRACK_HEADER_SIZE - len(TRACK_MAGIC)).rstrip(b' '))
+
+        self.layout = self.header['layout']
+        self.dtype = np.dtype(self.header['dtype'])
+        self.chroms = {chrom['name']: chrom for chrom in self.header['chroms']}
+        if self.layout == 'dense':
+            self.values = np.memmap(filepath, dtype=self.dtype, mode='r', offset=self.header['values_offset'], shape=(self.header['num_bases'], ))
+        else:
+            n = self.header['num_intervals']
+            memmap = lambda dtype, offset: np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=(n, )) if n > 0 else np.zeros(0, dtype=dtype)
+            self.starts = memmap('<i8', self.header['starts_offset'])
+            self.ends = memmap('<i8', self.header['ends_offset'])
+            self.values = memmap(self.dtype, self.header['values_offset'])
+
+    def load(self, chroms=None):
+        """
+        Copies the values (and interval starts and ends of the sparse layout) of chromosomes into memory.
+
+        Args:
+            chroms (list): Names of the chromosomes to load, defaults to all chromosomes
+
+        Returns:
+            tuple: values, starts, ends (None for the dense layout) and the loaded chromosomes with their offsets
+        """
+
+        sparse = self.layout == 'sparse'
+        if chroms is None:
+            return (np.array(self.values), np.array(self.starts) if sparse else None, np.array(self.ends) if sparse else None, 
+                list(self.chroms.values()))
+
+        values, starts, ends, loaded, offset = [], [], [], [], 0
+        for name in chroms:
+            if name not in self.chroms:
+                raise ValueError(f"Unknown chromosome '{name}'.")
+            chrom = self.chroms[name]
+            if sparse:
+                # intervals are sorted by their global start
+                lo, hi = np.searchsorted(self.starts, [chrom['offset'], chrom['offset'] + chrom['length']], side='left')
+                values.append(self.values[lo:hi])
+                starts.append(self.starts[lo:hi] - chrom['offset'] + offset)
+                ends.append(self.ends[lo:hi] - chrom['offset'] + offset)
+            else:
+                values.append(self.values[chrom['offset']:chrom['offset'] + chrom['length']])
+            loaded.append({'name': name, 'offset': offset, 'length': chrom['length']})
+            offset += chrom['length']
+        concatenate = lambda arrays, dtype: np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+        values = concatenate(values, self.dtype)
+        if not sparse:
+            return values, None, None, loaded
+        return values, concatenate(starts, np.int64), concatenate(ends, np.int64), loaded
+
+    @property
+    def nbytes(self):
+        """Size of the arrays (in bytes), i.e. the memory held by a `_CachedTrack` of all chromosomes with in_memory."""
+        return self.values.nbytes + (self.starts.nbytes + self.ends.nbytes if self.layout == 'sparse' else 0)
+
+    def values_at(self, positions):
+        """Returns the values at global positions (i.e. chromosome offset + position)."""
+        if self.layout == 'dense':
+            return np.asarray(self.values[positions])
+        if len(self.starts) == 0:
+            return np.zeros(len(positions), dtype=self.dtype)
+        # last interval starting at or before each position, the position is covered if it ends after the position
+        intervals = np.maximum(np.searchsorted(self.starts, positions, side='right') - 1, 0)
+        covered = (self.starts[intervals] <= positions) & (positions < self.ends[intervals])
+        return np.where(covered, self.values[intervals], 0).astype(self.dtype)
+
+    def fetch(self, chrom, start, end):
+        """Returns the values of bases [start, end) of a chromosome."""
+        chrom = self.chroms[chrom]
+        if not (0 <= start <= end <= chrom['length']):
+            raise ValueError(f'Invalid interval bounds: {start}-{end}')
+        start, end = chrom['offset'] + start, chrom['offset'] + end
+        if self.layout == 'dense':
+            return np.array(self.values[start:end])
+
+        values = np.zeros(end - start, dtype=self.dtype)
+        lo, hi = np.searchsorted(self.ends, start, side='right'), np.searchsorted(self.starts, end, side='left')
+        for s, e, v in zip(self.starts[lo:hi], self.ends[lo:hi], self.values[lo:hi]):
+            values[max(s, start) - start:min(e, end) - start] = v
+        return values
+
+# %%
+class _CachedTrack():
+    """
+    Track cache, sliced by a single numpy_function per batch that reads the memory-mapped file (i.e. all processes
+    share the track through the page cache).
+
+    With in_memory, the track is copied into tensors and sliced with tensorflow ops only, which is faster but
+    costs every process that builds the transform (e.g. every worker of `bioio serialize --workers`) 2 bytes per
+    base for a dense float16 track (about 6 GB for a human genome), unless it is restricted to some chromosomes.
+    """
+
+    def __init__(self, filepath, in_memory=False, chroms=None) -> None:
+        self._cache = TrackCache(filepath)
+        self.layout = self._cache.layout
+        self.in_memory = in_memory
+        if in_memory:
+            values, starts, ends, chroms = self._cache.load(chroms)
+            nbytes = values.nbytes + (starts.nbytes + ends.nbytes if self.layout == 'sparse' else 0)
+            if nbytes > IN_MEMORY_WARNING_BYTES:
+                warnings.warn(f'Track cache {filepath} copies {nbytes / 2**30:.1f} GB into the memory of this process, restrict chroms or use in_memory=False.')
+            self._values = tf.constant(values)
+            if self.layout == 'sparse':
+                self._starts = tf.constant(starts)
+                self._ends = tf.constant(ends)
+        else:
+            if chroms is not None:
+                raise ValueError('chroms requires in_memory=True.')
+            chroms = list(self._cache.chroms.values())
+        self._chrom_table = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(tf.constant([c['name'] for c in chroms]), tf.range(len(chroms), dtype=tf.int64)), default_value=-1)
+        self._chrom_offsets = tf.constant([c['offset'] for c in chroms], dtype=tf.int64)
+        self._chrom_lengths = tf.constant([c['length'] for c in chroms], dtype=tf.int64)
+
+    def slice_batch(self, chrom, start, end, dtype=tf.float32):
+        """Returns a tf.RaggedTensor of values of a batch of intervals."""
+        index = self._chrom_table.lookup(chrom)
+        tf.debugging.assert_non_negative(index, message='Unknown chromosome.')
+        start, end = tf.cast(start, tf.int64), tf.cast(end, tf.int64)
+        tf.debugging.assert_less_equal(start, end, message='Invalid interval bounds.')
+        tf.debugging.assert_less_equal(end, tf.gather(self._chrom_lengths, index), message='Invalid interval bounds.')
+        offset = tf.gather(self._chrom_offsets, index)
+        start, end = offset + start, offset + end
+
+        positions = tf.ragged.range(start, end)
+        if not self.in_memory:
+            flat_positions = positions.flat_values
+            values = tf.numpy_function(self._cache.values_at, inp=[flat_positions], Tout=tf.as_dtype(self._cache.dtype), stateful=False)
+            return tf.cast(positions.with_flat_values(tf.ensure_shape(values, flat_positions.shape)), dtype)
+        if self.layout == 'dense':
+            return tf.cast(tf.gather(self._values, positions), dtype)
+
+        flat_positions = positions.flat_values
+        if self._starts.shape[0] == 0:
+            # empty track
+            return positions.with_flat_values(tf.zeros_like(flat_positions, dtype=dtype))
+
+        # last interval starting at or before each position, the position is covered if it ends after the position
+        intervals = tf.searchsorted(self._starts, flat_positions, side='right') - 1
+        covered = (intervals >= 0) & (flat_positions < tf.gather(self._ends, tf.maximum(intervals, 0)))
+        values = tf.where(covered, tf.gather(self._values, tf.maximum(intervals, 0)), tf.zeros((), dtype=self._values.dtype))
+        return tf.cast(positions.with_flat_values(values), dtype)
+
+# %%
+def reverse_rows(values, reverse):
+    """Reverses the rows of a tf.RaggedTensor where reverse is True."""
+    # on flat values, i.e. position i of row r maps to row_start[r] + row_end[r] - 1 - i
+    rows = values.value_rowids()
+    positions = tf.range(tf.shape(values.flat_values, out_type=tf.int64)[0])
+    mirrored = tf.gather(values.row_starts() + values.row_limits() - 1, rows) - positions
+    indices = tf.where(tf.gather(reverse, rows), mirrored, positions)
+    return values.with_flat_values(tf.gather(values.flat_values, indices))
+
+# %%
+def _batch_example(example):
+    return {key: tf.expand_dims(value, 0) for key, value in example.items()}
+
+# %%
+class CachedBigWig():
+    """
+    Drop-in replacement for `BigWig`, reading from a track cache (see `bioio cache-bigwig`) with tensorflow ops only.
+    The track is read from the memory-mapped file, or copied into every process with in_memory (see `_CachedTrack`).
+
+    Args:
+        cache_filepath (str): Path to a track cache
+        in_memory (bool): Copy the track into tensors instead of reading the memory-mapped file
+        chroms (list): Names of the chromosomes to load with in_memory, defaults to all chromosomes
+    """
+
+    tensor_spec = tf.TensorSpec(shape=(None, ), dtype=tf.float32)
+
+    # reads of the memory-mapped file (or tensorflow ops on in-memory tensors) are safe to be mapped with parallel calls
+    thread_safe = True
+
+    def __init__(self, cache_filepath, in_memory=False, chroms=None) -> None:
+        self._track = _CachedTrack(cache_filepath, in_memory=in_memory, chroms=chroms)
+
+    def call_batch(self, examples):
+        return self._track.slice_batch(examples['chrom'], examples['start'], examples['end'], self.tensor_spec.dtype)
+
+    def __call__(self, example):
+        tensor = self.call_batch(_batch_example(example))[0]
+        tensor.set_shape(self.tensor_spec.shape)
+        return tensor
+
+# %%
+class CachedStrandedBigWig():
+    """
+    Drop-in replacement for `StrandedBigWig`, reading from track caches (see `bioio cache-bigwig`) with tensorflow ops only.
+    The tracks are read from the memory-mapped files, or copied into every process with in_memory (see `_CachedTrack`).
+
+    Args:
+        cache_plus (str): Path to the track cache of the '+' strand
+        cache_minus (str): Path to the track cache of the '-' strand
+        reverse_minus (bool): Reverse values of the '-' strand
+        in_memory (bool): Copy the tracks into tensors instead of reading the memory-mapped files
+        chroms (list): Names of the chromosomes to load with in_memory, defaults to all chromosomes
+    """
+
+    tensor_spec = tf.TensorSpec(shape=(None, ), dtype=tf.float32)
+
+    # reads of the memory-mapped file (or tensorflow ops on in-memory tensors) are safe to be mapped with parallel calls
+    thread_safe = True
+
+    def __init__(self, cache_plus, cache_minus, reverse_minus=True, in_memory=False, chroms=None) -> None:
+        self._track_plus = _CachedTrack(cache_plus, in_memory=in_memory, chroms=chroms)
+        self._track_minus = _CachedTrack(cache_minus, in_memory=in_memory, chroms=chroms)
+        self.reverse_minus = reverse_minus
+
+    def call_batch(self, examples):
+        if 'strand' not in examples:
+            # '+' strand, like StrandedBigWig
+            return self._track_plus.slice_batch(examples['chrom'], examples['start'], examples['end'], self.tensor_spec.dtype)
+
+        strand = examples['strand']
+        tf.debugging.assert_equal(tf.reduce_all((strand == '+') | (strand == '-')), True, message='Unexpected strand.')
+        is_minus = strand == '-'
+
+        # each interval is read from one track, the other track gets an empty interval
+        start, end = examples['start'], examples['end']
+        plus = self._track_plus.slice_batch(examples['chrom'], start, tf.where(is_minus, start, end), self.tensor_spec.dtype)
+        minus = self._track_minus.slice_batch(examples['chrom'], start, tf.where(is_minus, end, start), self.tensor_spec.dtype)
+        if self.reverse_minus:
+            minus = reverse_rows(minus, is_minus)
+        return tf.concat([plus, minus], axis=1)
+
+    def __call__(self, example):
+        tensor = self.call_batch(_batch_example(example))[0]
+        tensor.set_shape(self.tensor_spec.shape)
+        return tensor
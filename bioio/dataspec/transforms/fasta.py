@@ -1,22 +1,42 @@
 # %%
+import os
+
 import pysam
+import numpy as np
 import tensorflow as tf
 
-from bioio.tf.utils import better_py_function_kwargs
-from bioio.utils import sequence2onehot, reverse_complement, mask_noncanonical_bases
+from bioio.tf.utils import better_py_function_kwargs, better_py_function_batch
+from bioio.utils import sequence2onehot, reverse_complement, mask_noncanonical_bases, encode_sequence, encode_sequences, HandlePool
 
 # %%
 class Fasta():
     # tensor_spec = tf.TensorSpec(shape=(None, 4), dtype=tf.int8)
 
-    def __init__(self, filepath, to_onehot=True, mask_noncanonical_bases=True) -> None:
+    # one pysam handle per thread, i.e. safe to be mapped with parallel calls
+    thread_safe = True
+
+    def __init__(self, filepath, to_onehot=True, mask_noncanonical_bases=True, vectorized=True) -> None:
         self.to_onehot = to_onehot
         self.mask_noncanonical_bases = mask_noncanonical_bases
-        self._fasta = pysam.FastaFile(filepath)
+        self.vectorized = vectorized
+        # absolute path, since handles of other threads are opened lazily (i.e. possibly after the working directory changed)
+        self._fasta_pool = HandlePool(pysam.FastaFile, os.path.abspath(filepath))
+        # open a handle right away, such that a missing file fails early
+        self._fasta_pool.get()
         self.dtype = tf.int8 if to_onehot else tf.string
+
+    @property
+    def _fasta(self):
+        return self._fasta_pool.get()
     
     def fetch(self, chrom, start, end, strand='+', **kwargs):
-        sequence = self._fasta.fetch(chrom, start, end).upper()
+        sequence = self._fasta.fetch(chrom, start, end)
+
+        if self.vectorized:
+            # lookup-table based encoding on byte arrays (see bioio.utils.encode_sequences)
+            return encode_sequence(sequence, strand, to_onehot=self.to_onehot, mask_noncanonical=self.mask_noncanonical_bases)
+
+        sequence = sequence.upper()
 
         if self.mask_noncanonical_bases:
             # Everything except A, C, G, T will be mapped to N
@@ -37,5 +57,20 @@ class Fasta():
             # sequence.set_shape(())
         return sequence
 
+    def fetch_batch(self, chrom, start, end, strand=None, **kwargs):
+        fasta = self._fasta
+        sequences = [fasta.fetch(c, int(s), int(e)) for c, s, e in zip(chrom, start, end)]
+        if self.to_onehot:
+            # (values, row_lengths) of the concatenated one-hot sequences
+            return encode_sequences(sequences, strand, mask_noncanonical=self.mask_noncanonical_bases, flat=True)
+        else:
+            return np.array(encode_sequences(sequences, strand, to_onehot=False, mask_noncanonical=self.mask_noncanonical_bases), dtype=object)
+
     def __call__(self, example):
-        return better_py_function_kwargs(Tout=self.dtype)(self.fetch)(example)
\ No newline at end of file
+        return better_py_function_kwargs(Tout=self.dtype)(self.fetch)(example)
+
+    def call_batch(self, examples):
+        if self.to_onehot:
+            return better_py_function_batch(Tout=tf.TensorSpec(shape=(None, 4), dtype=self.dtype), ragged=True)(self.fetch_batch)(examples)
+        else:
+            return better_py_function_batch(Tout=tf.TensorSpec(shape=(), dtype=self.dtype))(self.fetch_batch)(examples)
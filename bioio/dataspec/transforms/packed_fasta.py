@@ -0,0 +1,272 @@
+# %%
+import json
+import warnings
+
+import pysam
+import numpy as np
+import tensorflow as tf
+
+from bioio.utils import _UPPER_LUT, _BASE2INT_LUT
+
+# %%
+# Packed genome format:
+#   - 8 bytes magic (PACKED_MAGIC)
+#   - JSON header (version, bits per base, chromosomes with their offset and length in bases, offset of the data and N-mask), padded to PACKED_HEADER_SIZE
+#   - bits=8: one uint8 code per base (0, 1, 2, 3 for A, C, G, T and 4 for everything else)
+#   - bits=2: four 2-bit codes per byte (lowest bits first), followed by a 1-bit mask of non-canonical bases (np.packbits, little bit order)
+# Chromosomes start at offsets that are a multiple of 8 bases, such that they start at byte boundaries in both encodings.
+PACKED_MAGIC = b'BIOIOPKG'
+PACKED_HEADER_SIZE = 4096
+N_CODE = 4
+
+# in-memory genomes larger than this (in bytes) are copied into every process with a warning
+IN_MEMORY_WARNING_BYTES = 2**30
+
+# %%
+def encode_bases(sequence):
+    """Maps (upper or lower case) bases to codes 0-3 for A, C, G, T and 4 for everything else."""
+    return _BASE2INT_LUT[_UPPER_LUT[np.frombuffer(sequence.encode('ascii') if isinstance(sequence, str) else sequence, dtype=np.uint8)]]
+
+# %%
+def pack_fasta(fasta_filepath, out_filepath, bits=2, chunk_size=2**24, pbar=None):
+    """
+    Converts a FASTA file to a packed genome file.
+
+    Args:
+        fasta_filepath (str): Path to an (indexed) FASTA file
+        out_filepath (str): Path of the packed genome file
+        bits (int): Bits per base, 2 (plus a 1-bit N-mask) or 8
+        chunk_size (int): Number of bases encoded at once (multiple of 8)
+    """
+
+    if bits not in (2, 8):
+        raise ValueError(f'Unsupported number of bits per base: {bits}')
+    assert chunk_size % 8 == 0
+
+    with pysam.FastaFile(fasta_filepath) as fasta:
+        chroms, offset = [], 0
+        for name, length in zip(fasta.references, fasta.lengths):
+            chroms.append({'name': name, 'offset': offset, 'length': length})
+            offset += -(-length // 8) * 8
+        num_bases = offset
+
+        data_size = num_bases if bits == 8 else num_bases // 4
+        header = json.dumps({
+            'version': 1,
+            'bits': bits,
+            'num_bases': num_bases,
+            'chroms': chroms,
+            'data_offset': PACKED_HEADER_SIZE,
+            'mask_offset': (PACKED_HEADER_SIZE + data_size) if bits == 2 else None,
+        }).encode('UTF-8')
+        if len(PACKED_MAGIC) + len(header) > PACKED_HEADER_SIZE:
+            raise ValueError('Packed genome header too large.')
+
+        with open(out_filepath, 'wb') as f:
+            f.write(PACKED_MAGIC + header + b' '*(PACKED_HEADER_SIZE - len(PACKED_MAGIC) - len(header)))
+            f.truncate(PACKED_HEADER_SIZE + data_size + (num_bases // 8 if bits == 2 else 0))
+
+            for chrom in chroms:
+                for start in range(0, chrom['length'], chunk_size):
+                    codes = encode_bases(fasta.fetch(chrom['name'], start, min(start + chunk_size, chrom['length'])))
+                    num_bases_chunk = len(codes)
+                    base_offset = chrom['offset'] + start
+                    if bits == 8:
+                        f.seek(PACKED_HEADER_SIZE + base_offset)
+                        f.write(codes.tobytes())
+                    else:
+                        # pad the last chunk of a chromosome to a multiple of 8 bases
+                        codes = np.pad(codes, (0, -len(codes) % 8), constant_values=N_CODE)
+                        packed = (codes & 3).reshape(-1, 4) << np.array([0, 2, 4, 6], dtype=np.uint8)
+                        f.seek(PACKED_HEADER_SIZE + base_offset // 4)
+                        f.write(np.bitwise_or.reduce(packed, axis=1).astype(np.uint8).tobytes())
+                        f.seek(PACKED_HEADER_SIZE + data_size + base_offset // 8)
+                        f.write(np.packbits(codes == N_CODE, bitorder='little').tobytes())
+                    if pbar is not None:
+                        pbar.update(num_bases_chunk)
+
+# %%
+class PackedGenome():
+    """
+    Memory-mapped packed genome (see `pack_fasta`).
+
+    Args:
+        filepath (str): Path to a packed genome file
+    """
+
+    def __init__(self, filepath) -> None:
+        self.filepath = filepath
+        with open(filepath, 'rb') as f:
+            if f.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+                raise ValueError(f'Not a packed genome file: {filepath}')
+            self.header = json.loads(f.read(PACKED_HEADER_SIZE - len(PACKED_MAGIC)).rstrip(b' '))
+
+        self.bits = self.header['bits']
+        self.chroms = {chrom['name']: chrom for chrom in self.header['chroms']}
+        num_bases = self.header['num_bases']
+        data_size = num_bases if self.bits == 8 else num_bases // 4
+        self.data = np.memmap(filepath, dtype=np.uint8, mode='r', offset=self.header['data_offset'], shape=(data_size, ))
+        self.mask = np.memmap(filepath, dtype=np.uint8, mode='r', offset=self.header['mask_offset'], shape=(num_bases // 8, )) if self.bits == 2 else None
+
+    def load(self, chroms=None):
+        """
+        Copies the data and N-mask (None for bits=8) of chromosomes into memory.
+
+        Args:
+            chroms (list): Names of the chromosomes to load, defaults to all chromosomes
+
+        Returns:
+            tuple: data, mask and the loaded chromosomes with their offsets (in bases) into data
+        """
+
+        if chroms is None:
+            return np.array(self.data), (np.array(self.mask) if self.bits == 2 else None), list(self.chroms.values())
+
+        bases_per_byte = 1 if self.bits == 8 else 4
+        data, mask, loaded, offset = [], [], [], 0
+        for name in chroms:
+            if name not in self.chroms:
+                raise ValueError(f"Unknown chromosome '{name}'.")
+            chrom = self.chroms[name]
+            # chromosomes are padded to a multiple of 8 bases, i.e. they start at byte boundaries
+            size = -(-chrom['length'] // 8) * 8
+            data.append(self.data[chrom['offset'] // bases_per_byte:(chrom['offset'] + size) // bases_per_byte])
+            if self.bits == 2:
+                mask.append(self.mask[chrom['offset'] // 8:(chrom['offset'] + size) // 8])
+            loaded.append({'name': name, 'offset': offset, 'length': chrom['length']})
+            offset += size
+        empty = np.zeros(0, dtype=np.uint8)
+        return np.concatenate(data or [empty]), (np.concatenate(mask or [empty]) if self.bits == 2 else None), loaded
+
+    @property
+    def nbytes(self):
+        """Size of the data and N-mask (in bytes), i.e. the memory held by a `PackedFasta` of all chromosomes with in_memory."""
+        return self.data.nbytes + (self.mask.nbytes if self.bits == 2 else 0)
+
+    def codes(self, positions):
+        """Returns the codes (0-3 for A, C, G, T and 4 for everything else) of bases at global positions."""
+        if self.bits == 8:
+            return np.asarray(self.data[positions])
+        codes = (self.data[positions // 4] >> (2*(positions % 4)).astype(np.uint8)) & 3
+        is_n = (self.mask[positions // 8] >> (positions % 8).astype(np.uint8)) & 1
+        return np.where(is_n == 1, N_CODE, codes).astype(np.uint8)
+
+    def fetch(self, chrom, start, end):
+        """Returns the codes of bases [start, end) of a chromosome (end is clipped to the chromosome length, like pysam)."""
+        chrom = self.chroms[chrom]
+        end = min(end, chrom['length'])
+        return self.codes(chrom['offset'] + np.arange(start, max(start, end), dtype=np.int64))
+
+# %%
+class PackedFasta():
+    """
+    Drop-in replacement for `Fasta`, reading from a packed genome (see `bioio pack-fasta`) with tensorflow ops only.
+
+    By default, the bases of a batch are read from the memory-mapped file by a single numpy_function, i.e. all
+    processes share the genome through the page cache. With in_memory, the genome is copied into a tensor and
+    sequences are sliced by gather in graph mode, which is faster but costs every process that builds the
+    transform (e.g. every worker of `bioio serialize --workers`) 3/8 bytes per base for bits=2 (about 1.2 GB
+    for a human genome) and 1 byte per base for bits=8, unless it is restricted to some chromosomes.
+
+    Args:
+        filepath (str): Path to a packed genome file
+        to_onehot (bool): Return one-hot sequences of shape (L, 4), else strings
+        mask_noncanonical_bases (bool): Map everything except A, C, G, T to N. Packed genomes are always masked,
+            i.e. only True is supported for strings (one-hot rows of non-canonical bases are always zero)
+        in_memory (bool): Copy the genome into a tensor instead of reading the memory-mapped file
+        chroms (list): Names of the chromosomes to load with in_memory, defaults to all chromosomes (intervals 
+            on other chromosomes fail like unknown chromosomes)
+    """
+
+    # reads of the memory-mapped file (or gathers of the in-memory tensor) are safe to be mapped with parallel calls
+    thread_safe = True
+
+    def __init__(self, filepath, to_onehot=True, mask_noncanonical_bases=True, in_memory=False, chroms=None) -> None:
+        if not (to_onehot or mask_noncanonical_bases):
+            raise ValueError('Packed genomes only store A, C, G, T and N, i.e. mask_noncanonical_bases=False is not supported for strings.')
+        self.to_onehot = to_onehot
+        self.mask_noncanonical_bases = mask_noncanonical_bases
+        self.dtype = tf.int8 if to_onehot else tf.string
+
+        self._genome = PackedGenome(filepath)
+        self.bits = self._genome.bits
+        self.in_memory = in_memory
+        if in_memory:
+            data, mask, chroms = self._genome.load(chroms)
+            nbytes = data.nbytes + (mask.nbytes if mask is not None else 0)
+            if nbytes > IN_MEMORY_WARNING_BYTES:
+                warnings.warn(f'PackedFasta copies {nbytes / 2**30:.1f} GB of {filepath} into the memory of this process, restrict chroms or use in_memory=False.')
+            self._data = tf.constant(data)
+            self._mask = tf.constant(mask) if self.bits == 2 else None
+        else:
+            if chroms is not None:
+                raise ValueError('chroms requires in_memory=True.')
+            chroms = list(self._genome.chroms.values())
+        self._chrom_table = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(tf.constant([c['name'] for c in chroms]), tf.range(len(chroms), dtype=tf.int64)), default_value=-1)
+        self._chrom_offsets = tf.constant([c['offset'] for c in chroms], dtype=tf.int64)
+        self._chrom_lengths = tf.constant([c['length'] for c in chroms], dtype=tf.int64)
+
+    def _codes(self, positions):
+        if not self.in_memory:
+            codes = tf.numpy_function(self._genome.codes, inp=[positions], Tout=tf.uint8, stateful=False)
+            return tf.cast(tf.ensure_shape(codes, positions.shape), tf.int32)
+        if self.bits == 8:
+            return tf.cast(tf.gather(self._data, positions), tf.int32)
+        codes = tf.bitwise.bitwise_and(tf.bitwise.right_shift(tf.cast(tf.gather(self._data, positions // 4), tf.int32), tf.cast(2*(positions % 4), tf.int32)), 3)
+        is_n = tf.bitwise.bitwise_and(tf.bitwise.right_shift(tf.cast(tf.gather(self._mask, positions // 8), tf.int32), tf.cast(positions % 8, tf.int32)), 1)
+        return tf.where(is_n == 1, N_CODE, codes)
+
+    def _ranges(self, chrom, start, end):
+        # global start and end positions of (a batch of) intervals, end is clipped to the chromosome length
+        index = self._chrom_table.lookup(chrom)
+        tf.debugging.assert_non_negative(index, message='Unknown chromosome.')
+        offset = tf.gather(self._chrom_offsets, index)
+        start, end = tf.cast(start, tf.int64), tf.minimum(tf.cast(end, tf.int64), tf.gather(self._chrom_lengths, index))
+        return offset + start, offset + tf.maximum(start, end)
+
+    def _encode(self, codes, is_minus):
+        # codes and is_minus have the same (ragged) shape
+        if is_minus is not None:
+            # complement, i.e. A <-> T and C <-> G (N stays N)
+            codes = tf.where(is_minus & (codes < N_CODE), 3 - codes, codes)
+        if self.to_onehot:
+            # all-zero rows for non-canonical bases
+            return tf.one_hot(codes, 4, dtype=self.dtype)
+        return tf.gather(tf.constant([ord(base) for base in 'ACGTN'], dtype=tf.int32), codes)
+
+    def _is_minus(self, strand):
+        tf.debugging.assert_equal(tf.reduce_all((strand == '+') | (strand == '-')), True, message='Unknown strand.')
+        return strand == '-'
+
+    def __call__(self, example):
+        start, end = self._ranges(example['chrom'], example['start'], example['end'])
+        positions = tf.range(start, end)
+        is_minus = None
+        if 'strand' in example:
+            is_minus = self._is_minus(example['strand'])
+            # reverse the positions of '-' strand intervals
+            positions = tf.cond(is_minus, lambda: tf.reverse(positions, axis=[0]), lambda: positions)
+            is_minus = tf.fill(tf.shape(positions), is_minus)
+
+        sequence = self._encode(self._codes(positions), is_minus)
+        if not self.to_onehot:
+            sequence = tf.strings.unicode_encode(sequence, 'UTF-8')
+        return sequence
+
+    def call_batch(self, examples):
+        start, end = self._ranges(examples['chrom'], examples['start'], examples['end'])
+        positions = tf.ragged.range(start, end)
+
+        # on flat values (ops on tf.RaggedTensor are considerably slower)
+        flat_positions, is_minus = positions.flat_values, None
+        if 'strand' in examples:
+            rows = positions.value_rowids()
+            is_minus = tf.gather(self._is_minus(examples['strand']), rows)
+            # mirror the positions of '-' strand intervals, i.e. p in [s, e) maps to s + e - 1 - p
+            flat_positions = tf.where(is_minus, tf.gather(start + end - 1, rows) - flat_positions, flat_positions)
+
+        sequences = positions.with_flat_values(self._encode(self._codes(flat_positions), is_minus))
+        if not self.to_onehot:
+            sequences = tf.strings.unicode_encode(sequences, 'UTF-8')
+        return sequences
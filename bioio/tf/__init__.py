@@ -1,6 +1,21 @@
 # %%
-from . import utils, index, gfile
+from bioio._lazy import lazy_getattr
 
-from .utils import load_tfrecord, dataset_to_tfrecord, dataset_from_iterable
-from .index import index_tfrecord
-from .gfile import GFileTFRecord
\ No newline at end of file
+# %%
+# Disable absl INFO and WARNING log messages
+from absl import logging as absl_logging
+absl_logging.set_verbosity(absl_logging.ERROR)
+
+# %%
+# submodules are imported on first access, since only some of them import tensorflow (e.g. not crc, example and writer)
+_SUBMODULES = ('utils', 'index', 'gfile', 'writer', 'crc', 'example', 'blocks')
+_ATTRIBUTES = {
+    'load_tfrecord': 'utils', 
+    'dataset_to_tfrecord': 'utils', 
+    'dataset_from_iterable': 'utils', 
+    'index_tfrecord': 'index', 
+    'load_indexed_tfrecord': 'index', 
+    'GFileTFRecord': 'gfile',
+}
+
+__getattr__ = lazy_getattr(__name__, _SUBMODULES, _ATTRIBUTES)
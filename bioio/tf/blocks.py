@@ -0,0 +1,301 @@
+# %%
+"""
+Block-compressed TFRecord files, i.e. compressed files that support random access (unlike gzip-compressed TFRecords).
+
+Records (with their usual TFRecord framing and CRCs) are grouped into blocks of about block_size uncompressed bytes
+and every block is compressed on its own. Offsets in the index (see `bioio.tf.index`) refer to the uncompressed
+stream of records, i.e. they are the same as for an uncompressed file, and the index additionally stores the offset
+of the (compressed) block of each record and the offset of the record within the block. Readers keep an LRU cache
+of decompressed blocks. This module must not import tensorflow.
+"""
+
+# %%
+import json
+import mmap
+import zlib
+import struct
+import threading
+import collections
+
+import numpy as np
+
+from .writer import frame_records
+from .crc import check_record
+
+# %%
+# Block-compressed TFRecord format:
+#   - 8 bytes magic (BLOCK_MAGIC)
+#   - JSON header (version, codec, block size, number of records and blocks, offset of the block table), padded to
+#     BLOCK_HEADER_SIZE. The header is written on close, i.e. it is blank for files of an interrupted writer
+#   - blocks of little-endian uint64 compressed length, uint64 uncompressed length and the compressed records
+#   - block table, little-endian int64 array of shape (num_blocks, 2) of the file offset and uncompressed offset of each block
+BLOCK_MAGIC = b'BIOIOBLK'
+BLOCK_HEADER_SIZE = 4096
+BLOCK_INDEX_COLUMNS = ('block_offset', 'in_block_offset')
+DEFAULT_BLOCK_SIZE = 2**20
+
+_BLOCK_HEADER = struct.Struct('<QQ')
+
+# %%
+def get_codec(name, level=None):
+    """Returns (compress, decompress) functions of a codec, i.e. 'zlib' or 'zstd'."""
+    if name == 'zlib':
+        level = -1 if level is None else level
+        return (lambda data: zlib.compress(data, level)), zlib.decompress
+    if name == 'zstd':
+        try:
+            # python >= 3.14
+            from compression import zstd
+            return (lambda data: zstd.compress(data, level)), zstd.decompress
+        except ModuleNotFoundError:
+            pass
+        try:
+            import zstandard
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('Please install zstandard for zstd block compression (e.g. pip install bioio[zstd]). See https://github.com/indygreg/python-zstandard')
+        compressor, decompressor = zstandard.ZstdCompressor(level=3 if level is None else level), zstandard.ZstdDecompressor()
+        return compressor.compress, decompressor.decompress
+    raise ValueError(f"Unknown block compression codec '{name}', expected 'zlib' or 'zstd'.")
+
+# %%
+def is_block_tfrecord(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC
+
+# %%
+class BlockCompression():
+    """
+    Options of block-compressed TFRecord files (used instead of tf.io.TFRecordOptions).
+
+    Args:
+        codec (str): 'zlib' or 'zstd'
+        block_size (int): Uncompressed size (in bytes) at which a block is completed, larger records form a block of their own
+        level (int): Compression level, defaults to the codec's default
+    """
+
+    def __init__(self, codec='zlib', block_size=DEFAULT_BLOCK_SIZE, level=None) -> None:
+        # fail early on unknown or unavailable codecs
+        get_codec(codec, level)
+        self.codec = codec
+        self.block_size = block_size
+        self.level = level
+
+# %%
+class BlockTFRecordWriter():
+    """
+    Writes a block-compressed TFRecord file.
+
+    Args:
+        filepath (str): Path of the file
+        options (BlockCompression): Codec, block size and compression level
+    """
+
+    def __init__(self, filepath, options=None) -> None:
+        self.filepath = filepath
+        self.options = options if options is not None else BlockCompression()
+        self._compress, _ = get_codec(self.options.codec, self.options.level)
+        self._file = open(filepath, 'wb')
+        self._file.write(BLOCK_MAGIC + b' '*(BLOCK_HEADER_SIZE - len(BLOCK_MAGIC)))
+        self._records, self._block_size = [], 0
+        self._blocks = []
+        self.num_records = 0
+        self._uncompressed_offset = 0
+
+    @property
+    def position(self):
+        """Block offset and in-block offset of the next record, i.e. the values of BLOCK_INDEX_COLUMNS."""
+        return {'block_offset': self._file.tell(), 'in_block_offset': self._block_size}
+
+    def write(self, record):
+        record = bytes(record)
+        self._records.append(record)
+        self._block_size += 8 + 4 + len(record) + 4
+        self.num_records += 1
+        if self._block_size >= self.options.block_size:
+            # complete blocks are written right away, i.e. the position of the next record is known
+            self.flush()
+
+    def flush(self):
+        """Compresses and writes the current block."""
+        if not self._records:
+            return
+        data = frame_records(self._records)
+        compressed = self._compress(data)
+        self._blocks.append((self._file.tell(), self._uncompressed_offset))
+        self._file.write(_BLOCK_HEADER.pack(len(compressed), len(data)) + compressed)
+        self._uncompressed_offset += len(data)
+        self._records, self._block_size = [], 0
+
+    def close(self):
+        self.flush()
+        table_offset = self._file.tell()
+        self._file.write(np.array(self._blocks, dtype='<i8').reshape(-1, 2).tobytes())
+
+        header = json.dumps({
+            'version': 1,
+            'codec': self.options.codec,
+            'block_size': self.options.block_size,
+            'num_records': self.num_records,
+            'num_blocks': len(self._blocks),
+            'table_offset': table_offset,
+        }).encode('UTF-8')
+        self._file.seek(len(BLOCK_MAGIC))
+        self._file.write(header)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# %%
+class LRUCache():
+    """Thread-safe LRU cache of (decompressed) blocks, evicted by their total size in bytes."""
+
+    def __init__(self, max_size) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        # loaded outside of the lock, such that threads decompress different blocks concurrently
+        value = load(key)
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = value
+                self.size += len(value)
+                while self.size > self.max_size and len(self._items) > 1:
+                    _, evicted = self._items.popitem(last=False)
+                    self.size -= len(evicted)
+        return value
+
+# %%
+class BlockTFRecordReader():
+    """
+    Random access to the records of a block-compressed TFRecord file, by their offset in the uncompressed stream.
+
+    Args:
+        read (callable): Function of (offset, size) that returns bytes of the file
+        size (int): Size of the file
+        cache_size (int): Maximum size (in bytes) of the LRU cache of decompressed blocks
+    """
+
+    def __init__(self, read, size, cache_size=64*2**20) -> None:
+        self._read = read
+        self.size = size
+        header = bytes(read(len(BLOCK_MAGIC), BLOCK_HEADER_SIZE - len(BLOCK_MAGIC))).rstrip(b' ')
+        if header:
+            self.header = json.loads(header)
+            table = np.frombuffer(bytes(read(self.header['table_offset'], 16*self.header['num_blocks'])), dtype='<i8').reshape(-1, 2)
+        else:
+            # unclosed file (e.g. of an interrupted writer), complete blocks are found by their headers
+            self.header = None
+            table = self._scan_blocks()
+        self.block_offsets, self.block_starts = table[:, 0], table[:, 1]
+        self.num_records = self.header['num_records'] if self.header is not None else None
+        self._decompress = None
+        self._cache = LRUCache(cache_size)
+
+    def _scan_blocks(self):
+        blocks, offset, start = [], BLOCK_HEADER_SIZE, 0
+        while offset + _BLOCK_HEADER.size <= self.size:
+            compressed_size, uncompressed_size = _BLOCK_HEADER.unpack(bytes(self._read(offset, _BLOCK_HEADER.size)))
+            if offset + _BLOCK_HEADER.size + compressed_size > self.size:
+                break
+            blocks.append((offset, start))
+            offset += _BLOCK_HEADER.size + compressed_size
+            start += uncompressed_size
+        return np.array(blocks, dtype=np.int64).reshape(-1, 2)
+
+    @property
+    def codec(self):
+        # unclosed files do not have a header, zlib streams start with 0x78
+        if self.header is not None:
+            return self.header['codec']
+        return 'zlib' if len(self.block_offsets) == 0 or bytes(self._read(int(self.block_offsets[0]) + _BLOCK_HEADER.size, 1)) == b'\x78' else 'zstd'
+
+    def decompress_block(self, i):
+        if self._decompress is None:
+            _, self._decompress = get_codec(self.codec)
+        offset = int(self.block_offsets[i])
+        compressed_size, _ = _BLOCK_HEADER.unpack(bytes(self._read(offset, _BLOCK_HEADER.size)))
+        return self._decompress(bytes(self._read(offset + _BLOCK_HEADER.size, compressed_size)))
+
+    def block(self, i):
+        """Decompressed block i (from the LRU cache)."""
+        return self._cache.get(int(i), self.decompress_block)
+
+    def read_record(self, offset, validate=False):
+        """Returns the proto of the record at an offset of the uncompressed stream (a memoryview of the cached block)."""
+        i = np.searchsorted(self.block_starts, offset, side='right') - 1
+        if i < 0:
+            raise ValueError(f'Invalid record offset {offset}.')
+        data = memoryview(self.block(i))
+        local_offset = int(offset - self.block_starts[i])
+        return _read_framed_record(data, local_offset, validate, offset)
+
+    def iter_records(self, validate=False):
+        """Yields the protos of all records, block by block (without caching blocks)."""
+        for proto, _, _ in self.iter_positions(validate):
+            yield proto
+
+    def iter_positions(self, validate=False):
+        """Yields (proto, block offset, in-block offset) of all records, e.g. to index the file."""
+        for i in range(len(self.block_offsets)):
+            data, local_offset = memoryview(self.decompress_block(i)), 0
+            while local_offset < len(data):
+                proto = _read_framed_record(data, local_offset, validate, int(self.block_starts[i]) + local_offset)
+                yield proto, int(self.block_offsets[i]), local_offset
+                local_offset += 8 + 4 + len(proto) + 4
+
+# %%
+def _read_framed_record(data, offset, validate, global_offset):
+    proto_len = struct.unpack_from('<Q', data, offset)[0]
+    if offset + 8 + 4 + proto_len + 4 > len(data):
+        raise ValueError(f'Truncated record at offset {global_offset}.')
+    proto = data[offset + 8 + 4:offset + 8 + 4 + proto_len]
+    if validate:
+        check_record(data[offset:offset + 8 + 4], proto, data[offset + 8 + 4 + proto_len:offset + 8 + 4 + proto_len + 4], global_offset)
+    return proto
+
+# %%
+def open_block_tfrecord(filepath, cache_size=64*2**20):
+    """Opens a (local) block-compressed TFRecord file for random access."""
+    with open(filepath, 'rb') as f:
+        buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return BlockTFRecordReader(lambda offset, size: buffer[offset:offset + size], len(buffer), cache_size=cache_size)
+
+# %%
+def iter_block_records(fileobj):
+    """Yields the protos of all records of a block-compressed TFRecord file, read sequentially from a file object (e.g. a tf.io.gfile.GFile)."""
+    if fileobj.read(len(BLOCK_MAGIC)) != BLOCK_MAGIC:
+        raise ValueError('Not a block-compressed TFRecord file.')
+    header = fileobj.read(BLOCK_HEADER_SIZE - len(BLOCK_MAGIC)).rstrip(b' ')
+    header = json.loads(header) if header else None
+    end = header['table_offset'] if header is not None else None
+
+    decompress, offset = None, BLOCK_HEADER_SIZE
+    while end is None or offset < end:
+        block_header = fileobj.read(_BLOCK_HEADER.size)
+        if len(block_header) < _BLOCK_HEADER.size:
+            break
+        compressed_size, _ = _BLOCK_HEADER.unpack(block_header)
+        compressed = fileobj.read(compressed_size)
+        if len(compressed) < compressed_size:
+            # incomplete block of an interrupted writer
+            break
+        if decompress is None:
+            codec = header['codec'] if header is not None else ('zlib' if compressed[:1] == b'\x78' else 'zstd')
+            _, decompress = get_codec(codec)
+        data, local_offset = memoryview(decompress(compressed)), 0
+        while local_offset < len(data):
+            proto = _read_framed_record(data, local_offset, False, local_offset)
+            yield bytes(proto)
+            local_offset += 8 + 4 + len(proto) + 4
+        offset += _BLOCK_HEADER.size + compressed_size
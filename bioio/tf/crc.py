@@ -0,0 +1,191 @@
+# %%
+"""
+CRC32C (Castagnoli) checksums, as used by the TFRecord format.
+
+Uses the `google_crc32c` or `crc32c` package if installed (recommended, hardware accelerated). Otherwise,
+falls back to a table-driven (slicing-by-4) NumPy implementation that processes many buffers at once,
+i.e. one vectorized step per 4 bytes of the longest buffer instead of a python loop over every byte.
+"""
+
+# %%
+import struct
+
+import numpy as np
+
+# %%
+try:
+    import google_crc32c
+    _crc32c = lambda data: google_crc32c.value(bytes(data))
+    CRC32C_BACKEND = 'google_crc32c'
+except ModuleNotFoundError:
+    try:
+        import crc32c as _crc32c_module
+        _crc32c = lambda data: _crc32c_module.crc32c(data)
+        CRC32C_BACKEND = 'crc32c'
+    except ModuleNotFoundError:
+        _crc32c = None
+        CRC32C_BACKEND = 'numpy'
+
+# %%
+_POLY = 0x82F63B78 # reversed Castagnoli polynomial
+_MASK_DELTA = 0xA282EAD8
+
+def _make_tables():
+    tables = np.zeros((4, 256), dtype=np.uint32)
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (_POLY if crc & 1 else 0)
+        tables[0, i] = crc
+    for k in range(1, 4):
+        tables[k] = (tables[k - 1] >> 8) ^ tables[0][tables[k - 1] & 0xFF]
+    return tables
+
+_TABLES = _make_tables()
+
+# %%
+def _crc32c_register(data, crc=0xFFFFFFFF):
+    # bytewise update of a CRC register, only used for buffers shorter than 4 bytes
+    for b in bytes(data):
+        crc = int(_TABLES[0][(crc ^ b) & 0xFF]) ^ (crc >> 8)
+    return crc
+
+# %%
+def _crc32c_words(words):
+    # slicing-by-4 from a zero register, one vectorized step per column of 32-bit words
+    crc = np.zeros(words.shape[0], dtype=np.uint32)
+    for j in range(words.shape[1]):
+        crc = crc ^ words[:, j]
+        crc = _TABLES[3][crc & 0xFF] ^ _TABLES[2][(crc >> 8) & 0xFF] ^ _TABLES[1][(crc >> 16) & 0xFF] ^ _TABLES[0][crc >> 24]
+    return crc
+
+# %%
+def _crc32c_numpy_batch(buffers):
+    """CRC32C of a list of buffers of similar length, vectorized over buffers."""
+    lengths = np.array([len(b) for b in buffers], dtype=np.int64)
+    width = int(-(-lengths.max() // 4) * 4)
+
+    # Left-pad buffers with zeros to a common width (a multiple of 4). A zero register is not changed by leading 
+    # zeros, and processing data from the initial register (0xFFFFFFFF) is the same as processing it from a zero 
+    # register with the first 4 bytes XOR'ed with 0xFF.
+    matrix = np.zeros((len(buffers), width), dtype=np.uint8)
+    for i, b in enumerate(buffers):
+        if len(b) > 0:
+            matrix[i, width - len(b):] = np.frombuffer(b, dtype=np.uint8)
+    long = np.nonzero(lengths >= 4)[0]
+    matrix[long[:, None], (width - lengths[long])[:, None] + np.arange(4)] ^= 0xFF
+
+    crc = _crc32c_words(matrix.view('<u4'))
+    for i in np.nonzero(lengths < 4)[0]:
+        crc[i] = _crc32c_register(buffers[i])
+    return crc ^ np.uint32(0xFFFFFFFF)
+
+# %%
+def _apply_operator(operator, crc):
+    out = 0
+    for bit in range(32):
+        if (crc >> bit) & 1:
+            out ^= operator[bit]
+    return out
+
+def _zeros_operator(n):
+    # linear operator (as the images of the 32 register bits) that advances a CRC register over n zero bytes
+    operator = [_crc32c_register(b'\x00', 1 << bit) for bit in range(32)]
+    result = [1 << bit for bit in range(32)]
+    while n > 0:
+        if n & 1:
+            result = [_apply_operator(operator, x) for x in result]
+        operator = [_apply_operator(operator, x) for x in operator]
+        n >>= 1
+    return result
+
+# %%
+_CHUNK_SIZE = 4096
+
+def _crc32c_numpy_long(data):
+    """CRC32C of a single long buffer, vectorized over fixed-size chunks that are combined afterwards."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    num_chunks = -(-len(data) // _CHUNK_SIZE)
+    pad = num_chunks * _CHUNK_SIZE - len(data)
+
+    flat = np.zeros(num_chunks * _CHUNK_SIZE, dtype=np.uint8)
+    flat[pad:] = data
+    flat[pad:pad + 4] ^= 0xFF
+    crcs = _crc32c_words(flat.reshape(num_chunks, _CHUNK_SIZE).view('<u4'))
+
+    # crc(a + b) = shift(crc(a), len(b)) ^ crc(b), for zero initial registers
+    shift = _zeros_operator(_CHUNK_SIZE)
+    crc = 0
+    for chunk_crc in crcs.tolist():
+        crc = _apply_operator(shift, crc) ^ chunk_crc
+    return crc ^ 0xFFFFFFFF
+
+# %%
+def crc32c(data):
+    """CRC32C of a bytes-like object."""
+    if _crc32c is not None:
+        return _crc32c(data)
+    if len(data) > 4*_CHUNK_SIZE:
+        return _crc32c_numpy_long(data)
+    return int(_crc32c_numpy_batch([data])[0])
+
+# %%
+def crc32c_batch(buffers):
+    """CRC32C of a list of bytes-like objects, returned as numpy.array of uint32."""
+    if _crc32c is not None:
+        return np.array([_crc32c(b) for b in buffers], dtype=np.uint32)
+
+    crcs = np.zeros(len(buffers), dtype=np.uint32)
+    lengths = np.array([len(b) for b in buffers], dtype=np.int64)
+
+    # long buffers are vectorized over their chunks
+    for i in np.nonzero(lengths > 4*_CHUNK_SIZE)[0]:
+        crcs[i] = _crc32c_numpy_long(buffers[i])
+
+    # other buffers are vectorized over groups of buffers of similar length (to limit zero-padding)
+    group = []
+    for i in np.argsort(lengths, kind='stable'):
+        if lengths[i] > 4*_CHUNK_SIZE:
+            break
+        if group and lengths[i] > 2*lengths[group[0]] + 64:
+            crcs[group] = _crc32c_numpy_batch([buffers[j] for j in group])
+            group = []
+        group.append(i)
+    if group:
+        crcs[group] = _crc32c_numpy_batch([buffers[j] for j in group])
+    return crcs
+
+# %%
+def mask(crc):
+    """Masks a CRC as done by the TFRecord format (rotate right by 15 bits and add a constant)."""
+    crc = np.asarray(crc, dtype=np.uint64)
+    return (((crc >> np.uint64(15)) | (crc << np.uint64(17))) + np.uint64(_MASK_DELTA)) & np.uint64(0xFFFFFFFF)
+
+# %%
+def masked_crc32c(data):
+    return int(mask(crc32c(data)))
+
+# %%
+def masked_crc32c_batch(buffers):
+    return mask(crc32c_batch(buffers)).astype(np.uint32)
+
+# %%
+def check_record(header, proto, proto_crc, offset=0):
+    """
+    Checks the CRCs of a TFRecord record and raises a ValueError on mismatch or if the record is truncated.
+
+    Args:
+        header (bytes): 8 bytes proto length followed by 4 bytes masked length CRC
+        proto (bytes): Proto bytes
+        proto_crc (bytes): 4 bytes masked proto CRC
+        offset (int): Offset of the record, for the error message
+    """
+
+    if len(header) < 12:
+        raise ValueError(f'Truncated record at offset {offset}.')
+    if masked_crc32c(header[:8]) != struct.unpack('<I', header[8:12])[0]:
+        raise ValueError(f'Corrupted record at offset {offset}: length CRC mismatch.')
+    if len(proto) < struct.unpack('<Q', header[:8])[0] or len(proto_crc) < 4:
+        raise ValueError(f'Truncated record at offset {offset}.')
+    if masked_crc32c(proto) != struct.unpack('<I', proto_crc)[0]:
+        raise ValueError(f'Corrupted record at offset {offset}: data CRC mismatch.')
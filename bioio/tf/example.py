@@ -0,0 +1,319 @@
+# %%
+"""
+TensorFlow-free decoding of serialized tf.train.Example protos to numpy.
+
+The decoder is compiled from a features specification (i.e. the content of a .features.json file, as written
+by `features_to_json_file`) and parses the protobuf wire format directly. This module must not import
+tensorflow (or tensorflow_datasets).
+"""
+
+# %%
+import json
+import zlib
+
+import numpy as np
+
+# %%
+_FEATURES_DICT = 'tensorflow_datasets.core.features.features_dict.FeaturesDict'
+_TENSOR = 'tensorflow_datasets.core.features.tensor_feature.Tensor'
+
+# protobuf wire types
+_VARINT, _FIXED64, _LENGTH_DELIMITED, _FIXED32 = 0, 1, 2, 5
+
+# %%
+def _read_varint(buffer, pos):
+    result, shift = 0, 0
+    while True:
+        b = buffer[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+# %%
+def _iter_fields(buffer, start, end):
+    """Yields (field number, wire type, value) of a message, where value is a (start, end) tuple for length-delimited fields."""
+    pos = start
+    while pos < end:
+        tag, pos = _read_varint(buffer, pos)
+        field, wire_type = tag >> 3, tag & 0x7
+        if wire_type == _VARINT:
+            value, pos = _read_varint(buffer, pos)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _read_varint(buffer, pos)
+            value, pos = (pos, pos + length), pos + length
+        elif wire_type == _FIXED64:
+            value, pos = buffer[pos:pos + 8], pos + 8
+        elif wire_type == _FIXED32:
+            value, pos = buffer[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type: {wire_type}')
+        yield field, wire_type, value
+
+# %%
+def _decode_packed_varints(data):
+    # vectorized decoding of packed (unsigned) varints, returns int64
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last = data < 0x80
+    starts = np.concatenate([[0], np.nonzero(last)[0][:-1] + 1])
+    position = np.arange(len(data)) - np.repeat(starts, np.diff(np.append(starts, len(data))))
+    parts = (data & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts).view(np.int64)
+
+# %%
+def parse_example(proto, keys=None):
+    """
+    Parses a serialized tf.train.Example to a flat dict of feature name to a tuple (kind, values), where
+    kind is 'bytes' (list of bytes), 'float' (numpy.array of float32) or 'int64' (numpy.array of int64).
+
+    Args:
+        proto (bytes): Serialized example
+        keys (set): Optional names of the features to parse, all other features are skipped
+    """
+
+    buffer = memoryview(proto)
+    features = {}
+    for field, _, (start, end) in _iter_fields(buffer, 0, len(buffer)):
+        if field != 1: # Example.features
+            continue
+        for field, _, (entry_start, entry_end) in _iter_fields(buffer, start, end):
+            if field != 1: # Features.feature (map entry)
+                continue
+            key, value_span = None, None
+            for field, _, span in _iter_fields(buffer, entry_start, entry_end):
+                if field == 1:
+                    key = bytes(buffer[span[0]:span[1]]).decode('UTF-8')
+                elif field == 2:
+                    value_span = span
+            if keys is not None and key not in keys:
+                continue
+            features[key] = _parse_feature(buffer, *value_span) if value_span is not None else None
+    return features
+
+# %%
+def _write_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+# %%
+def _length_delimited(field, payload):
+    return _write_varint((field << 3) | _LENGTH_DELIMITED) + _write_varint(len(payload)) + payload
+
+# %%
+def feature_entries(proto):
+    """
+    Splits a serialized tf.train.Example into its feature map entries, without parsing the features.
+
+    Returns:
+        dict: Feature name to the serialized map entry (i.e. key and Feature message)
+    """
+
+    buffer = memoryview(proto)
+    entries = {}
+    for field, _, (start, end) in _iter_fields(buffer, 0, len(buffer)):
+        if field != 1: # Example.features
+            continue
+        for field, _, (entry_start, entry_end) in _iter_fields(buffer, start, end):
+            if field != 1: # Features.feature (map entry)
+                continue
+            for field, _, (key_start, key_end) in _iter_fields(buffer, entry_start, entry_end):
+                if field == 1:
+                    # later entries of the same key replace earlier ones (protobuf merge semantics)
+                    entries[bytes(buffer[key_start:key_end]).decode('UTF-8')] = buffer[entry_start:entry_end]
+                    break
+    return entries
+
+# %%
+def parse_feature_entry(entry):
+    """Parses a serialized feature map entry (see `feature_entries`) to (kind, values), like the values of `parse_example`."""
+    buffer = memoryview(entry)
+    for field, _, span in _iter_fields(buffer, 0, len(buffer)):
+        if field == 2:
+            return _parse_feature(buffer, *span)
+    return 'bytes', []
+
+# %%
+def serialize_feature_entries(entries):
+    """
+    Serializes a dict of feature name to map entry (see `feature_entries`) to a tf.train.Example.
+
+    Entries are written in the order of their keys, i.e. the result is the same as a deterministic serialization
+    of the example (see `bioio.tf.utils.serialize_example`).
+    """
+    features = b''.join(_length_delimited(1, bytes(entries[key])) for key in sorted(entries))
+    return _length_delimited(1, features)
+
+# %%
+def _parse_feature(buffer, start, end):
+    for kind, _, (list_start, list_end) in _iter_fields(buffer, start, end):
+        if kind == 1: # BytesList
+            return 'bytes', [buffer[s:e] for _, _, (s, e) in _iter_fields(buffer, list_start, list_end)]
+
+        values = []
+        for _, wire_type, value in _iter_fields(buffer, list_start, list_end):
+            if kind == 2: # FloatList, packed or not
+                values.append(np.frombuffer(buffer[value[0]:value[1]] if wire_type == _LENGTH_DELIMITED else value, dtype='<f4'))
+            elif kind == 3: # Int64List, packed or not
+                values.append(_decode_packed_varints(buffer[value[0]:value[1]]) if wire_type == _LENGTH_DELIMITED else np.array([value], dtype=np.uint64).view(np.int64))
+        values = np.concatenate(values) if values else np.zeros(0, dtype=(np.float32 if kind == 2 else np.int64))
+        return ('float' if kind == 2 else 'int64'), values
+
+    # empty feature
+    return 'bytes', []
+
+# %%
+class TensorDecoder():
+    """Decodes a single tfds Tensor feature (encoding 'none', 'bytes' or 'zlib')."""
+
+    def __init__(self, name, shape, dtype, encoding='none') -> None:
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.encoding = encoding
+        self.dynamic_shape = self.shape.count(None) > 1
+        self.np_dtype = None if dtype == 'string' else np.dtype(dtype)
+
+    @classmethod
+    def from_json_content(cls, name, content):
+        shape = [None if int(d) == -1 else int(d) for d in content.get('shape', {}).get('dimensions', [])]
+        return cls(name, shape, content['dtype'], content.get('encoding', 'none'))
+
+    @property
+    def keys(self):
+        """Names of the proto features of the tensor."""
+        return (self.name + '/shape', self.name + '/value') if self.dynamic_shape else (self.name, )
+
+    def _shape(self, features):
+        if self.dynamic_shape:
+            _, shape = features[self.name + '/shape']
+            return tuple(int(d) for d in shape)
+        return tuple(-1 if d is None else d for d in self.shape)
+
+    def length(self, features):
+        """
+        Size of the first dimension of the tensor, from its serialized shape or the size of its values, i.e. 
+        without decoding (or, for 'bytes' encoding, copying) the values.
+        """
+
+        if self.shape == ():
+            raise ValueError(f"Feature '{self.name}' is a scalar.")
+        if self.dynamic_shape:
+            return self._shape(features)[0]
+        if self.shape[0] is not None:
+            return self.shape[0]
+
+        key = self.name
+        if key not in features:
+            raise ValueError(f"Feature '{key}' not found in example.")
+        _, values = features[key]
+        if self.encoding in ('bytes', 'zlib'):
+            data = values[0] if self.encoding == 'bytes' else zlib.decompress(values[0])
+            size = len(data) // self.np_dtype.itemsize
+        else:
+            size = len(values)
+        return size // int(np.prod(self.shape[1:], dtype=np.int64))
+
+    def __call__(self, features):
+        key = (self.name + '/value') if self.dynamic_shape else self.name
+        if key not in features:
+            raise ValueError(f"Feature '{key}' not found in example.")
+        _, values = features[key]
+
+        if self.encoding in ('bytes', 'zlib'):
+            data = values[0]
+            if self.encoding == 'zlib':
+                data = zlib.decompress(data)
+            # bytearray, such that the returned array is writable (e.g. for torch.from_numpy)
+            return np.frombuffer(bytearray(data), dtype=self.np_dtype).reshape(self._shape(features))
+
+        if self.dtype == 'string':
+            values = [bytes(value) for value in values]
+            return values[0] if self.shape == () else np.array(values, dtype=object).reshape(self._shape(features))
+
+        if self.np_dtype == np.uint64:
+            # uint64 is stored bitcasted to int64
+            values = values.view(np.uint64)
+        values = values.astype(self.np_dtype)
+        return values.reshape(()) if self.shape == () else values.reshape(self._shape(features))
+
+# %%
+def select_paths(paths, names):
+    """
+    Selects feature paths by flattened names (see `bioio.utils.flatten_dict`), e.g. 'inputs/sequence' selects a
+    single tensor and 'outputs' all tensors of a nested FeaturesDict.
+
+    Args:
+        paths (list): Paths (tuples of keys) of all tensors
+        names (list): Flattened names of the features to select
+
+    Returns:
+        list: Selected paths, in the order of paths
+    """
+
+    selected = set()
+    for name in names:
+        prefix = tuple(name.strip('/').split('/'))
+        matches = [path for path in paths if path[:len(prefix)] == prefix]
+        if not matches:
+            raise ValueError(f"Unknown feature '{name}', expected one of {['/'.join(path) for path in paths]}.")
+        selected.update(matches)
+    return [path for path in paths if path in selected]
+
+# %%
+class ExampleDecoder():
+    """
+    Decodes serialized tf.train.Example protos to (nested dicts of) numpy arrays, without tensorflow.
+
+    Args:
+        features_json (dict): Features specification, i.e. the content of a .features.json file
+        features (list): Optional flattened names of the features to decode (see `select_paths`), all other 
+            features are skipped without being parsed or decompressed
+    """
+
+    def __init__(self, features_json, features=None) -> None:
+        self.features_json = features_json
+        self.decoders = {}
+        self._compile(self._features_dict_content(features_json), ())
+        self.keys = None
+        if features is not None:
+            self.decoders = {path: self.decoders[path] for path in select_paths(list(self.decoders), features)}
+            self.keys = set(key for decoder in self.decoders.values() for key in decoder.keys)
+
+    @classmethod
+    def from_json_file(cls, filepath, features=None):
+        with open(filepath) as f:
+            return cls(json.load(f), features=features)
+
+    @staticmethod
+    def _features_dict_content(features_json):
+        # top-level FeaturesDict
+        if features_json.get('type') != _FEATURES_DICT:
+            raise ValueError(f"Expected a FeaturesDict, but got {features_json.get('type')}.")
+        return features_json['content']['features']
+
+    def _compile(self, features, path):
+        for key, feature in features.items():
+            class_name = feature.get('pythonClassName')
+            if class_name == _FEATURES_DICT:
+                self._compile(feature['featuresDict']['features'], path + (key, ))
+            elif class_name == _TENSOR:
+                self.decoders[path + (key, )] = TensorDecoder.from_json_content('/'.join(path + (key, )), feature['tensor'])
+            else:
+                raise NotImplementedError(f'Unsupported feature type: {class_name}')
+
+    def __call__(self, proto):
+        features = parse_example(proto, keys=self.keys)
+        example = {}
+        for path, decoder in self.decoders.items():
+            nested = example
+            for key in path[:-1]:
+                nested = nested.setdefault(key, {})
+            nested[path[-1]] = decoder(features)
+        return example
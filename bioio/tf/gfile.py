@@ -1,23 +1,74 @@
+import os
+import mmap
 import struct
+import threading
 
 import tensorflow as tf
 import numpy as np
 from tensorflow_datasets.core.features.features_dict import FeaturesDict
 
 import bioio
+from .crc import check_record
+from .blocks import BLOCK_MAGIC, BlockTFRecordReader
+from .example import ExampleDecoder
+from .utils import select_features, features_to_json
+
+# %%
+def is_local_file(filepath):
+    return ('://' not in filepath or filepath.startswith('file://')) and os.path.isfile(filepath.removeprefix('file://'))
 
 # %%
 class GFileTFRecord:
-    def __init__(self, filepath, features=None, index=None):
-        self._gfile_tfrecord = tf.io.gfile.GFile(filepath, 'rb')
+    """
+    Random-access reader for (uncompressed or block-compressed) TFRecord files. 
+
+    Local files are memory-mapped, such that records are returned as zero-copy memoryview slices and 
+    concurrent lookups (e.g. from multiple threads) do not share a file position. Records that are used after 
+    close() must be copied with bytes(), since a referenced memoryview keeps the file mapped. Other filesystems 
+    (e.g. gs://) are read through a tf.io.gfile.GFile handle, guarded by a lock. Block-compressed files 
+    (see `bioio.tf.blocks`) are detected by their magic bytes, offsets are offsets in the uncompressed 
+    records (as in their index) and decompressed blocks are kept in an LRU cache.
+
+    Args:
+        filepath (str): Path to the TFRecord file
+        features (str or FeaturesDict): Features (or path to a .features.json file) used for deserialization
+        index (str or numpy.array): Record offsets (or path to an index file)
+        use_mmap (bool): Memory-map the file. Defaults to True for local files.
+        validate (bool): Check the CRCs of every record read (default for calls that do not specify it)
+        to_numpy (bool): Deserialize records to numpy arrays, using the tensorflow-free ExampleDecoder (default for calls that do not specify it)
+        select (list): Optional flattened names of the features to deserialize (e.g. ['inputs/sequence']), all other 
+            features are skipped without being parsed or decompressed
+        block_cache_mb (int): Size of the cache of decompressed blocks (in MB), for block-compressed files
+    """
+
+    def __init__(self, filepath, features=None, index=None, use_mmap=None, validate=False, to_numpy=False, select=None, block_cache_mb=64):
+        self.filepath = filepath
+        self.validate = validate
+        self.to_numpy = to_numpy
+        self.use_mmap = is_local_file(filepath) if use_mmap is None else use_mmap
+        if self.use_mmap:
+            with open(filepath.removeprefix('file://'), 'rb') as f:
+                # mmap of an empty file is not allowed
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else b''
+            self._buffer = memoryview(self._mmap)
+        else:
+            self._gfile_tfrecord = tf.io.gfile.GFile(filepath, 'rb')
+            self._lock = threading.Lock()
+        self._blocks = self._open_blocks(block_cache_mb)
+        self._features_spec = features
+        self._decoder = None
+        self.select = select
         self.features = self._read_features(features) if features is not None else None
+        if self.features is not None and select is not None:
+            self.features = select_features(self.features, select)
         self.index = self._read_index(index) if index is not None else None
 
-    def __call__(self, offset, deserialize=True, to_numpy=False, to_torch=False, validate=False):
+    def __call__(self, offset, deserialize=True, to_numpy=None, to_torch=False, validate=None):
+        validate = self.validate if validate is None else validate
         try:
             proto = self._read_proto(offset, validate)
-        except:
-            raise ValueError(f'Invalid record at offset {offset}.')
+        except Exception as e:
+            raise ValueError(f'Invalid record at offset {offset}.') from e
         
         if (self.features is None) or (not deserialize):
             return proto
@@ -28,17 +79,44 @@ class GFileTFRecord:
         if self.index is None:
             raise ValueError('Index not specified.')
         return self(self.index[idx], **kwargs)
+
+    def get_many(self, indices, **kwargs):
+        """
+        Returns the records at the given indices (in the given order). Records are read in order of their 
+        offsets, i.e. as sequential as possible.
+        """
+
+        if self.index is None:
+            raise ValueError('Index not specified.')
+        offsets = np.asarray(self.index)[np.asarray(indices, dtype=np.int64)]
+        records = [None] * len(offsets)
+        for i in np.argsort(offsets, kind='stable'):
+            records[i] = self(offsets[i], **kwargs)
+        return records
     
     def __iter__(self):
-        while True:
-            try:
-                proto = self._read_next_proto()
-                if self.features is None:
-                    yield proto
-                else:
-                    yield self.deserialize(proto)
-            except:
-                break
+        if self._blocks is not None:
+            for proto in self._blocks.iter_records(self.validate):
+                yield proto if self.features is None else self.deserialize(proto)
+        elif self.use_mmap:
+            offset = 0
+            while offset < len(self._buffer):
+                proto = self._read_proto(offset, self.validate)
+                offset += 8 + 4 + len(proto) + 4
+                yield proto if self.features is None else self.deserialize(proto)
+        else:
+            while True:
+                try:
+                    with self._lock:
+                        proto = self._read_next_proto(self.validate)
+                    if proto is None:
+                        break
+                    if self.features is None:
+                        yield proto
+                    else:
+                        yield self.deserialize(proto)
+                except:
+                    break
     
     def __len__(self):
         if self.index is not None:
@@ -56,9 +134,29 @@ class GFileTFRecord:
             n += 1
         return n
 
+    def close(self):
+        if self.use_mmap:
+            self._buffer.release()
+            if isinstance(self._mmap, mmap.mmap):
+                try:
+                    self._mmap.close()
+                except BufferError:
+                    # records returned as memoryview slices are still referenced, the file is unmapped once they are 
+                    # garbage collected
+                    pass
+            self._buffer, self._mmap = None, None
+        else:
+            self._gfile_tfrecord.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @property
     def size(self):
-        return self._gfile_tfrecord.size()
+        return len(self._buffer) if self.use_mmap else self._gfile_tfrecord.size()
 
     def as_tf_data_iterator(self, shuffle=False):
         raise NotImplementedError()
@@ -69,25 +167,70 @@ class GFileTFRecord:
     def as_torch_iterator(self, shuffle=False):
         raise NotImplementedError()
 
-    def deserialize(self, proto, to_numpy=False, to_torch=False):
+    @property
+    def decoder(self):
+        if self._decoder is None:
+            if isinstance(self._features_spec, str):
+                self._decoder = ExampleDecoder.from_json_file(self._features_spec, features=self.select)
+            else:
+                self._decoder = ExampleDecoder(features_to_json(self.features))
+        return self._decoder
+
+    def deserialize(self, proto, to_numpy=None, to_torch=False):
+        to_numpy = self.to_numpy if to_numpy is None else to_numpy
         assert not (to_numpy and to_torch), 'Cannot convert to both numpy and torch.'
 
         if self.features is None:
             raise ValueError('Features not specified.')
         
-        example = self.features.deserialize_example(proto)
-        if to_numpy:
-            example = tf.nest.map_structure(lambda x: x.numpy(), example)
-        if to_torch:
-            example = tf.nest.map_structure(lambda x: bioio.torch.utils.numpy_to_torch(x.numpy()), example)
-        return example
+        if to_numpy or to_torch:
+            # decode directly to numpy, without tensorflow ops
+            example = self.decoder(proto)
+            if to_torch:
+                example = tf.nest.map_structure(bioio.torch.utils.numpy_to_torch, example)
+            return example
+
+        if isinstance(proto, memoryview):
+            proto = proto.tobytes()
+        return self.features.deserialize_example(proto)
     
+    def _open_blocks(self, block_cache_mb):
+        # reader of block-compressed files, None for uncompressed files
+        if self.size < len(BLOCK_MAGIC) or bytes(self._read_bytes(0, len(BLOCK_MAGIC))) != BLOCK_MAGIC:
+            return None
+        return BlockTFRecordReader(self._read_bytes, self.size, cache_size=block_cache_mb*2**20)
+
+    def _read_bytes(self, offset, size):
+        if self.use_mmap:
+            return self._buffer[offset:offset + size]
+        with self._lock:
+            self._gfile_tfrecord.seek(offset)
+            return self._gfile_tfrecord.read(size)
+
     def _read_proto(self, offset, validate=False):
-        # seek to offset
-        self._gfile_tfrecord.seek(offset)
-        return self._read_next_proto(validate)
+        if self._blocks is not None:
+            return self._blocks.read_record(int(offset), validate)
+        if self.use_mmap:
+            return self._read_mmap_proto(int(offset), validate)
+
+        with self._lock:
+            # seek to offset
+            self._gfile_tfrecord.seek(offset)
+            return self._read_next_proto(validate)
+
+    def _read_mmap_proto(self, offset, validate=False):
+        # proto length, proto length crc, proto bytes, proto bytes crc
+        proto_len = struct.unpack_from('q', self._buffer, offset)[0]
+        if offset + 8 + 4 + proto_len + 4 > len(self._buffer):
+            raise ValueError(f'Truncated record at offset {offset}.')
+        proto = self._buffer[offset + 8 + 4:offset + 8 + 4 + proto_len]
+        if validate:
+            check_record(self._buffer[offset:offset + 8 + 4], proto, self._buffer[offset + 8 + 4 + proto_len:offset + 8 + 4 + proto_len + 4], offset)
+        return proto
     
     def _read_next_proto(self, validate=False):
+        offset = self._gfile_tfrecord.tell()
+
         # get proto length
         proto_len_bytes = self._gfile_tfrecord.read(8)
         if len(proto_len_bytes) == 0:
@@ -96,16 +239,16 @@ class GFileTFRecord:
 
         # proto length crc
         proto_len_crc = self._gfile_tfrecord.read(4)
-        if validate:
-            raise NotImplementedError('CRC validation not implemented.')
 
         # proto bytes
         proto_bytes = self._gfile_tfrecord.read(proto_len)
 
         # proto bytes crc
         proto_bytes_crc = self._gfile_tfrecord.read(4)
+        if len(proto_bytes) != proto_len or len(proto_bytes_crc) != 4:
+            raise ValueError(f'Truncated record at offset {offset}.')
         if validate:
-            raise NotImplementedError('CRC validation not implemented.')
+            check_record(proto_len_bytes + proto_len_crc, proto_bytes, proto_bytes_crc, offset)
         
         return proto_bytes
 
@@ -1,16 +1,193 @@
 # %%
+import os
+import sys
+import json
 import struct
 
 import tqdm
-import pandas as pd
 import numpy as np
-import tensorflow as tf
 
-from .utils import features_from_json_file
+from .crc import check_record
+# pandas, tensorflow and the TFRecord readers are imported where needed, i.e. writing and reading binary indices 
+# (e.g. `bioio tfrecord2idx`) does not load them
 
 # %%
-def index_tfrecord(tfrecord, index_filepath, pbar=None, proto_fn=None):
-    with open(tfrecord, 'rb') as tfr, open(index_filepath, 'w') as idx:
+# Binary index format:
+#   - 8 bytes magic (INDEX_MAGIC)
+#   - JSON header (version, number of records, column names, offset of the data and keys), padded to INDEX_HEADER_SIZE
+#   - little-endian int64 array of shape (num_records, num_columns), starting with the 'offset' and 'length' (in bytes) of each record
+#   - optional keys, as int64 array of num_records + 1 offsets into a subsequent UTF-8 blob
+INDEX_MAGIC = b'BIOIOIDX'
+INDEX_HEADER_SIZE = 4096
+INDEX_COLUMNS = ('offset', 'length')
+# optional column of the length (first dimension) of a variable-length feature, e.g. for length-bucketed batching
+LENGTH_COLUMN = 'sequence_length'
+
+# %%
+def tfrecord_record_length(proto_len):
+    # uint64 length + uint32 length crc + proto + uint32 proto crc
+    return 8 + 4 + proto_len + 4
+
+# %%
+class IndexWriter():
+    """
+    Writes a binary TFRecord index while records are written, i.e. without reading the TFRecord file again. 
+
+    Args:
+        filepath (str): Path of the index file
+        keys (bool): Whether a key is stored for each record
+        columns (tuple): Names of additional int64 columns stored for each record
+        append (bool): Extend an existing index (closed, or left unclosed by an interrupted writer)
+        num_records (int): With append, keep only the first num_records records of the existing index
+    """
+
+    def __init__(self, filepath, keys=False, columns=(), append=False, num_records=None) -> None:
+        self.filepath = filepath
+        self.columns = INDEX_COLUMNS + tuple(columns)
+        self.keys = [] if keys else None
+        self.num_records = 0
+        self._offset = 0
+
+        if append and os.path.exists(filepath):
+            self._open_append(num_records)
+        else:
+            self._file = open(filepath, 'wb')
+            self._file.write(INDEX_MAGIC + b' '*(INDEX_HEADER_SIZE - len(INDEX_MAGIC)))
+
+    def _open_append(self, num_records):
+        with open(self.filepath, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError(f'Not a binary index: {self.filepath}')
+            header = f.read(INDEX_HEADER_SIZE - len(INDEX_MAGIC)).rstrip(b' ')
+
+        if header:
+            header = json.loads(header)
+            if tuple(header['columns']) != self.columns:
+                raise ValueError(f"Index columns {header['columns']} do not match {list(self.columns)}.")
+            available = header['num_records']
+            keys = load_index_table(self.filepath)['key']
+        else:
+            # the header is written on close, i.e. the previous writer was interrupted and keys are lost
+            available = (os.path.getsize(self.filepath) - INDEX_HEADER_SIZE) // (8 * len(self.columns))
+            keys = None
+        if (keys is None) != (self.keys is None):
+            raise ValueError(f'Index {self.filepath} ' + ('has no keys.' if keys is None else 'has keys.'))
+
+        num_records = available if num_records is None else num_records
+        if num_records > available:
+            raise ValueError(f'Index {self.filepath} has {available} records, expected at least {num_records}.')
+        if num_records > 0:
+            data = np.memmap(self.filepath, dtype='<i8', mode='r', offset=INDEX_HEADER_SIZE, shape=(num_records, len(self.columns)))
+            self._offset = int(data[-1, 0] + data[-1, 1])
+            del data
+        self.num_records = num_records
+        if keys is not None:
+            self.keys = list(keys[:num_records])
+
+        self._file = open(self.filepath, 'r+b')
+        self._file.truncate(INDEX_HEADER_SIZE + num_records * len(self.columns) * 8)
+        # blank the header until close, such that an interrupted writer leaves an (detectably) unclosed index
+        self._file.write(INDEX_MAGIC + b' '*(INDEX_HEADER_SIZE - len(INDEX_MAGIC)))
+        self._file.seek(0, os.SEEK_END)
+
+    def add(self, length, key=None, **values):
+        """Adds a record of the given length (in bytes, including TFRecord framing) directly after the previous record."""
+        row = [self._offset, length] + [values[column] for column in self.columns[2:]]
+        self._file.write(struct.pack(f'<{len(row)}q', *row))
+        if self.keys is not None:
+            self.keys.append(str(key))
+        self._offset += length
+        self.num_records += 1
+
+    def add_proto(self, proto, key=None, **values):
+        self.add(tfrecord_record_length(len(proto)), key=key, **values)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        keys_offset = None
+        if self.keys is not None:
+            keys_offset = self._file.tell()
+            keys = [key.encode('UTF-8') for key in self.keys]
+            self._file.write(np.cumsum([0] + [len(key) for key in keys], dtype='<i8').tobytes())
+            self._file.write(b''.join(keys))
+
+        header = json.dumps({
+            'version': 1, 
+            'num_records': self.num_records, 
+            'columns': list(self.columns), 
+            'data_offset': INDEX_HEADER_SIZE, 
+            'keys_offset': keys_offset,
+        }).encode('UTF-8')
+        if len(INDEX_MAGIC) + len(header) > INDEX_HEADER_SIZE:
+            raise ValueError('Index header too large.')
+
+        self._file.seek(len(INDEX_MAGIC))
+        self._file.write(header)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# %%
+def record_length_fn(features_json, length_key):
+    """
+    Returns a function of a serialized record that returns the length (i.e. first dimension) of a variable-length feature, 
+    without tensorflow and without decoding the feature's values (see `TensorDecoder.length`).
+
+    Args:
+        features_json (dict): Features specification, i.e. the content of a .features.json file
+        length_key (str): Flattened name of the feature, e.g. 'inputs/sequence'
+    """
+
+    from .example import ExampleDecoder, parse_example
+
+    decoders = ExampleDecoder(features_json, features=[length_key]).decoders
+    if len(decoders) != 1:
+        raise ValueError(f"Length key '{length_key}' selects {len(decoders)} features, expected a single tensor.")
+    decoder = next(iter(decoders.values()))
+    if decoder.shape == ():
+        raise ValueError(f"Length key '{length_key}' is a scalar.")
+    keys = set(decoder.keys)
+    return lambda proto: decoder.length(parse_example(proto, keys=keys))
+
+# %%
+# additional index column and values of records, if a record_length_fn is given
+def length_columns(length_fn):
+    return (LENGTH_COLUMN, ) if length_fn is not None else ()
+
+def length_values(proto, length_fn):
+    return {LENGTH_COLUMN: length_fn(proto)} if length_fn is not None else {}
+
+# %%
+def index_block_tfrecord(tfrecord, index_filepath, pbar=None, proto_fn=None, validate=False, length_fn=None):
+    """Indexes a block-compressed TFRecord file, with the block offset and in-block offset of each record (see `bioio.tf.blocks`)."""
+    from .blocks import BLOCK_INDEX_COLUMNS, open_block_tfrecord
+
+    reader = open_block_tfrecord(tfrecord)
+    with IndexWriter(index_filepath, keys=(proto_fn is not None), columns=BLOCK_INDEX_COLUMNS + length_columns(length_fn)) as idx:
+        pbar = (tqdm.tqdm() if pbar is not None else None)
+        for proto, block_offset, in_block_offset in reader.iter_positions(validate):
+            idx.add_proto(proto, key=(proto_fn(proto) if proto_fn is not None else None), block_offset=block_offset, in_block_offset=in_block_offset, 
+                **length_values(proto, length_fn))
+            if pbar is not None:
+                pbar.update(1)
+
+# %%
+def index_tfrecord(tfrecord, index_filepath, pbar=None, proto_fn=None, binary=True, validate=False, length_fn=None):
+    from .blocks import is_block_tfrecord
+    if not binary and length_fn is not None:
+        raise ValueError('Record lengths require a binary index.')
+    if is_block_tfrecord(tfrecord):
+        if not binary:
+            raise ValueError('Block-compressed TFRecord files require a binary index.')
+        return index_block_tfrecord(tfrecord, index_filepath, pbar=pbar, proto_fn=proto_fn, validate=validate, length_fn=length_fn)
+
+    with open(tfrecord, 'rb') as tfr, (IndexWriter(index_filepath, keys=(proto_fn is not None), columns=length_columns(length_fn)) if binary else open(index_filepath, 'w')) as idx:
         pbar = (tqdm.tqdm() if pbar is not None else None)
         while True:
             current = tfr.tell()
@@ -19,6 +196,8 @@ def index_tfrecord(tfrecord, index_filepath, pbar=None, proto_fn=None):
                 byte_len = tfr.read(8)
                 if len(byte_len) == 0:
                     break
+                if validate and len(byte_len) < 8:
+                    raise ValueError(f'Truncated record at offset {current}.')
 
                 # crc length
                 byte_len_crc = tfr.read(4)
@@ -28,82 +207,215 @@ def index_tfrecord(tfrecord, index_filepath, pbar=None, proto_fn=None):
                 proto = tfr.read(proto_len)
 
                 # crc
-                tfr.read(4)
-                print(str(current) + '\t' + str(tfr.tell() - current) + ('\t' + str(proto_fn(proto)) if proto_fn is not None else ''), file=idx)
+                proto_crc = tfr.read(4)
+                if validate:
+                    check_record(byte_len + byte_len_crc, proto, proto_crc, current)
+                if binary:
+                    idx.add(tfr.tell() - current, key=(proto_fn(proto) if proto_fn is not None else None), **length_values(proto, length_fn))
+                else:
+                    print(str(current) + '\t' + str(tfr.tell() - current) + ('\t' + str(proto_fn(proto)) if proto_fn is not None else ''), file=idx)
+            except ValueError:
+                # corrupted record
+                raise
             except Exception:
-                print('Not a valid TFRecord file.')
+                print('Not a valid TFRecord file.', file=sys.stderr)
                 break
             
             if pbar is not None:
                 pbar.update(1)
 
+# %%
+def is_binary_index(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+# %%
+def read_index_header(filepath):
+    with open(filepath, 'rb') as f:
+        f.seek(len(INDEX_MAGIC))
+        return json.loads(f.read(INDEX_HEADER_SIZE - len(INDEX_MAGIC)).rstrip(b' '))
+
+# %%
+def load_index_table(filepath):
+    """
+    Loads a TFRecord index (binary or legacy TSV format).
+
+    Returns:
+        dict: Column name ('offset', 'length', ...) to numpy.array (memory-mapped for binary indices), and 'key' to a list of keys or None
+    """
+
+    if not is_binary_index(filepath):
+        # legacy TSV format: offset, length and optional key
+        import pandas as pd
+        df = pd.read_csv(filepath, sep='\t', header=None, keep_default_na=False)
+        table = {column: np.array(df[i], dtype=np.int64) for i, column in enumerate(INDEX_COLUMNS)}
+        table['key'] = list(df[2].astype(str)) if len(df.columns) > 2 else None
+        return table
+
+    header = read_index_header(filepath)
+    num_records, columns = header['num_records'], header['columns']
+    if num_records == 0:
+        data = np.zeros((0, len(columns)), dtype=np.int64)
+    else:
+        data = np.memmap(filepath, dtype='<i8', mode='r', offset=header['data_offset'], shape=(num_records, len(columns)))
+    table = {column: data[:, i] for i, column in enumerate(columns)}
+
+    table['key'] = None
+    if header['keys_offset'] is not None:
+        key_offsets = np.memmap(filepath, dtype='<i8', mode='r', offset=header['keys_offset'], shape=(num_records + 1, ))
+        with open(filepath, 'rb') as f:
+            f.seek(header['keys_offset'] + key_offsets.nbytes)
+            blob = f.read()
+        table['key'] = [blob[start:end].decode('UTF-8') for start, end in zip(key_offsets[:-1], key_offsets[1:])]
+    return table
+
 # %%
 def load_index(filepath):
-    return np.array(pd.read_csv(filepath, sep='\t', header=None)[0], dtype=np.int64)
+    return load_index_table(filepath)['offset']
 
 # %%
 def load_index_to_dataset(filepath):
+    import tensorflow as tf
     return tf.data.Dataset.from_tensor_slices(load_index(filepath))
 
 # %%
-# def load_indexed_tfrecord(tfrecord_file, features_file=None, index_file=None, shuffle=False): # TODO: Implement caching!
-#     if features_file is None:
-#         features_file = tfrecord_file + '.features.json'
-#     features = features_from_json_file(features_file)
-
-#     if index_file is None:
-#         index_file = tfrecord_file + '.idx'
-#     dataset = index_to_dataset(index_file)
-#     print(dataset.cardinality())
-
-#     gfile_tfrecord = GFileTFRecord(tfrecord_file)
-
-#     # shuffle indices
-#     if shuffle:
-#         dataset = dataset.shuffle(shuffle)
-#     dataset = dataset.prefetch(tf.data.AUTOTUNE)
-
-#     # load proto
-#     dataset = dataset.map(gfile_tfrecord.read_proto)
-#     dataset = dataset.prefetch(tf.data.AUTOTUNE)
-
-#     # deserialize proto to example
-#     dataset = dataset.map(features.deserialize_example)
-#     dataset = dataset.prefetch(tf.data.AUTOTUNE)
-    
-#     return dataset
-
-
-# # %%
-# class GFileTFRecord:
-#     def __init__(self, filepath, features=None):
-#         self._gfile_tfrecord = tf.io.gfile.GFile(filepath, 'rb')
-#         self.features = features
-    
-#     def _seek_and_read(self, offset, length):
-#         offset, length = int(offset), int(length)
-
-#         self._gfile_tfrecord.seek(offset)
-#         return self._gfile_tfrecord.read(length)[(8+4):-4]
-
-#     def read_proto(self, offset, length):
-#         proto_bytes = tf.py_function(self._seek_and_read, inp=[offset, length], Tout=tf.string)
-#         proto_bytes.set_shape(shape=())
-#         return proto_bytes
-    
-#     def read_example(self, offset, length):
-#         if self.features is None:
-#             raise ValueError('Features are required for deserialization.')
-
-#         proto = self.read_proto(offset, length)
-#         return self.features.deserialize_example(proto)
-
-# %%
-# def read_indexed_tfrecord(tfrecord_file, index_file, features_file, shuffle=False):
-#     features = features_from_json_file(features_file)
-#     gfile_tfrecord = GFileTFRecord(tfrecord_file, features)
-#     dataset = index_to_dataset(index_file)
-#     if shuffle:
-#         dataset = dataset.shuffle(shuffle)
-#     dataset = dataset.map(gfile_tfrecord.read_example)
-#     return dataset
+def record_lengths(index_files):
+    """Record lengths (see `record_length_fn`) of all records of the given index files, concatenated."""
+    lengths = []
+    for index_file in index_files:
+        table = load_index_table(index_file)
+        if LENGTH_COLUMN not in table:
+            raise ValueError(f"Index {index_file} has no '{LENGTH_COLUMN}' column, write it with `bioio serialize --length-key` or `bioio tfrecord2idx --length-key`.")
+        lengths.append(np.asarray(table[LENGTH_COLUMN]))
+    return np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+
+# %%
+def read_records(readers, shard_offsets, ids):
+    """
+    Reads records by their global id (i.e. position in the concatenation of all shards). 
+
+    Args:
+        readers (list): GFileTFRecord of each shard
+        shard_offsets (numpy.array): Global id of the first record of each shard (cumulative number of records)
+        ids (numpy.array): Global ids of the records to read
+
+    Returns:
+        numpy.array: Serialized records (dtype object, in the order of ids)
+    """
+
+    shards = np.searchsorted(shard_offsets, ids, side='right') - 1
+    records = np.empty(len(ids), dtype=object)
+    for shard in np.unique(shards):
+        mask = shards == shard
+        local_ids = ids[mask] - shard_offsets[shard]
+        records[mask] = [bytes(proto) for proto in readers[shard].get_many(local_ids, deserialize=False)]
+    return records
+
+# %%
+def load_indexed_tfrecord(tfrecords, features_file=None, index_files=None, shuffle=True, seed=None, deserialize=True, read_batch_size=256, validate=False, features=None, 
+                          bucket_boundaries=None, bucket_batch_sizes=None, drop_remainder=False):
+    """
+    Loads (uncompressed or block-compressed) TFRecord files via their record index. 
+
+    Records are read by offset, such that shuffling is global (i.e. across all records of all shards, and 
+    reshuffled every epoch) while only the record index is held in memory. Batches of records are read in 
+    parallel from memory-mapped files. 
+
+    Args:
+        tfrecords (str or list): TFRecord file(s), e.g. the shards of a dataset
+        features_file (str): Features file, defaults to the features file of the first TFRecord
+        index_files (list): Index file of each TFRecord, defaults to '<tfrecord>.idx'
+        shuffle (bool): Shuffle records globally, every epoch
+        seed (int): Seed of the shuffle
+        deserialize (bool): Deserialize records to examples
+        read_batch_size (int): Number of records read per call (records are unbatched afterwards)
+        validate (bool): Check the CRCs of every record read
+        features (list): Optional flattened names of the features to deserialize (see `load_tfrecord`)
+        bucket_boundaries (list): Optional increasing lengths, examples are batched by the record lengths in the index (see 
+            `record_length_fn`) and padded to the boundary of their bucket (see `bioio.tf.utils.bucket_by_length`). Batches 
+            are composed from the index, i.e. before any record is read, and shuffled every epoch
+        bucket_batch_sizes (int or list): Batch size of all buckets, or of each bucket (len(bucket_boundaries) + 1)
+        drop_remainder (bool): Drop the last batch of each bucket if it is smaller than its batch size
+
+    Returns:
+        tf.data.Dataset: Dataset of known cardinality
+    """
+
+    import tensorflow as tf
+    from .utils import features_from_json_file, default_features_file, select_features, bucket_batch_sizes_list, bucket_by_length
+    from .gfile import GFileTFRecord
+
+    if isinstance(tfrecords, str):
+        tfrecords = [tfrecords]
+    if index_files is None:
+        index_files = [tfrecord + '.idx' for tfrecord in tfrecords]
+    if len(index_files) != len(tfrecords):
+        raise ValueError('Expected one index file per TFRecord file.')
+
+    if bucket_boundaries is not None and (not deserialize or bucket_batch_sizes is None):
+        raise ValueError('Length-bucketed batching requires deserialize and bucket_batch_sizes.')
+
+    readers = [GFileTFRecord(tfrecord, index=index_file, validate=validate) for tfrecord, index_file in zip(tfrecords, index_files)]
+    shard_offsets = np.cumsum([0] + [len(reader) for reader in readers], dtype=np.int64)
+    num_records = int(shard_offsets[-1])
+
+    if bucket_boundaries is not None:
+        batch_sizes = bucket_batch_sizes_list(bucket_batch_sizes, bucket_boundaries)
+        record_buckets = np.searchsorted(bucket_boundaries, record_lengths(index_files), side='left')
+        bucket_counts = np.bincount(record_buckets, minlength=len(batch_sizes))
+        num_batches = sum((count // size) if drop_remainder else -(-count // size) for count, size in zip(bucket_counts, batch_sizes))
+
+    # global record ids, in batches of read_batch_size
+    rng = np.random.default_rng(seed)
+    def ids_generator():
+        # called once per epoch
+        ids = rng.permutation(num_records) if shuffle else np.arange(num_records)
+        for start in range(0, num_records, read_batch_size):
+            yield ids[start:start + read_batch_size]
+
+    def bucket_batches_generator():
+        # full batches of each bucket (in random order), then the last (smaller) batch of each bucket, such that batches 
+        # are not mixed when examples are grouped by bucket again after reading
+        ids = rng.permutation(num_records) if shuffle else np.arange(num_records)
+        full, last = [], []
+        for bucket, size in enumerate(batch_sizes):
+            bucket_ids = ids[record_buckets[ids] == bucket]
+            for start in range(0, len(bucket_ids), size):
+                (full if start + size <= len(bucket_ids) else last).append((bucket_ids[start:start + size], bucket))
+        if shuffle:
+            full = [full[i] for i in rng.permutation(len(full))]
+        for batch_ids, bucket in full + ([] if drop_remainder else last):
+            yield batch_ids, np.full(len(batch_ids), bucket, dtype=np.int64)
+
+    if bucket_boundaries is not None:
+        dataset = tf.data.Dataset.from_generator(bucket_batches_generator, output_signature=(
+            tf.TensorSpec(shape=(None, ), dtype=tf.int64), tf.TensorSpec(shape=(None, ), dtype=tf.int64)))
+    else:
+        dataset = tf.data.Dataset.from_generator(ids_generator, output_signature=tf.TensorSpec(shape=(None, ), dtype=tf.int64))
+
+    # read records by offset (buckets are passed through)
+    def read_batch(ids, *buckets):
+        records = tf.numpy_function(lambda x: read_records(readers, shard_offsets, x), inp=[ids], Tout=tf.string, stateful=False)
+        records = tf.ensure_shape(records, (None, ))
+        return (records, *buckets) if buckets else records
+    dataset = dataset.map(read_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.unbatch()
+    if bucket_boundaries is None:
+        dataset = dataset.apply(tf.data.experimental.assert_cardinality(num_records))
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+    if deserialize:
+        if features_file is None:
+            features_file = default_features_file(tfrecords[0])
+        features_dict = features_from_json_file(features_file)
+        if features is not None:
+            features_dict = select_features(features_dict, features)
+        if bucket_boundaries is None:
+            dataset = dataset.map(features_dict.deserialize_example, num_parallel_calls=tf.data.AUTOTUNE)
+        else:
+            dataset = dataset.map(lambda record, bucket: (features_dict.deserialize_example(record), bucket), num_parallel_calls=tf.data.AUTOTUNE)
+            dataset = bucket_by_length(dataset, None, bucket_boundaries, batch_sizes, drop_remainder=drop_remainder)
+            dataset = dataset.apply(tf.data.experimental.assert_cardinality(num_batches))
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+
+    return dataset
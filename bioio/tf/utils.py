@@ -1,10 +1,16 @@
 # %%
+import os
+import re
 import sys
 import json
+import time
+import threading
 
 import tqdm
+import numpy as np
 import tensorflow as tf
 import tensorflow_datasets as tfds
+from tensorflow_datasets.core.example_serializer import ExampleSerializer
 
 # %%
 # def get_structure_types(structure):
@@ -23,10 +29,14 @@ def get_generalized_structure_signature(structure):
 
 # %%
 def dataset_from_iterable(py_iterable):
+    if hasattr(py_iterable, 'to_dataset'):
+        # iterables may build the tf.data.Dataset themselves, e.g. from column arrays instead of a python generator
+        return py_iterable.to_dataset()
+
     # output_signature = get_structure_signature(next(iter(py_iterable)))
     output_signature = get_generalized_structure_signature(next(iter(py_iterable)))
     # print(output_signature)
-    return tf.data.Dataset.from_generator(lambda: iter(py_iterable), output_signature=output_signature)
+    return tf.data.Dataset.from_generator(lambda: PyFunctionTimer.timed_iter(iter(py_iterable)), output_signature=output_signature)
 
 # %%
 def tensorspec_to_tensor_feature(tensorspec, encoding=None, **kwargs):
@@ -52,21 +62,96 @@ def dataset_to_tensor_features(dataset, **kwargs):
             lambda spec: tensorspec_to_tensor_feature(spec, **kwargs), 
             first_example_signature))
 
+# %%
+def _nested_features_json(feature_json):
+    # features of a top-level or nested FeaturesDict specification
+    return feature_json['content']['features'] if 'content' in feature_json else feature_json['featuresDict']['features']
+
+def features_to_json(features):
+    """
+    Returns features.to_json() with the (nested) features in the order of the FeaturesDict, since to_json orders 
+    them like the protobuf map it is converted from (i.e. by string hashes, which differ between processes).
+    """
+
+    def ordered(feature, feature_json):
+        if isinstance(feature, tfds.features.FeaturesDict):
+            features_json = _nested_features_json(feature_json)
+            ordered_json = {key: ordered(feature[key], features_json[key]) for key in feature.keys()}
+            features_json.clear()
+            features_json.update(ordered_json)
+        return feature_json
+    return ordered(features, features.to_json())
+
 # %%
 def features_to_json_file(features, filepath, indent=2):
     with open(filepath, 'w') as json_file:
-        print(json.dumps(features.to_json(), indent=indent), file=json_file)
+        print(json.dumps(features_to_json(features), indent=indent), file=json_file)
+
+# %%
+def features_from_json(features_json):
+    """Returns the FeaturesDict of a features specification, with its (nested) features in the order of the specification (see `features_to_json`)."""
+
+    def ordered(feature, feature_json):
+        if isinstance(feature, tfds.features.FeaturesDict):
+            return tfds.features.FeaturesDict({key: ordered(feature[key], value) for key, value in _nested_features_json(feature_json).items()})
+        return feature
+    return ordered(tfds.features.FeaturesDict.from_json(features_json), features_json)
+
+# %%
+def ordered_like_features(features, example):
+    """Returns a (nested) example dict with its keys in the order of the FeaturesDict."""
+    if isinstance(features, tfds.features.FeaturesDict):
+        return {key: ordered_like_features(features[key], example[key]) for key in features.keys()}
+    return example
 
 # %%
 def features_from_json_file(filepath):
     with open(filepath) as json_file:
-        features = tfds.features.FeaturesDict.from_json(json.load(json_file))
+        features = features_from_json(json.load(json_file))
     return features
 
+# %%
+def select_features(features, names):
+    """
+    Returns the FeaturesDict of a subset of features, selected by flattened names (e.g. ['inputs/sequence', 'outputs'], 
+    see `bioio.tf.example.select_paths`). Examples deserialized with it only parse and decode the selected features.
+    """
+
+    from .example import select_paths
+
+    def leaves(feature, path=()):
+        if isinstance(feature, tfds.features.FeaturesDict):
+            return {leaf: value for key in feature.keys() for leaf, value in leaves(feature[key], path + (key, )).items()}
+        return {path: feature}
+
+    tensors = leaves(features)
+    selected = {}
+    for path in select_paths(list(tensors), names):
+        nested = selected
+        for key in path[:-1]:
+            nested = nested.setdefault(key, {})
+        nested[path[-1]] = tensors[path]
+    return tfds.features.FeaturesDict(selected)
+
+# %%
+def example_serializer(features):
+    """
+    Returns a function that serializes examples like features.serialize_example, but deterministically (i.e. with 
+    sorted keys of the proto's feature map), such that the same examples always result in the same bytes.
+    """
+    serializer = ExampleSerializer(features.get_serialized_info())
+    return lambda example: serializer.get_tf_example(features.encode_example(example)).SerializeToString(deterministic=True)
+
+# %%
+def serialize_example(features, example):
+    """Serializes a single example deterministically (see `example_serializer`)."""
+    return example_serializer(features)(example)
+
 # %%
 def serialize_dataset(dataset, features):
+    serialize = example_serializer(features)
     for example in dataset:
-        yield features.serialize_example(tf.nest.map_structure(lambda e: e.numpy(), example))
+        yield serialize(tf.nest.map_structure(lambda e: e.numpy(), example))
 
 # %%
 def dataset_to_tfrecord(dataset, filepath, encoding='bytes'):
@@ -82,12 +167,179 @@ def deserialize_dataset(dataset, features):
     return dataset.map(features.deserialize_example)
 
 # %%
-def load_tfrecord(tfrecords, features_file=None, deserialize=True, shuffle=None):
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+def compression_type(tfrecord):
+    """Returns 'GZIP' for gzip-compressed and 'BLOCK' for block-compressed TFRecord files (detected by their magic bytes), else ''."""
+    from .blocks import BLOCK_MAGIC
+    with tf.io.gfile.GFile(tfrecord, 'rb') as f:
+        magic = f.read(len(BLOCK_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return 'GZIP'
+    return 'BLOCK' if magic == BLOCK_MAGIC else ''
+
+# %%
+# called inside interleave, whose function AutoGraph would try (and fail) to convert, since the reader is a generator
+@tf.autograph.experimental.do_not_convert
+def block_tfrecord_dataset(tfrecord):
+    """Dataset of the (serialized) records of a block-compressed TFRecord file (see `bioio.tf.blocks`)."""
+    from .blocks import iter_block_records
+
+    def generator(filepath):
+        with tf.io.gfile.GFile(filepath.decode(), 'rb') as f:
+            yield from iter_block_records(f)
+    return tf.data.Dataset.from_generator(generator, args=(tfrecord, ), output_signature=tf.TensorSpec(shape=(), dtype=tf.string))
+
+# %%
+def default_features_file(tfrecord):
+    """
+    Returns the features file of a TFRecord, i.e. '<tfrecord>.features.json' or, for the shards 
+    '<tfrecord>-00000-of-0000n' of `bioio serialize --num-shards`, the features file of their manifest.
+    """
+    # features of gzip-compressed files may be named without the '.gz' suffix (e.g. by `bioio merge-tfrecords`)
+    features_file = tfrecord + '.features.json'
+    if not tf.io.gfile.exists(features_file) and tfrecord.endswith('.gz'):
+        features_file = tfrecord.removesuffix('.gz') + '.features.json'
+    match = re.fullmatch(r'(.+)-\d{5}-of-\d{5}', tfrecord)
+    if not tf.io.gfile.exists(features_file) and match is not None:
+        manifest_file = match.group(1) + '.manifest.json'
+        if tf.io.gfile.exists(manifest_file):
+            with tf.io.gfile.GFile(manifest_file) as f:
+                manifest = json.load(f)
+            features_file = os.path.join(os.path.dirname(tfrecord), manifest['features'])
+    return features_file
+
+# %%
+def bucket_batch_sizes_list(bucket_batch_sizes, bucket_boundaries):
+    """Batch size of each bucket, i.e. of the len(bucket_boundaries) buckets and of the bucket of longer elements."""
+    if isinstance(bucket_batch_sizes, int):
+        return [bucket_batch_sizes] * (len(bucket_boundaries) + 1)
+    if len(bucket_batch_sizes) != len(bucket_boundaries) + 1:
+        raise ValueError(f'Expected {len(bucket_boundaries) + 1} bucket batch sizes (one per bucket boundary and one for longer elements), but got {len(bucket_batch_sizes)}.')
+    return list(bucket_batch_sizes)
+
+# %%
+def bucket_padded_shapes(element_spec, padded_length):
+    """Padded shapes of a (nested) element, variable leading dimensions are padded to padded_length (-1 pads to the longest element of a batch)."""
+    def padded_shape(spec):
+        if spec.shape.rank and spec.shape[0] is None:
+            rest = [-1 if d is None else d for d in spec.shape.as_list()[1:]]
+            return tf.concat([tf.reshape(padded_length, (1, )), tf.constant(rest, dtype=tf.int64)], axis=0)
+        return spec.shape
+    return tf.nest.map_structure(padded_shape, element_spec)
+
+# %%
+def bucket_by_length(dataset, bucket_fn, bucket_boundaries, bucket_batch_sizes, drop_remainder=False):
+    """
+    Batches elements of the same length bucket, padded to the upper boundary of their bucket.
+
+    Bucket i holds elements of length in (bucket_boundaries[i - 1], bucket_boundaries[i]], the last bucket holds longer elements 
+    (padded to the longest element of each batch). Variable leading dimensions of all (nested) tensors are padded, 
+    other variable dimensions are padded to the longest element of each batch.
+
+    Args:
+        dataset (tf.data.Dataset): Dataset of (nested) tensors
+        bucket_fn (callable): Function of an element that returns its bucket (int64 scalar), see `length_bucket`. None if elements 
+            are (element, bucket) pairs, e.g. with buckets assigned from the record lengths in the index
+        bucket_boundaries (list): Increasing upper lengths of the buckets
+        bucket_batch_sizes (int or list): Batch size of all buckets, or of each bucket (len(bucket_boundaries) + 1)
+        drop_remainder (bool): Drop the last batch of each bucket if it is smaller than the batch size
+    """
+
+    batch_sizes = tf.constant(bucket_batch_sizes_list(bucket_batch_sizes, bucket_boundaries), dtype=tf.int64)
+    padded_lengths = tf.constant(list(bucket_boundaries) + [-1], dtype=tf.int64)
+
+    paired = bucket_fn is None
+    if paired:
+        bucket_fn = lambda element, bucket: bucket
+
+    def reduce_fn(bucket, window):
+        if paired:
+            window = window.map(lambda element, _: element)
+        return window.padded_batch(tf.gather(batch_sizes, bucket), padded_shapes=bucket_padded_shapes(window.element_spec, tf.gather(padded_lengths, bucket)), 
+            drop_remainder=drop_remainder)
+    return dataset.group_by_window(key_func=bucket_fn, reduce_func=reduce_fn, window_size_func=lambda bucket: tf.gather(batch_sizes, bucket))
+
+# %%
+def length_bucket(length, bucket_boundaries):
+    """Bucket of a length (see `bucket_by_length`), i.e. the index of the first boundary that is not smaller than the length."""
+    bucket = tf.searchsorted(tf.constant(bucket_boundaries, dtype=tf.int64), tf.reshape(tf.cast(length, tf.int64), (1, )), side='left', out_type=tf.int64)
+    return bucket[0]
+
+# %%
+def load_tfrecord(tfrecords, features_file=None, deserialize=True, shuffle=None, shuffle_memory_mb=None, cycle_length=1, block_length=1, 
+                  num_parallel_reads=tf.data.AUTOTUNE, buffer_size=None, shard=None, deterministic=None, features=None, 
+                  bucket_boundaries=None, bucket_batch_sizes=None, length_key=None, drop_remainder=False):
+    """
+    Loads TFRecord files (uncompressed or gzip-compressed, detected per file, or block-compressed, see `bioio.tf.blocks`).
+
+    Args:
+        tfrecords (str or list): TFRecord file(s), e.g. the shards of a dataset
+        features_file (str): Features file, defaults to the features file of the first TFRecord
+        deserialize (bool): Deserialize records to examples
+        shuffle (int): Size of the shuffle buffer (in records)
+        shuffle_memory_mb (int): Memory budget of the shuffle buffer (in MB), its size is estimated from the 
+            record sizes (see `estimate_max_buffer_size`). Exclusive with shuffle
+        cycle_length (int): Number of files read concurrently (interleaved), 1 reads files one after another 
+            (i.e. records are in the order of the files) and tf.data.AUTOTUNE lets tf.data decide
+        block_length (int): Number of consecutive records from each file, if files are interleaved
+        num_parallel_reads (int): Number of threads reading the interleaved files
+        buffer_size (int): Read buffer size of each file (in bytes), defaults to the TFRecordDataset default
+        shard (tuple): Optional (num_workers, worker_index), only files worker_index, worker_index + num_workers, ...
+            are read (e.g. by each process of multi-process or multi-host training)
+        deterministic (bool): Whether interleaved records and deserialized examples must be produced in a
+            deterministic order, False allows out-of-order reads for higher throughput (defaults to tf.data.Options)
+        features (list): Optional flattened names of the features to deserialize (e.g. ['inputs/sequence', 'outputs/total']),
+            all other features are skipped without being parsed or decompressed
+        bucket_boundaries (list): Optional increasing lengths, examples are batched by the length of their length_key feature 
+            and padded to the boundary of their bucket (see `bucket_by_length`)
+        bucket_batch_sizes (int or list): Batch size of all buckets, or of each bucket (len(bucket_boundaries) + 1)
+        length_key (str): Flattened name of the variable-length feature that determines the bucket (e.g. 'inputs/sequence')
+        drop_remainder (bool): Drop the last batch of each bucket if it is smaller than its batch size
+    """
+
     if isinstance(tfrecords, str):
         # backward compatibility, accept a single tfrecord file instead of a list of tfrecord files
         tfrecords = [tfrecords]
-    dataset = tf.data.Dataset.from_tensor_slices(tfrecords)
-    dataset = dataset.interleave(lambda fp: tf.data.TFRecordDataset(fp), cycle_length=1, block_length=1, num_parallel_calls=tf.data.AUTOTUNE)
+    tfrecords = list(tfrecords)
+    if shuffle is not None and shuffle_memory_mb is not None:
+        raise ValueError('Expected either shuffle or shuffle_memory_mb, not both.')
+    if bucket_boundaries is not None and (not deserialize or length_key is None or bucket_batch_sizes is None):
+        raise ValueError('Length-bucketed batching requires deserialize, length_key and bucket_batch_sizes.')
+    if deserialize and features_file is None:
+        # if list of tfrecords is supplied but no features file, use features file of first tfrecord - this must exist
+        features_file = default_features_file(tfrecords[0])
+
+    if shard is not None:
+        # shard files (not records), such that each worker only reads its own files
+        num_workers, worker_index = shard
+        if not 0 <= worker_index < num_workers:
+            raise ValueError(f'Invalid shard {shard}, expected (num_workers, worker_index) with 0 <= worker_index < num_workers.')
+        if len(tfrecords) < num_workers:
+            raise ValueError(f'Cannot shard {len(tfrecords)} file(s) across {num_workers} workers.')
+        tfrecords = tfrecords[worker_index::num_workers]
+
+    if shuffle_memory_mb is not None:
+        shuffle = estimate_max_buffer_size(tfrecords, memory_in_mb=shuffle_memory_mb)
+
+    if num_parallel_reads not in (None, tf.data.AUTOTUNE):
+        # files read in parallel must be in the cycle (and tf.data does not resolve an AUTOTUNE cycle length accordingly)
+        cycle_length = num_parallel_reads if cycle_length == tf.data.AUTOTUNE else cycle_length
+        num_parallel_reads = min(num_parallel_reads, cycle_length)
+
+    compressions = [compression_type(tfrecord) for tfrecord in tfrecords]
+    if 'BLOCK' in compressions and any(compression != 'BLOCK' for compression in compressions):
+        raise ValueError('Cannot mix block-compressed and other TFRecord files.')
+    dataset = tf.data.Dataset.from_tensor_slices((tfrecords, compressions))
+    if shuffle is not None and len(tfrecords) > 1:
+        # shuffle the order of files (every epoch), such that the shuffle buffer does not always start with the first file
+        dataset = dataset.shuffle(len(tfrecords))
+    if 'BLOCK' in compressions:
+        read_file = lambda fp, compression: block_tfrecord_dataset(fp)
+    else:
+        read_file = lambda fp, compression: tf.data.TFRecordDataset(fp, compression_type=compression, buffer_size=buffer_size)
+    dataset = dataset.interleave(read_file, cycle_length=cycle_length, block_length=block_length, num_parallel_calls=num_parallel_reads, 
+        deterministic=deterministic)
 
     if shuffle is not None:
         # shuffle examples before deserializing
@@ -99,12 +351,20 @@ def load_tfrecord(tfrecords, features_file=None, deserialize=True, shuffle=None)
 
     # desrialize examples using feature specification in auxiliary file
     if deserialize:
-        if features_file is None:
-            # if list of tfrecords is supplied but no features file, use features file of first tfrecord - this must exist
-            features_file = tfrecords[0] + '.features.json'
-        features = features_from_json_file(features_file)
-
-        dataset = dataset.map(features.deserialize_example, num_parallel_calls=tf.data.AUTOTUNE)
+        features_dict = features_from_json_file(features_file)
+        if features is not None:
+            features_dict = select_features(features_dict, features)
+        # nested features of deserialized examples are sorted by name, restore the order of the features file
+        dataset = dataset.map(lambda proto: ordered_like_features(features_dict, features_dict.deserialize_example(proto)), 
+            num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
+
+    if bucket_boundaries is not None:
+        path = length_key.strip('/').split('/')
+        def bucket_fn(example):
+            for key in path:
+                example = example[key]
+            return length_bucket(tf.shape(example)[0], bucket_boundaries)
+        dataset = bucket_by_length(dataset, bucket_fn, bucket_boundaries, bucket_batch_sizes, drop_remainder=drop_remainder)
     
     # optimize IO
     dataset = dataset.prefetch(tf.data.AUTOTUNE)
@@ -135,11 +395,53 @@ def dtype_to_tensor_spec(v):
 def tensor_spec_to_dtype(v):
   return v.dtype if isinstance(v, tf.TensorSpec) else v
 
+# %%
+class PyFunctionTimer():
+    """
+    Accumulates the time spent in python code called from tf.data pipelines (functions wrapped with py_function_nest 
+    and python generators of dataset_from_iterable), while the timer is active, e.g. for profiling.
+    """
+
+    active = None
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        # py_function may be called from multiple threads, i.e. seconds may exceed the wall time
+        with self._lock:
+            self.seconds += seconds
+            self.calls += 1
+
+    @staticmethod
+    def timed_iter(iterator):
+        while True:
+            timer, start = PyFunctionTimer.active, time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            if timer is not None:
+                timer.add(time.perf_counter() - start)
+            yield item
+
+    def __enter__(self):
+        PyFunctionTimer.active = self
+        return self
+
+    def __exit__(self, *args):
+        PyFunctionTimer.active = None
+
 # %%
 def py_function_nest(func, inp, Tout, name=None):
     def wrapped_func(*flat_inp):
+        timer, start = PyFunctionTimer.active, time.perf_counter()
         reconstructed_inp = tf.nest.pack_sequence_as(inp, flat_inp, expand_composites=True)
         out = func(*reconstructed_inp)
+        if timer is not None:
+            timer.add(time.perf_counter() - start)
         return tf.nest.flatten(out, expand_composites=True)
 
     flat_Tout = tf.nest.flatten(Tout, expand_composites=True)
@@ -164,6 +466,43 @@ def better_py_function_kwargs(Tout, numpy=True, decode_bytes=True):
         return lambda kwargs: py_function_nest(func_wrapper, inp=[kwargs], Tout=Tout)
     return decorator
 
+# %%
+def decode_if_bytes_array(x):
+    if isinstance(x, np.ndarray) and x.dtype == object:
+        x = np.char.decode(x.astype(bytes), 'UTF-8')
+    return x
+
+# %%
+def better_py_function_batch(Tout, ragged=False, decode_bytes=True):
+    """
+    Batched counterpart of better_py_function_kwargs. The wrapped function is called once per batch of
+    examples, with each column passed as a numpy array.
+
+    If ragged=True, the wrapped function must return a tuple (values, row_lengths) of the concatenated
+    values of all examples and the number of values per example. This is converted to a tf.RaggedTensor
+    of shape (batch_size, None, ...), where Tout is the TensorSpec of a single (unbatched) example.
+    """
+
+    def decorator(func):
+        def func_wrapper(kwargs):
+            kwargs = tf.nest.map_structure(tensor_to_numpy, kwargs)
+            if decode_bytes:
+                kwargs = tf.nest.map_structure(decode_if_bytes_array, kwargs)
+            return func(**kwargs)
+
+        def batch_func(kwargs):
+            if not ragged:
+                tensor = py_function_nest(func_wrapper, inp=[kwargs], Tout=Tout.dtype)
+                tensor.set_shape(tf.TensorShape([None]).concatenate(Tout.shape))
+                return tensor
+
+            values, row_lengths = py_function_nest(func_wrapper, inp=[kwargs], Tout=(Tout.dtype, tf.int64))
+            values.set_shape(Tout.shape)
+            row_lengths.set_shape((None, ))
+            return tf.RaggedTensor.from_row_lengths(values, row_lengths)
+        return batch_func
+    return decorator
+
 # %%
 # def pyfunc(output_types, numpy=True, decode_bytes=True, expand_kwargs=True):
 #     def decorator(func):
@@ -185,32 +524,91 @@ def multi_hot(x, depth):
     return tf.reduce_sum(tf.one_hot(x, depth=depth, dtype=tf.int64), axis=0)
 
 # %%
-def estimate_record_size(tfrecords, take=None):
-    """
-    Estimate mean and standard deviation of TFRecord record sizes in bytes.
-    """
+def _index_record_sizes(tfrecords, take=None):
+    """Serialized record sizes (in bytes) from the index files of TFRecord files, None if any index is missing or does not match its file."""
+    from .index import load_index_table, tfrecord_record_length
+
+    sizes, num_sizes = [], 0
+    for tfrecord in tfrecords:
+        if take is not None and num_sizes >= take:
+            break
+        try:
+            table = load_index_table(tfrecord + '.idx')
+        except (OSError, ValueError):
+            # missing, legacy TSV index without records or an unclosed binary index
+            return None
+        offsets, lengths = table['offset'], table['length']
+        if 'block_offset' not in table and len(lengths) > 0 and offsets[-1] + lengths[-1] != os.path.getsize(tfrecord):
+            # stale index (offsets of block-compressed files are offsets in the uncompressed records)
+            return None
+        lengths = lengths[:(take - num_sizes) if take is not None else None]
+        # framing (length, CRCs) is not held in memory
+        sizes.append(np.asarray(lengths, dtype=np.float64) - tfrecord_record_length(0))
+        num_sizes += len(lengths)
+    return np.concatenate(sizes) if sizes else np.zeros(0)
 
+# %%
+def _sampled_record_sizes(tfrecords, take=None, sample_size=10000, seed=None, batch_size=4096):
+    """Reservoir sample of serialized record sizes (in bytes), by reading the records."""
     dataset = load_tfrecord(tfrecords, deserialize=False)
     if take is not None:
         dataset = dataset.take(take)
+    dataset = dataset.map(tf.strings.length).batch(batch_size)
 
-    sizes = []
+    rng = np.random.default_rng(seed)
+    reservoir, n = np.zeros(sample_size), 0
     print('Estimating record size...', file=sys.stderr)
-    for record in tqdm.tqdm(dataset.as_numpy_iterator()):
-        sizes.append(tf.cast(sys.getsizeof(record), dtype=tf.float32))
-    return tf.math.reduce_mean(sizes), tf.math.reduce_std(sizes)
+    for lengths in tqdm.tqdm(dataset.as_numpy_iterator(), unit='batch'):
+        # fill the reservoir, then replace a random element with probability sample_size / (i + 1) for the i-th record
+        num_fill = max(0, min(sample_size - n, len(lengths)))
+        reservoir[n:n + num_fill] = lengths[:num_fill]
+        i = n + np.arange(num_fill, len(lengths))
+        slots = (rng.random(len(i)) * (i + 1)).astype(np.int64)
+        accepted = slots < sample_size
+        # numpy assigns repeated slots in order, i.e. like the sequential algorithm
+        reservoir[slots[accepted]] = lengths[num_fill:][accepted]
+        n += len(lengths)
+    return reservoir[:min(n, sample_size)]
+
+# %%
+def estimate_record_size(tfrecords, take=None, sample_size=10000, seed=None):
+    """
+    Estimate mean and standard deviation of TFRecord record sizes in bytes.
+
+    Record sizes are read from the index files (<tfrecord>.idx) if all TFRecord files have one, else from a reservoir
+    sample of sample_size records.
+
+    Args:
+        tfrecords (str or list): TFRecord file(s)
+        take (int): Only consider the first take records
+        sample_size (int): Size of the reservoir sample, if records are read
+        seed (int): Seed of the reservoir sample
+
+    Returns:
+        tuple: Mean and standard deviation
+    """
+
+    if isinstance(tfrecords, str):
+        tfrecords = [tfrecords]
+
+    sizes = _index_record_sizes(tfrecords, take=take)
+    if sizes is None:
+        sizes = _sampled_record_sizes(tfrecords, take=take, sample_size=sample_size, seed=seed)
+    if len(sizes) == 0:
+        return 0.0, 0.0
+    return float(np.mean(sizes)), float(np.std(sizes))
 
 # %%
 def get_max_buffer_size_for_target_memory(record_size_mean, record_size_std, memory_in_mb=1024):
     """
     Estimate the maximum viable buffer sizes for a given memory budget. 
     """
-    return int(1000*1000*memory_in_mb / (record_size_mean + 2*record_size_std))
+    return max(1, int(1000*1000*memory_in_mb / max(record_size_mean + 2*record_size_std, 1)))
 
 # %%
-def estimate_max_buffer_size(tfrecords, memory_in_mb=1024, take=None):
+def estimate_max_buffer_size(tfrecords, memory_in_mb=1024, take=None, **kwargs):
     """
     Estimate the maximum viable buffer sizes for a given memory budget. 
     """
-    record_size_mean, record_size_std = estimate_record_size(tfrecords, take=take)
+    record_size_mean, record_size_std = estimate_record_size(tfrecords, take=take, **kwargs)
     return get_max_buffer_size_for_target_memory(record_size_mean, record_size_std, memory_in_mb)
\ No newline at end of file
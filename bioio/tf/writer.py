@@ -0,0 +1,72 @@
+# %%
+import os
+import mmap
+import struct
+
+from .crc import masked_crc32c, masked_crc32c_batch
+
+# %%
+class TFRecordAppendWriter():
+    """
+    Writes (uncompressed) TFRecord records, appending to an existing file.
+
+    tf.io.TFRecordWriter always truncates, i.e. this writer is used to extend files (e.g. to resume an interrupted
+    `bioio serialize`). The framing and CRCs are the same.
+
+    Args:
+        filepath (str): Path of the TFRecord file, created if it does not exist
+    """
+
+    def __init__(self, filepath) -> None:
+        self.filepath = filepath
+        self._file = open(filepath, 'ab')
+
+    def write(self, record):
+        record = bytes(record)
+        length = struct.pack('<Q', len(record))
+        self._file.write(length + struct.pack('<I', masked_crc32c(length)) + record + struct.pack('<I', masked_crc32c(record)))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# %%
+def frame_records(records):
+    """Returns the TFRecord framing (lengths, CRCs) of a list of records as bytes, with CRCs computed in a batch."""
+    lengths = [struct.pack('<Q', len(record)) for record in records]
+    crcs = masked_crc32c_batch(lengths + list(records)).tolist()
+    return b''.join(
+        length + struct.pack('<I', length_crc) + record + struct.pack('<I', record_crc)
+        for length, length_crc, record, record_crc in zip(lengths, crcs[:len(records)], records, crcs[len(records):])
+    )
+
+# %%
+def iter_records(tfrecord):
+    """Yields the (proto) records of an uncompressed (or block-compressed) TFRecord file, without checking CRCs."""
+    with open(tfrecord, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        from .blocks import BLOCK_MAGIC
+        if f.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC:
+            from .blocks import iter_block_records
+            f.seek(0)
+            yield from iter_block_records(f)
+            return
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        offset = 0
+        while offset + 8 <= len(buffer):
+            proto_len = struct.unpack_from('<Q', buffer, offset)[0]
+            yield buffer[offset + 8 + 4:offset + 8 + 4 + proto_len]
+            offset += 8 + 4 + proto_len + 4
+    finally:
+        buffer.close()
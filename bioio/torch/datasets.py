@@ -1,2 +1,90 @@
 # %%
-import torch
\ No newline at end of file
+import os
+
+import numpy as np
+import torch
+
+from bioio.tf.gfile import GFileTFRecord
+from bioio.tf.index import load_index
+from bioio.tf.utils import default_features_file, compression_type
+
+# %%
+class TFRecordDataset(torch.utils.data.Dataset):
+    """
+    Map-style PyTorch dataset over one or more indexed (uncompressed or block-compressed) TFRecord files. 
+
+    File handles are opened lazily by each process (i.e. after DataLoader workers are forked or spawned), 
+    such that workers never share a file handle. Examples are returned as nested dicts of torch.Tensor.
+
+    Args:
+        tfrecords (str or list): TFRecord file(s), e.g. the shards of a dataset
+        features_file (str): Features file, defaults to the features file of the first TFRecord
+        index_files (list): Index file of each TFRecord, defaults to '<tfrecord>.idx'
+        validate (bool): Check the CRCs of every record read
+        features (list): Optional flattened names of the features to decode (e.g. ['inputs/sequence']), all other
+            features are skipped
+    """
+
+    def __init__(self, tfrecords, features_file=None, index_files=None, validate=False, features=None) -> None:
+        if isinstance(tfrecords, str):
+            tfrecords = [tfrecords]
+        self.tfrecords = list(tfrecords)
+        for tfrecord in self.tfrecords:
+            # records are read at their offsets, i.e. gzip-compressed files do not support random access
+            if compression_type(tfrecord) == 'GZIP':
+                raise ValueError(f'{tfrecord} is gzip-compressed, random access requires an uncompressed or block-compressed TFRecord file.')
+        self.features_file = features_file if features_file is not None else default_features_file(self.tfrecords[0])
+        self.index_files = list(index_files) if index_files is not None else [tfrecord + '.idx' for tfrecord in self.tfrecords]
+        if len(self.index_files) != len(self.tfrecords):
+            raise ValueError('Expected one index file per TFRecord file.')
+        self.validate = validate
+        self.features = features
+
+        # global id of the first record of each shard
+        self.shard_offsets = np.cumsum([0] + [len(load_index(index_file)) for index_file in self.index_files], dtype=np.int64)
+
+        self._readers = None
+        self._pid = None
+
+    @property
+    def readers(self):
+        # (re-)open file handles in every new process
+        if self._pid != os.getpid():
+            self._readers = [GFileTFRecord(tfrecord, features=self.features_file, index=index_file, validate=self.validate, select=self.features) for tfrecord, index_file in zip(self.tfrecords, self.index_files)]
+            self._pid = os.getpid()
+        return self._readers
+
+    def __getstate__(self):
+        # file handles are not pickled (e.g. for DataLoader workers started with 'spawn')
+        state = self.__dict__.copy()
+        state['_readers'], state['_pid'] = None, None
+        return state
+
+    def __len__(self):
+        return int(self.shard_offsets[-1])
+
+    def _locate(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError(f'Index out of range for dataset of length {len(self)}.')
+        shards = np.searchsorted(self.shard_offsets, indices, side='right') - 1
+        return shards, indices - self.shard_offsets[shards]
+
+    def _to_torch(self, reader, proto):
+        # decoded to numpy without tensorflow ops, then shared with torch
+        return reader.deserialize(proto, to_torch=True)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        """Returns the examples at the given indices, reading records of each shard in order of their offsets."""
+        shards, local_indices = self._locate(indices)
+        examples = [None] * len(shards)
+        for shard in np.unique(shards):
+            positions = np.nonzero(shards == shard)[0]
+            reader = self.readers[shard]
+            for position, proto in zip(positions, reader.get_many(local_indices[positions], deserialize=False)):
+                examples[position] = self._to_torch(reader, proto)
+        return examples
@@ -4,8 +4,13 @@ import torch
 
 # %%
 def numpy_to_torch(x):
+    """Converts a numpy array (or bytes / str) to a torch.Tensor, sharing memory with the array where possible."""
     if isinstance(x, str) or isinstance(x, bytes):
         if isinstance(x, str):
             x = x.encode('UTF-8')
-        x = np.frombuffer(x, dtype=np.uint8)
-    return torch.tensor(x)
\ No newline at end of file
+        # bytearray, since torch.from_numpy requires a writable buffer
+        x = np.frombuffer(bytearray(x), dtype=np.uint8)
+    x = np.asarray(x)
+    if not x.flags.writeable:
+        x = x.copy()
+    return torch.from_numpy(x)
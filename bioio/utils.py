@@ -1,7 +1,16 @@
 # %%
+import os
+import threading
+
+import numpy as np
 import tensorflow as tf
 import pandas as pd
 
+# %%
+# Disable absl INFO and WARNING log messages (like bioio.tf and bioio.dataspec)
+from absl import logging as absl_logging
+absl_logging.set_verbosity(absl_logging.ERROR)
+
 # %%
 def flatten_dict(data_dict):
     return pd.json_normalize(data_dict, sep='/').to_dict(orient='records')[0]
@@ -32,3 +41,141 @@ def sequence2onehot(sequence, mapping=base2int):
 def mask_noncanonical_bases(sequence):
     return ''.join([base if base in base2int else 'N' for base in sequence])
 
+# %%
+# Lookup tables over ASCII byte values, used by the vectorized (batch) encoders below
+_UPPER_LUT = np.arange(256, dtype=np.uint8)
+_UPPER_LUT[ord('a'):ord('z') + 1] -= ord('a') - ord('A')
+
+_MASK_LUT = np.full(256, ord('N'), dtype=np.uint8)
+_COMPLEMENT_LUT = np.full(256, ord('N'), dtype=np.uint8)
+_BASE2INT_LUT = np.full(256, len(base2int), dtype=np.uint8)
+for _base, _i in base2int.items():
+    _MASK_LUT[ord(_base)] = ord(_base)
+    _COMPLEMENT_LUT[ord(_base)] = ord(baseComplement[_base])
+    _BASE2INT_LUT[ord(_base)] = _i
+
+# one-hot rows for A, C, G, T and an all-zero row for everything else
+_ONEHOT_LUT = np.eye(len(base2int) + 1, len(base2int), dtype=np.int8)
+
+# %%
+def decode_strand(strand):
+    return strand.decode('UTF-8') if isinstance(strand, bytes) else strand
+
+# %%
+def sequences_to_bytes(sequences, strands=None, mask_noncanonical=True):
+    """Concatenates a batch of DNA sequences to a single upper-cased uint8 array. 
+
+    Non-canonical bases are (optionally) masked to 'N' and sequences on the '-' strand are 
+    reverse-complemented, both as lookup-table operations over the whole batch. 
+
+    Args:
+        sequences (list): DNA sequences (str or bytes)
+        strands   (list): Strands ('+' or '-'), one per sequence. Defaults to all '+'.
+        mask_noncanonical (bool): Map everything except A, C, G, T to N
+
+    Returns:
+        tuple: (numpy.array of concatenated bases, numpy.array of sequence lengths)
+    """
+
+    sequences = [s.encode('ascii') if isinstance(s, str) else bytes(s) for s in sequences]
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    values = _UPPER_LUT[np.frombuffer(b''.join(sequences), dtype=np.uint8)]
+
+    if mask_noncanonical:
+        values = _MASK_LUT[values]
+
+    if strands is not None:
+        strands = np.array([decode_strand(strand) for strand in strands], dtype=object)
+        unknown = set(strands) - {'+', '-'}
+        if unknown:
+            raise ValueError(f'Unknown strand: {unknown.pop()}')
+
+        is_minus = np.repeat(strands == '-', lengths)
+        if np.any(is_minus):
+            # mirror each '-' segment around its center, i.e. position i in [o, o+l) maps to 2*o + l - 1 - i
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.arange(len(values))
+            mirrored = np.repeat(2*offsets + lengths - 1, lengths) - positions
+            values = np.where(is_minus, _COMPLEMENT_LUT[values], values)[np.where(is_minus, mirrored, positions)]
+
+    return values, lengths
+
+# %%
+def bytes2int(values):
+    """Maps an array of base bytes to integers (A: 0, C: 1, G: 2, T: 3, everything else: 4)."""
+    return _BASE2INT_LUT[values]
+
+# %%
+def bytes2onehot(values, dtype=np.int8):
+    """One-hot encodes an array of base bytes to shape (len(values), 4). Non-canonical bases are all-zero."""
+    return _ONEHOT_LUT.astype(dtype, copy=False)[bytes2int(values)]
+
+# %%
+def encode_sequences(sequences, strands=None, to_onehot=True, mask_noncanonical=True, dtype=np.int8, flat=False):
+    """Vectorized encoding of a batch of DNA sequences. 
+
+    Gives the same result as `mask_noncanonical_bases`, `reverse_complement` (for '-' strands) and 
+    `sequence2onehot` applied per sequence, but all steps are NumPy lookup-table operations. 
+
+    Args:
+        sequences (list): DNA sequences (str or bytes)
+        strands   (list): Strands ('+' or '-'), one per sequence. Defaults to all '+'.
+        to_onehot (bool): Return one-hot arrays of shape (L, 4) instead of strings
+        mask_noncanonical (bool): Map everything except A, C, G, T to N (one-hot rows of non-canonical bases are always zero)
+        dtype     (numpy.dtype): Dtype of one-hot arrays
+        flat      (bool): Return (concatenated values, lengths) instead of a list
+
+    Returns:
+        list: One numpy.array of shape (L, 4) (or string, if to_onehot=False) per sequence
+    """
+
+    values, lengths = sequences_to_bytes(sequences, strands, mask_noncanonical=(mask_noncanonical and not to_onehot))
+    if to_onehot:
+        values = bytes2onehot(values, dtype=dtype)
+
+    if flat:
+        return values, lengths
+
+    encoded = np.split(values, np.cumsum(lengths)[:-1]) if len(lengths) > 0 else []
+    if not to_onehot:
+        encoded = [e.tobytes().decode('ascii') for e in encoded]
+    return encoded
+
+# %%
+def encode_sequence(sequence, strand='+', **kwargs):
+    """Vectorized encoding of a single DNA sequence. See `encode_sequences`."""
+    return encode_sequences([sequence], [strand], **kwargs)[0]
+
+# %%
+class HandlePool():
+    """
+    Pool of (not thread-safe) file handles with one handle per thread (and process), opened lazily.
+
+    Args:
+        open_func (callable): Opens a new handle, e.g. pysam.FastaFile
+        *args: Arguments passed to open_func
+    """
+
+    def __init__(self, open_func, *args, **kwargs) -> None:
+        self.open_func = open_func
+        self.args = args
+        self.kwargs = kwargs
+        self._local = threading.local()
+
+    def get(self):
+        """Returns the handle of the current thread."""
+        # handles are not shared with forked processes either
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.handle = self.open_func(*self.args, **self.kwargs)
+            self._local.pid = os.getpid()
+        return self._local.handle
+
+    def __getstate__(self):
+        # handles are not picklable, they are reopened on first use
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
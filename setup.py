@@ -14,6 +14,10 @@ setup(name='bioio',
       author_email='marc.horlacher@gmail.com',
       license='MIT',
       install_requires=requirements,
+      extras_require={
+            # zstd block compression (see `bioio serialize --block-compression zstd`), built into python >= 3.14
+            'zstd': ['zstandard'],
+      },
       packages=find_packages(),
       include_package_data=False,
       entry_points = {
@@ -0,0 +1,32 @@
+# %%
+"""Light `bioio` commands must start within a time budget and without heavy imports (see benchmarks/import_time.py)."""
+
+# %%
+import os
+import importlib.util
+
+import pytest
+
+# %%
+# benchmarks/ is not a package, i.e. the benchmark is loaded from its path
+_spec = importlib.util.spec_from_file_location('import_time', os.path.join(os.path.dirname(__file__), '..', 'benchmarks', 'import_time.py'))
+import_time = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(import_time)
+
+# start-up time (in seconds) of each light command, including the python interpreter
+BUDGET = float(os.environ.get('BIOIO_IMPORT_TIME_BUDGET', 1.0))
+
+# %%
+@pytest.fixture(scope='module')
+def directory(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('import_time')
+    import_time.write_test_tfrecord(str(directory / 'test.tfrecord'))
+    return directory
+
+# %%
+@pytest.mark.parametrize('name', list(import_time.light_commands('test.tfrecord', '.')))
+def test_light_command(name, directory):
+    args = import_time.light_commands(str(directory / 'test.tfrecord'), str(directory))[name]
+    seconds, heavy = import_time.measure_command(args)
+    assert heavy == [], f"'bioio {name}' imports {', '.join(heavy)}"
+    assert seconds <= BUDGET, f"'bioio {name}' takes {seconds:.2f}s, the budget is {BUDGET:.2f}s"
@@ -0,0 +1,74 @@
+# %%
+"""Map-style torch TFRecordDataset (see bioio.torch.datasets) over uncompressed, block-compressed and gzip-compressed files."""
+
+# %%
+import gzip
+import shutil
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+tf = pytest.importorskip('tensorflow')
+
+from bioio.tf.utils import dataset_to_tfrecord
+from bioio.tf.index import index_tfrecord
+from bioio.tf.writer import iter_records
+from bioio.tf.blocks import BlockCompression, BlockTFRecordWriter
+from bioio.torch.datasets import TFRecordDataset
+
+# %%
+NUM_RECORDS = 50
+
+@pytest.fixture(scope='module')
+def tfrecord(tmp_path_factory):
+    tfrecord = str(tmp_path_factory.mktemp('torch') / 'test.tfrecord')
+    dataset = tf.data.Dataset.range(NUM_RECORDS).map(lambda i: {'inputs': {'id': i, 'values': tf.fill([3], tf.cast(i, tf.float32))}})
+    dataset_to_tfrecord(dataset, tfrecord)
+    index_tfrecord(tfrecord, tfrecord + '.idx')
+    return tfrecord
+
+# %%
+def block_copy(tfrecord, filepath):
+    with BlockTFRecordWriter(filepath, BlockCompression('zlib', block_size=256)) as writer:
+        for record in iter_records(tfrecord):
+            writer.write(record)
+    index_tfrecord(filepath, filepath + '.idx')
+    shutil.copy(tfrecord + '.features.json', filepath + '.features.json')
+    return filepath
+
+# %%
+@pytest.mark.parametrize('block', [False, True])
+def test_getitem(tfrecord, block):
+    if block:
+        tfrecord = block_copy(tfrecord, tfrecord.replace('test.tfrecord', 'block.tfrecord'))
+    dataset = TFRecordDataset(tfrecord)
+    assert len(dataset) == NUM_RECORDS
+    for i in (0, 17, NUM_RECORDS - 1, -1):
+        example = dataset[i]
+        assert int(example['inputs']['id']) == i % NUM_RECORDS
+        assert np.array_equal(example['inputs']['values'].numpy(), np.full(3, i % NUM_RECORDS, dtype=np.float32))
+    assert [int(example['inputs']['id']) for example in dataset.__getitems__([5, 3, 40])] == [5, 3, 40]
+
+# %%
+def test_shards(tfrecord):
+    dataset = TFRecordDataset([tfrecord, tfrecord])
+    assert len(dataset) == 2*NUM_RECORDS
+    assert int(dataset[NUM_RECORDS + 2]['inputs']['id']) == 2
+    with pytest.raises(IndexError):
+        dataset[2*NUM_RECORDS]
+
+# %%
+def test_dataloader(tfrecord):
+    loader = torch.utils.data.DataLoader(TFRecordDataset(tfrecord, features=['inputs/id']), batch_size=16)
+    ids = torch.cat([batch['inputs']['id'] for batch in loader])
+    assert ids.tolist() == list(range(NUM_RECORDS))
+
+# %%
+def test_gzip_is_rejected(tfrecord):
+    gzipped = tfrecord.replace('test.tfrecord', 'gzipped.tfrecord')
+    with open(tfrecord, 'rb') as src, gzip.open(gzipped, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    shutil.copy(tfrecord + '.idx', gzipped + '.idx')
+    with pytest.raises(ValueError, match='gzip-compressed'):
+        TFRecordDataset(gzipped, features_file=tfrecord + '.features.json')